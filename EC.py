@@ -11,19 +11,61 @@ parser.add_argument("experiment")
 parser.add_argument("-c", "--mCalib_file", type=str, default="None")
 parser.add_argument("-p", "--mCalib_protocol", type=str, default="mCalib")    
 parser.add_argument("-r", "--repeats", type=int, default=10)
-args = parser.parse_args()
+parser.add_argument("-s", "--simulate", action="store_true",
+                    help="use the simulated DAQ, no arena")
+parser.add_argument("-f", "--flush", type=str, default="protocol",
+                    help="flush data file every 'protocol', 'trial' or "
+                         "number of seconds")
+parser.add_argument("--sampling_rate", type=int, default=10000,
+                    help="samples per second, for new experiments")
+parser.add_argument("--section", type=int, default=1000,
+                    help="samples per DAQ section, for new experiments")
+parser.add_argument("-l", "--live", nargs="?", const=True, default=False,
+                    help="publish acquired data to a live tap file "
+                         "(default in the temp directory)")
+parser.add_argument("--cache", type=str, default="copy",
+                    help="stimulus cache: 'copy' cached waveforms into the "
+                         "data file, 'link' to them or 'off'")
+parser.add_argument("--lazy", action="store_true",
+                    help="store protocol specs and seeds instead of "
+                         "waveforms; stimuli are synthesized when played")
+parser.add_argument("-j", "--processes", type=int, default=None,
+                    help="processes generating stimuli for new experiments "
+                         "(default: one per core)")
+parser.add_argument("--storage", type=str, default="float",
+                    help="stimulus storage: 'float' (Analog Out and "
+                         "Digital Out as before), 'compact' (DAC codes and "
+                         "bit-packed lines, readers need "
+                         "stimulus.synthesizeProtocol) or 'compressed' "
+                         "(compact and gzip)")
+parser.add_argument("--raw", action="store_true",
+                    help="read and store analog input as raw int16 ADC "
+                         "codes with their scaling coefficients")
+
+# guarded, as stimulus generation starts processes that import this module
+# on Windows
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    experiment = args.experiment
+    if args.mCalib_file == "None":
+        mCalib = False
+    else:
+        mCalib = {"file": args.mCalib_file,
+                  "protocol": args.mCalib_protocol}
+    repeats = args.repeats
+    data_file_name = args.data_file
+    file_mode = 'a'
+    runExperiment.runExperiment(data_file_name, file_mode=file_mode,
+                  experiment=experiment, mCalib=mCalib, repeats=repeats,
+                  simulate=args.simulate, flush_policy=args.flush,
+                  sampling_rate=args.sampling_rate,
+                  sample_section=args.section, live_tap=args.live,
+                  stimulus_cache={"copy": True, "link": "link",
+                                  "off": False}[args.cache],
+                  lazy_stimulus=args.lazy,
+                  stimulus_processes=args.processes,
+                  stimulus_storage=args.storage,
+                  raw_ai=args.raw)
 
-experiment = args.experiment
-if args.mCalib_file == "None":
-    mCalib = False
-else:
-    mCalib = {"file": args.mCalib_file,
-              "protocol": args.mCalib_protocol}
-repeats = args.repeats
-data_file_name = args.data_file
-file_mode = 'a'
-runExperiment.runExperiment(data_file_name, file_mode=file_mode, experiment=experiment, 
-              mCalib=mCalib, repeats=repeats)
-              
-              
 # vim: set ts=4 sw=4 ft=python ai nu et
\ No newline at end of file
@@ -12,6 +12,11 @@ volatile bool arenaUpdated = false,
 
 byte pattern[40];
 
+volatile unsigned int stagedType = 0,
+                      stagedSize = 10;
+volatile bool patternStaged = false;
+byte stagedPattern[40];
+
 SPISettings settingsA(10000000, LSBFIRST, SPI_MODE0);
 
 void setup() {
@@ -59,15 +64,39 @@ void nextInSequence() {
 }
 
 void getCommand() {
-  unsigned char command;
+  unsigned char command, status = ACK_OK;
+  serialTimedOut = false;
   WaitTillSerialInputAvailableOrTimeout
   command = Serial.read();
-  if (command == 0x01) {
+  if (command == SET_BRIGHTNESS) {
     getBrightnessFromSerial();
   }
-  else if (command == 0x02) {
+  else if (command == SET_PATTERN) {
     getPatternParametersFromSerial();
   }
+  else if (command == STAGE_PATTERN) {
+    getStagedPatternFromSerial();
+  }
+  else if (command == COMMIT_PATTERN) {
+    if (!commitStagedPattern()) {
+      status = ACK_NOTHING_STAGED;
+    }
+  }
+  else {
+    status = ACK_UNKNOWN_COMMAND;
+  }
+  if (serialTimedOut) {
+    status = ACK_TIMEOUT;
+  }
+  acknowledge(command, status);
+}
+
+void acknowledge(unsigned char command, unsigned char status) {
+  Serial.write(GET_COMMAND);
+  Serial.write(ACKNOWLEDGE);
+  Serial.write(command);
+  Serial.write(status);
+  Serial.send_now();
 }
 
 void getBrightnessFromSerial() {
@@ -105,3 +134,37 @@ void getPatternParametersFromSerial() {
   sei();
 }
 
+
+void getStagedPatternFromSerial() {
+  union {
+    char c[2];
+    unsigned int b;
+  } t;
+  WaitTillSerialInputAvailableOrTimeout
+  t.c[0] = Serial.read();
+  WaitTillSerialInputAvailableOrTimeout
+  t.c[1] = Serial.read();
+  stagedType = t.b;
+  WaitTillSerialInputAvailableOrTimeout
+  t.c[0] = Serial.read();
+  WaitTillSerialInputAvailableOrTimeout
+  t.c[1] = Serial.read();
+  stagedSize = t.b;
+  setPattern(stagedPattern, stagedType, stagedSize, 0);
+  patternStaged = true;
+}
+
+bool commitStagedPattern() {
+  if (!patternStaged) {
+    return false;
+  }
+  cli();
+  patternType = stagedType;
+  patternSize = stagedSize;
+  currentOffset = 0;
+  memcpy(pattern, stagedPattern, 40);
+  updateArena();
+  sei();
+  patternStaged = false;
+  return true;
+}
@@ -17,6 +17,18 @@ nextpin - Input from DAQ to switch display to next pattern in sequence
 
 // Byte codes
 #define GET_COMMAND 0xcc
+#define SET_BRIGHTNESS 0x01
+#define SET_PATTERN 0x02
+// Stage a pattern (computed now, not shown), commit it (shown at once)
+#define STAGE_PATTERN 0x03
+#define COMMIT_PATTERN 0x04
+// Acknowledgement frame, sent after every command:
+// GET_COMMAND ACKNOWLEDGE <command> <status>
+#define ACKNOWLEDGE 0xac
+#define ACK_OK 0x00
+#define ACK_UNKNOWN_COMMAND 0x01
+#define ACK_TIMEOUT 0x02
+#define ACK_NOTHING_STAGED 0x03
 
 #define FORWARD 0
 #define BACKWARD 1
@@ -25,11 +37,13 @@ nextpin - Input from DAQ to switch display to next pattern in sequence
 #define SPOTCLOCKWISE 4
 #define SPOTCOUNTERCLOCKWISE 5
 
-int ts;
+unsigned long ts;
+bool serialTimedOut = false;
 #define WaitTillSerialInputAvailableOrTimeout \
 ts = millis();\
 while (Serial.available() == 0) {\
-  if (ts - millis() > SERtimeout) {\
+  if (millis() - ts > SERtimeout) {\
+    serialTimedOut = true;\
     break;\
   }\
 }
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Requirements : numpy
+               scipy
+
+Simulated stand-in for DAQmxAcquisition.Continuous. Same acquire / stop
+contract, no NI hardware or PyDAQmx needed. Use to load-test the acquisition
+pipeline (runExperiment -> readStimulus / writeData) on any machine.
+
+# Analog in (default loopback):
+#            0: Analog out 0
+#            1: Analog out 0
+#            2: Analog out 1
+
+# Digital in:
+#  Port0/line2: Loop back from Port0/line1 (delayed by di_offset samples)
+#            3: STCP (idle high, low for stcp_width samples, stcp_delay
+#               samples after every falling edge of line2)
+"""
+
+from .experimentCommon import *
+from . import experimentCommon
+
+# Raw code to volts polynomial of the simulated ADC
+_simulated_ai_scaling = np.array([1.5e-4, 20.0 / 2 ** 16 * 1.0002, 0.0, 0.0])
+
+class Continuous:
+    """Simulated Continuous, Synchronized Analog & Digital Input-Output
+
+    Output sections are queued in a buffer of one second (as on the device)
+    and clocked out against a sample clock. acquire blocks while the output
+    buffer is full, so the caller is paced exactly like by the real device.
+    Whatever has been clocked out comes back on the input channels.
+
+    ai_source         - analog output channel looped back into each analog
+                        input channel
+    transfer_function - (b, a) filter applied to the analog loopback
+    noise             - standard deviation (V) of gaussian noise added to
+                        analog input
+    di_offset         - samples by which digital input lags analog input
+    jitter            - maximum random host side delay (s) added per acquire
+    realtime          - False runs on a virtual clock, as fast as possible
+    raw_ai            - analog input as int16 codes of a simulated 16 bit
+                        ADC (+-10 V, with a small gain and offset error),
+                        scaled by ai_scaling_coefficients as on the device
+
+    ao_queued and ai_backlog report output and input buffer levels after
+    every acquire, as on the device.
+
+    Use injectStall / injectUnderrun to provoke output buffer underruns.
+    As on the device, input is read into a ring of preallocated section
+    buffers; hand them back with release once written.
+    """
+    def __init__(self, ai=None, ao=None, di=None, do=None,
+                 n_samples_section=1000, sampling_rate=None,
+                 ai_source=None, transfer_function=None, noise=0.0,
+                 di_offset=0, stcp_delay=2, stcp_width=1,
+                 jitter=0.0, realtime=True, raw_ai=False):
+        if sampling_rate is None:
+            sampling_rate = experimentCommon.sampling_rate
+        self.sampling_rate = float(sampling_rate)
+        self.bufferSize = int(sampling_rate)
+        self.n_samples_section = n_samples_section
+        self.read = None
+        self.written = None
+        self.ai_n_samples_read = 0
+        self.di_n_samples_read = 0
+        self.n_underruns = 0
+        self.n_overflows = 0
+        self.ao_queued = 0
+        self.ai_backlog = 0
+        self.noise = noise
+        self.jitter = jitter
+        self.realtime = realtime
+        self.stcp_delay = stcp_delay
+        self.stcp_width = stcp_width
+        self.ao_chan_count = countChannels(ao) if ao is not None else None
+        self.do_chan_count = countChannels(do) if do is not None else None
+        self.ai_chan_count = countChannels(ai) if ai is not None else None
+        self.di_chan_count = countChannels(di) if di is not None else None
+        n_buffers = 2 * (self.bufferSize // n_samples_section) + 2
+        self._ai_ring = None
+        self._di_ring = None
+        self.raw_ai = raw_ai
+        self.ai_scaling_coefficients = None
+        if self.ai_chan_count is not None:
+            ai_dtype = None
+            if raw_ai:
+                self.ai_scaling_coefficients = np.tile(
+                    _simulated_ai_scaling, (self.ai_chan_count, 1))
+                ai_dtype = np.int16
+            self._ai_ring = bufferRing(n_buffers, (n_samples_section,
+                                                   self.ai_chan_count),
+                                       dtype=ai_dtype)
+        if self.di_chan_count is not None:
+            self._di_ring = bufferRing(n_buffers, (n_samples_section,
+                                                   self.di_chan_count),
+                                       digital=True)
+        if ai_source is None:
+            ai_source = [0, 0, 1]
+        self.ai_source = ai_source
+        if transfer_function is None:
+            transfer_function = ([1.0], [1.0])
+        self._b = np.asarray(transfer_function[0], dtype=np.float64)
+        self._a = np.asarray(transfer_function[1], dtype=np.float64)
+        n_state = max(len(self._a), len(self._b)) - 1
+        if self.ai_chan_count is not None:
+            self._ai_filter_state = [np.zeros(n_state)
+                                     for i in range(self.ai_chan_count)]
+        self._step_delay_line = np.zeros(di_offset, dtype=np.uint8)
+        self._stcp_carry = np.ones(stcp_delay + stcp_width, dtype=np.uint8)
+        self._last_step = 0
+        self._virtual_time = 0.0
+        self._start_time = None
+        self._stall = 0.0
+        self._n_written = 0
+        self._n_generated = 0
+        self._n_read = 0
+        self._ao_pending = []
+        self._do_pending = []
+        self._ai_backlog = []
+        self._di_backlog = []
+
+    def acquire(self, ao_data, do_data):
+        if self.jitter > 0:
+            self._sleep(random.uniform(0, self.jitter))
+        if self._stall > 0:
+            self._sleep(self._stall)
+            self._stall = 0.0
+        self._clockOut()
+        n_samples = len(ao_data) if ao_data is not None else len(do_data)
+        while self._n_written - self._n_generated + n_samples > \
+              self.bufferSize:
+            space_needed = self._n_written - self._n_generated + \
+                           n_samples - self.bufferSize
+            self._sleep(space_needed / self.sampling_rate)
+            self._clockOut()
+        if ao_data is None:
+            ao_data = dataArray((n_samples, self.ao_chan_count or 2))
+        if do_data is None:
+            do_data = dataArray((n_samples, self.do_chan_count or 2),
+                                digital=True)
+        self._ao_pending.append(np.array(ao_data, dtype=np.float64))
+        self._do_pending.append(np.array(do_data, dtype=np.uint8))
+        self._n_written += n_samples
+        self.written = n_samples
+        if self._start_time is None:
+            self._start_time = self._now()
+        self.read = min(self._n_generated - self._n_read,
+                        self.n_samples_section)
+        self._n_read += self.read
+        self.ao_queued = self._n_written - self._n_generated
+        self.ai_backlog = self._n_generated - self._n_read
+        if self.ai_chan_count is not None:
+            ai_data = self._ai_ring.get()
+            if self.read > 0:
+                ai_data[:self.read] = _take(self._ai_backlog, self.read)
+            self.ai_n_samples_read += self.read
+        else:
+            ai_data = None
+        if self.di_chan_count is not None:
+            di_data = self._di_ring.get()
+            if self.read > 0:
+                di_data[:self.read] = _take(self._di_backlog, self.read)
+            self.di_n_samples_read += self.read
+        else:
+            di_data = None
+        return ai_data[:self.read], di_data[:self.read]
+
+    def release(self, ai_data, di_data):
+        """Return buffers handed out by acquire to the ring"""
+        if self._ai_ring is not None:
+            self._ai_ring.release(ai_data)
+        if self._di_ring is not None:
+            self._di_ring.release(di_data)
+
+    def reserveBuffers(self, n_buffers):
+        """Keep at least n_buffers section buffers in each ring, as many as
+        the consumer can hold at once"""
+        for ring in [self._ai_ring, self._di_ring]:
+            if ring is not None:
+                ring.reserve(n_buffers)
+
+    @property
+    def n_buffer_allocations(self):
+        """Section buffers allocated after start, 0 in steady state"""
+        return sum([ring.n_allocations for ring in
+                    [self._ai_ring, self._di_ring] if ring is not None])
+
+    def injectStall(self, seconds):
+        """Block the next acquire for given seconds before writing"""
+        self._stall += seconds
+
+    def injectUnderrun(self):
+        """Stall the next acquire long enough to drain the output buffer"""
+        queued = self._n_written - self._n_generated
+        self.injectStall((queued + self.n_samples_section) /
+                         self.sampling_rate)
+
+    def stop(self):
+        if self._start_time is not None:
+            print "Simulated DAQ: %d samples read, %d underrun(s), " \
+                  "%d overflow(s), %d buffer allocation(s)" % \
+                  (self.ai_n_samples_read, self.n_underruns,
+                   self.n_overflows, self.n_buffer_allocations)
+        self._start_time = None
+
+    def _now(self):
+        if self.realtime:
+            return time.time()
+        return self._virtual_time
+
+    def _sleep(self, seconds):
+        if self.realtime:
+            time.sleep(seconds)
+        else:
+            self._virtual_time += seconds
+
+    def _clockOut(self):
+        """Move samples clocked out since the last call from the output
+        buffer to the input backlog"""
+        if self._start_time is None:
+            return
+        now = self._now()
+        clock = int((now - self._start_time) * self.sampling_rate)
+        if clock > self._n_written:
+            self.n_underruns += 1
+            print "Simulated DAQ: output buffer underrun at sample", \
+                  self._n_written
+            self._start_time = now - self._n_written / self.sampling_rate
+            clock = self._n_written
+        n_samples = clock - self._n_generated
+        if n_samples <= 0:
+            return
+        ao_data = _take(self._ao_pending, n_samples)
+        do_data = _take(self._do_pending, n_samples)
+        self._n_generated += n_samples
+        if self._n_generated - self._n_read > self.bufferSize:
+            self.n_overflows += 1
+            print "Simulated DAQ: input buffer overflow at sample", \
+                  self._n_generated
+        if self.ai_chan_count is not None:
+            self._ai_backlog.append(self._analogLoopback(ao_data))
+        if self.di_chan_count is not None:
+            self._di_backlog.append(self._digitalLoopback(do_data))
+
+    def _analogLoopback(self, ao_data):
+        ai_data = dataArray((len(ao_data), self.ai_chan_count))
+        for channel in range(self.ai_chan_count):
+            source = self.ai_source[channel]
+            ai_data[:, channel], self._ai_filter_state[channel] = \
+                scipy.signal.lfilter(self._b, self._a, ao_data[:, source],
+                                     zi=self._ai_filter_state[channel])
+        if self.noise > 0:
+            ai_data += np.random.normal(0, self.noise, ai_data.shape)
+        if self.raw_ai:
+            offset, gain = _simulated_ai_scaling[:2]
+            ai_data = np.clip(np.round((ai_data - offset) / gain),
+                              -2 ** 15, 2 ** 15 - 1).astype(np.int16)
+        return ai_data
+
+    def _digitalLoopback(self, do_data):
+        n_samples = len(do_data)
+        di_data = dataArray((n_samples, self.di_chan_count), digital=True)
+        step = np.concatenate((self._step_delay_line, do_data[:, 1]))
+        self._step_delay_line = step[n_samples:]
+        step = step[:n_samples]
+        previous = np.concatenate(([self._last_step], step[:-1]))
+        self._last_step = step[-1]
+        falling_edge_list = np.flatnonzero((previous == 1) & (step == 0))
+        stcp = np.ones(n_samples + len(self._stcp_carry), dtype=np.uint8)
+        stcp[:len(self._stcp_carry)] = self._stcp_carry
+        for i in range(self.stcp_width):
+            stcp[falling_edge_list + self.stcp_delay + i] = 0
+        self._stcp_carry = stcp[n_samples:]
+        di_data[:, 0] = step
+        if self.di_chan_count > 1:
+            di_data[:, 1] = stcp[:n_samples]
+        return di_data
+
+def _take(section_list, n_samples):
+    """Remove and return the first n_samples rows from a list of sections"""
+    taken = []
+    while n_samples > 0 and len(section_list) > 0:
+        section = section_list[0]
+        if len(section) <= n_samples:
+            taken.append(section_list.pop(0))
+            n_samples -= len(section)
+        else:
+            taken.append(section[:n_samples])
+            section_list[0] = section[n_samples:]
+            n_samples = 0
+    return np.concatenate(taken)
+
+if __name__ == "__main__":
+    for rate in [10000, 50000, 100000, 200000]:
+        section = rate / 10
+        test = Continuous(ai="Dev1/ai0:2", ao="Dev1/ao0:1",
+                          di="Dev1/port0/line2:3", do="Dev1/port0/line0:1",
+                          n_samples_section=section, sampling_rate=rate,
+                          noise=0.001, jitter=0.002)
+        ao = dataArray((section, 2))
+        do = dataArray((section, 2), digital=True)
+        acquire_time_list = []
+        for i in range(50):
+            t0 = time.time()
+            ai, di = test.acquire(ao, do)
+            test.release(ai, di)
+            acquire_time_list.append(time.time() - t0)
+        print rate, "S/s: mean acquire %.2f ms, max %.2f ms," % \
+            (1000 * np.mean(acquire_time_list),
+             1000 * np.max(acquire_time_list)),
+        test.stop()
@@ -9,7 +9,9 @@ Written for NI USB-6229 / USB-6259
 """
 
 from .experimentCommon import *
+from . import experimentCommon
 from PyDAQmx import *
+from ctypes import create_string_buffer
 
 class Continuous:
     """Continuous, Synchronized Analog & Digital[!] Input-Output
@@ -17,21 +19,45 @@ class Continuous:
     [!] Digital input task does not support start trigger. So digital input
     data will be offset by an unknown number of samples. Use two extra
     digital lines with hardware loopback to figure out the offset.
+
+    Input is read into a ring of preallocated section buffers. acquire
+    returns views into them; hand them back with release once written.
+
+    After every acquire, ao_queued is the number of samples queued in the
+    output buffer ahead of the sample clock (underrun margin) and
+    ai_backlog the number of samples left unread in the input buffer
+    (overflow margin).
+
+    With raw_ai, analog input is read unscaled, as the ADC's int16 codes;
+    ai_scaling_coefficients (one row per channel, see scaleAnalogIn) turn
+    them into volts. Otherwise it is read in volts (float64) and
+    ai_scaling_coefficients is None.
     """
     def __init__(self, ai=None, ao=None, di=None, do=None,
-                 n_samples_section=1000):
-        global sampling_rate
+                 n_samples_section=1000, sampling_rate=None, raw_ai=False):
+        if sampling_rate is None:
+            sampling_rate = experimentCommon.sampling_rate
+        self.sampling_rate = sampling_rate
         self.bufferSize = uInt32(int(sampling_rate))
         self.n_samples_section = n_samples_section
         self.read = None
         self.written = None
         self.ai_n_samples_read = 0
         self.di_n_samples_read = 0
+        self.ao_queued = 0
+        self.ai_backlog = 0
         self._analogRead = int32()
         self._digitalRead = int32()
         self._digitalReadBytes = int32()
         self._analogWritten = int32()
         self._digitalWritten = int32()
+        self._writeSpaceAvail = uInt32()
+        self._readAvail = uInt32()
+        self._ai_ring = None
+        self._di_ring = None
+        self.raw_ai = raw_ai
+        self.ai_scaling_coefficients = None
+        n_buffers = 2 * (int(sampling_rate) // n_samples_section) + 2
         try:
             if ao is not None:
                 self.ao_task_handle = TaskHandle()
@@ -82,6 +108,15 @@ class Continuous:
                                       DAQmx_Val_DoNotOverwriteUnreadSamps)
                 DAQmxStartTask(self.ai_task_handle)
                 self.ai_chan_count = countChannels(ai)
+                if raw_ai:
+                    self.ai_scaling_coefficients = \
+                        self._aiScalingCoefficients()
+                    ai_dtype = np.int16
+                else:
+                    ai_dtype = None
+                self._ai_ring = bufferRing(n_buffers, (self.n_samples_section,
+                                                       self.ai_chan_count),
+                                           dtype=ai_dtype)
             else:
                 self.ai_task_handle = None
                 self.ai_chan_count = None
@@ -102,6 +137,9 @@ class Continuous:
                                       DAQmx_Val_DoNotOverwriteUnreadSamps)
                 DAQmxStartTask(self.di_task_handle)
                 self.di_chan_count = countChannels(di)
+                self._di_ring = bufferRing(n_buffers, (self.n_samples_section,
+                                                       self.di_chan_count),
+                                           digital=True)
             else:
                 self.di_task_handle = None
                 self.di_chan_count = None
@@ -117,6 +155,10 @@ class Continuous:
                                     DAQmx_Val_GroupByScanNumber, 
                                     ao_data, byref(self._analogWritten), None)
                 self.written = self._analogWritten.value
+                DAQmxGetWriteSpaceAvail(self.ao_task_handle,
+                                        byref(self._writeSpaceAvail))
+                self.ao_queued = self.bufferSize.value - \
+                                 self._writeSpaceAvail.value
             if self.do_task_handle is not None:
                 DAQmxWriteDigitalLines(self.do_task_handle, 
                                        self.n_samples_section, 1, 10.0, 
@@ -124,19 +166,26 @@ class Continuous:
                                        do_data, byref(self._digitalWritten), 
                                        None)
             if self.ai_task_handle is not None:
-                ai_data = dataArray((self.n_samples_section,
-                                      self.ai_chan_count))
-                DAQmxReadAnalogF64(self.ai_task_handle, -1, 10.0, 
-                                   DAQmx_Val_GroupByScanNumber, 
-                                   ai_data, ai_data.size, 
-                                   byref(self._analogRead), None)
+                ai_data = self._ai_ring.get()
+                if self.raw_ai:
+                    DAQmxReadBinaryI16(self.ai_task_handle, -1, 10.0,
+                                       DAQmx_Val_GroupByScanNumber,
+                                       ai_data, ai_data.size,
+                                       byref(self._analogRead), None)
+                else:
+                    DAQmxReadAnalogF64(self.ai_task_handle, -1, 10.0, 
+                                       DAQmx_Val_GroupByScanNumber, 
+                                       ai_data, ai_data.size, 
+                                       byref(self._analogRead), None)
                 self.read = self._analogRead.value
                 self.ai_n_samples_read += self._analogRead.value
+                DAQmxGetReadAvailSampPerChan(self.ai_task_handle,
+                                             byref(self._readAvail))
+                self.ai_backlog = self._readAvail.value
             else:
                 ai_data = None
             if self.di_task_handle is not None:
-                di_data = dataArray((self.n_samples_section,
-                                      self.di_chan_count), digital=True)
+                di_data = self._di_ring.get()
                 DAQmxReadDigitalLines(self.di_task_handle, -1, 10.0, 
                                       DAQmx_Val_GroupByScanNumber,
                                       di_data,di_data.size, 
@@ -150,6 +199,40 @@ class Continuous:
             self.stop()
         return ai_data[:self.read], di_data[:self.read]
 
+    def _aiScalingCoefficients(self, n_coefficients=4):
+        """Polynomial from raw codes to volts of every AI channel of the
+        task, as calibrated by the device (M series: 4 coefficients)"""
+        n_channels = uInt32()
+        DAQmxGetTaskNumChans(self.ai_task_handle, byref(n_channels))
+        channel_name = create_string_buffer(256)
+        coefficients = np.zeros((n_channels.value, n_coefficients))
+        for channel in range(n_channels.value):
+            DAQmxGetNthTaskChannel(self.ai_task_handle, channel + 1,
+                                   channel_name, len(channel_name))
+            DAQmxGetAIDevScalingCoeff(self.ai_task_handle, channel_name.value,
+                                      coefficients[channel], n_coefficients)
+        return coefficients
+
+    def release(self, ai_data, di_data):
+        """Return buffers handed out by acquire to the ring"""
+        if self._ai_ring is not None:
+            self._ai_ring.release(ai_data)
+        if self._di_ring is not None:
+            self._di_ring.release(di_data)
+
+    def reserveBuffers(self, n_buffers):
+        """Keep at least n_buffers section buffers in each ring, as many as
+        the consumer can hold at once"""
+        for ring in [self._ai_ring, self._di_ring]:
+            if ring is not None:
+                ring.reserve(n_buffers)
+
+    @property
+    def n_buffer_allocations(self):
+        """Section buffers allocated after start, 0 in steady state"""
+        return sum([ring.n_allocations for ring in
+                    [self._ai_ring, self._di_ring] if ring is not None])
+
     def stop(self):
         for taskHandle in [self.ai_task_handle, self.ao_task_handle,
                            self.di_task_handle, self.do_task_handle]:
@@ -157,32 +240,6 @@ class Continuous:
                 DAQmxStopTask(taskHandle)
                 DAQmxClearTask(taskHandle)
 
-def countChannels(channelString=""):
-    """Returns the number of physical channels in a string containing
-    physical channel lists
-
-    http://zone.ni.com/reference/en-XX/help/370466V-01/mxcncpts/physchannames/
-    """
-    count = 0
-    if channelString.count(",") > 0:
-        t = channelString.split(",")
-        for i in t:
-            count += countChannels(i)
-        return count
-    else:
-        if channelString.count(":") > 0:
-            t2 = channelString.split(":")
-            n2 = int(t2[1])
-            # Detect last number in string:
-            t3 = re.match(r'(.*?)(\d+$)', t2[0]).groups() 
-            n1 = int(t3[1])
-            if n1 > n2:
-                return n1 - n2 + 1
-            else:
-                return n2 - n1 + 1
-        else:
-            return 1
-
 if __name__ == "__main__":
     sampling_rate = 10000
     ao = dataArray((80000,2))
@@ -5,15 +5,64 @@
 Requirements : pyserial
 
 Written for 1D LED arena vI.2
+
+Commands: 0xcc <command> <little endian uint16 arguments>
+    0x01 brightness
+    0x02 pattern type, pattern size
+    0x03 stage pattern type, pattern size (computed, not shown yet)
+    0x04 commit the staged pattern
+The firmware acknowledges every command with 0xcc 0xac <command> <status>.
 """
 
-from .experimentCommon import thread, math
+from .experimentCommon import math, threading, Queue, np, time
+from timeit import default_timer
+from .arenaPattern import mode_list
 import serial
 
+GET_COMMAND = 0xcc
+SET_BRIGHTNESS = 0x01
+SET_PATTERN = 0x02
+STAGE_PATTERN = 0x03
+COMMIT_PATTERN = 0x04
+ACKNOWLEDGE = 0xac
+ACK_UNKNOWN_COMMAND = 0x01
+status_list = ["ok", "unknown command", "timeout", "nothing staged"]
+
 class arena:
-    def __init__(self, port):
+    """1D LED arena on a serial port
+
+    One I/O worker thread owns the port. Commands are queued and sent in
+    the order they were given; each waits for its acknowledgement (up to
+    ack_timeout s) before the next is sent, so a pattern and a brightness
+    change can never overtake or interleave each other. Calls return at
+    once with the queued command; wait() on it, or on the arena for all
+    queued commands. Round trip times are kept in round_trip_list.
+    Anything else the firmware sends ("Ready") is printed. After a serial
+    error (kept in error) the worker stops writing to the port and marks
+    every further command done with that error.
+
+    stagePattern uploads a pattern ahead of time; commitPattern shows it,
+    sent no earlier than a given time. Firmware without staging rejects
+    the stage command, or ignores it before any acknowledgement has
+    arrived; from then on stage commands are not sent and the commit sends
+    the whole pattern instead. Firmware from before acknowledgements is
+    recognised by the first command timing out without any acknowledgement
+    ever arriving; after that no command waits for one.
+    """
+    def __init__(self, port, ack_timeout=0.5):
         self._serial = serial.Serial(port=port, baudrate=115200, timeout=0.05)
-        self.readall()
+        self.ack_timeout = ack_timeout
+        self.round_trip_list = []
+        self.n_timeouts = 0
+        self.error = None
+        self._buffer = bytearray()
+        self._staged_data = None
+        self._staging_supported = None
+        self._acknowledging = None
+        self._command_queue = Queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="LEDarena")
+        self._worker.daemon = True
+        self._worker.start()
 
     def setBrightness(self, percent):
         max_brightness = (2 ** 16) - 1
@@ -21,34 +70,171 @@ class arena:
             brightness = (int((math.log10(100 - percent) / 2) * max_brightness))
         else:
             brightness = 0
-        command=[0xcc, 0x01, brightness & 0xff, (brightness & 0xff00) >> 8]
-        self._write(command)
-        self.readall()
-    
+        return self._send([GET_COMMAND, SET_BRIGHTNESS,
+                           brightness & 0xff, (brightness & 0xff00) >> 8])
+
     def sendPattern(self, mode="forward", angular_size=10):
-        mode_list = ["forward", "backward", "clockwise", "counterclockwise", 
-                     "spot clockwise", "spot counterclockwise"]
-        pattern_type = mode_list.index(mode)
-        command = [0xcc, 0x02, 
-                   pattern_type & 0xff, (pattern_type & 0xff00) >> 8, 
-                   angular_size & 0xff, (angular_size & 0xff00) >> 8]
-        self._write(command)
-        self.readall()
+        return self._send(_patternCommand(SET_PATTERN, mode, angular_size))
 
-    def end(self):
-        thread.start_new_thread(self._end,())
+    def stagePattern(self, mode="forward", angular_size=10):
+        self._staged_data = _patternCommand(SET_PATTERN, mode, angular_size)
+        return self._send(_patternCommand(STAGE_PATTERN, mode,
+                                          angular_size))
+
+    def commitPattern(self, at=None):
+        """Show the staged pattern; sent at time at (timeit.default_timer)
+        if given"""
+        command = arenaCommand([GET_COMMAND, COMMIT_PATTERN], due=at)
+        command.fallback = self._staged_data
+        self._command_queue.put(command)
+        return command
+
+    def wait(self):
+        """Block until every queued command is acknowledged or timed out"""
+        self._command_queue.join()
+
+    def roundTripSummary(self):
+        """Commands sent, median and max round trip (ms), timeouts"""
+        if len(self.round_trip_list) == 0:
+            return 0, 0.0, 0.0, self.n_timeouts
+        return (len(self.round_trip_list),
+                1000 * np.median(self.round_trip_list),
+                1000 * np.max(self.round_trip_list), self.n_timeouts)
 
-    def _end(self):
-        #self._readall()
+    def end(self):
+        self._command_queue.put(None)
+        self._worker.join()
+        if self.error is None:
+            self._print(self._serial.read(self._serial.inWaiting()))
         self._serial.close()
+        print "LED arena: %d commands, round trip median %.2f ms, " \
+              "max %.2f ms, %d timeout(s)" % self.roundTripSummary()
+
+    _end = end
+
+    def _send(self, data):
+        command = arenaCommand(data)
+        self._command_queue.put(command)
+        return command
+
+    def _run(self):
+        while True:
+            command = self._command_queue.get()
+            if command is None:
+                self._command_queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self._execute(command)
+                else:
+                    command.error = self.error
+            except Exception as err:
+                self.error = err
+                command.error = err
+                print "LED arena: serial error, dropping further commands:", \
+                      err
+            finally:
+                command.done.set()
+                self._command_queue.task_done()
+
+    def _execute(self, command):
+        if command.due is not None:
+            time.sleep(max(0, command.due - default_timer()))
+        if self._staging_supported is False:
+            if command.data[1] == STAGE_PATTERN:
+                return
+            if command.fallback is not None:
+                command.data = command.fallback
+        waiting = self._acknowledging is not False
+        t0 = default_timer()
+        command.sent = t0
+        self._serial.write(bytearray(command.data))
+        if waiting:
+            command.status = self._readAcknowledgement(command.data[1],
+                                                       t0 + self.ack_timeout)
+        command.round_trip = default_timer() - t0
+        if command.data[1] == STAGE_PATTERN:
+            if command.status == ACK_UNKNOWN_COMMAND:
+                self._staging_supported = False
+            elif command.status is not None:
+                self._staging_supported = True
+            elif self._acknowledging is not True:
+                # a timeout only says no staging before any acknowledgement
+                # has arrived; after that it is a lost acknowledgement
+                self._staging_supported = False
+        if command.status is None:
+            if waiting:
+                self.n_timeouts += 1
+                print "LED arena: no acknowledgement for command", \
+                      hex(command.data[1])
+            if self._acknowledging is None:
+                self._acknowledging = False
+                print "LED arena: firmware does not acknowledge, " \
+                      "not waiting for acknowledgements"
+        else:
+            self._acknowledging = True
+            self.round_trip_list.append(command.round_trip)
+            if command.status != 0 and self._staging_supported is not False:
+                print "LED arena: command %s, %s" % \
+                    (hex(command.data[1]), _statusName(command.status))
+
+    def _readAcknowledgement(self, command_code, deadline):
+        """Status from the acknowledgement frame for command_code, None if
+        none came before deadline"""
+        while True:
+            frame_start = self._buffer.find(bytearray([GET_COMMAND,
+                                                       ACKNOWLEDGE]))
+            if frame_start >= 0:
+                self._print(self._buffer[:frame_start])
+                del self._buffer[:frame_start]
+                if len(self._buffer) >= 4:
+                    frame = self._buffer[:4]
+                    del self._buffer[:4]
+                    if frame[2] == command_code:
+                        return frame[3]
+                    continue
+            elif len(self._buffer) > 1:
+                self._print(self._buffer[:-1])
+                del self._buffer[:-1]
+            if default_timer() > deadline:
+                return None
+            self._buffer.extend(self._serial.read(
+                max(1, self._serial.inWaiting())))
+
+    def _print(self, text):
+        text = str(text).strip()
+        if len(text) > 0:
+            print "LED arena:", text
+
+class arenaCommand:
+    """A queued command. status (0 ok, see status_list) and round_trip (s)
+    are set once it is acknowledged; status stays None on timeout, and on a
+    serial error, which is then kept in error, and when the firmware does
+    not acknowledge at all. A command with a due time is sent no earlier
+    than that; sent is when it was."""
+    def __init__(self, data, due=None):
+        self.data = data
+        self.due = due
+        self.fallback = None
+        self.sent = None
+        self.status = None
+        self.round_trip = None
+        self.error = None
+        self.done = threading.Event()
 
-    def readall(self):
-        thread.start_new_thread(self._readall,())
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.status
 
-    def _readall(self):
-        print self._serial.readall()
+def _patternCommand(command_code, mode, angular_size):
+    pattern_type = mode_list.index(mode)
+    return [GET_COMMAND, command_code,
+            pattern_type & 0xff, (pattern_type & 0xff00) >> 8,
+            angular_size & 0xff, (angular_size & 0xff00) >> 8]
 
-    def _write(self,data):
-        thread.start_new_thread(self._serial.write,(data,))
+def _statusName(status):
+    if status < len(status_list):
+        return status_list[status]
+    return "status " + str(status)
 
 # vim: set ts=4 sw=4 ft=python ai nu et
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Acquisition engine: stimulus reader -> DAQ -> writer
+
+    readStimulus --outputQ--> DAQ.acquire --inputQ--> writeData
+     (thread)                (caller's thread)         (thread)
+
+Both queues are bounded. A full queue blocks the stage feeding it
+(backpressure) and every block is counted. Stages end on a None sentinel,
+never on a timeout. An exception in any stage aborts the run and is
+re-raised from run(). On abort the DAQ stage stops after the current
+section, stimulus sections not yet played are discarded and everything
+already acquired is still written before run() returns.
+
+The writer keeps trial data in memory and writes it in chunks of
+chunk_sections sections, every flush_interval seconds (rounded to whole
+chunks). Write throughput and latency are saved as experiment attributes.
+The writer also flushes the data file, as set by flush_policy (see
+durabilityPolicy); the DAQ stage never touches the file system.
+
+Buffer health of the DAQ stage is recorded for every section (see
+daqTelemetry) and saved with a summary per protocol and per run.
+
+The arena pattern of every protocol is staged (uploaded to the arena
+without showing it) while the protocol before it plays, and committed when
+the protocol's first sample leaves the DAQ, which is ao_queued samples after
+it was written. The time from there to the commit's acknowledgement is the
+boundary latency, saved per boundary.
+
+With detect_spikes, the writer runs an analysis.OnlineSpikeDetector over
+Analog In channel 0 and saves spike positions with every trial as it is
+written.
+
+Given a live_tap (see liveData), the DAQ stage also publishes every acquired
+section to it, for monitoring from other processes.
+
+A DAQ reading raw analog input (raw_ai) hands over int16 ADC codes; they
+are written as they are, with the DAQ's scaling coefficients (see
+trialWriter).
+"""
+
+from .experimentCommon import *
+from .dataIO import readStimulus, writeData, playbackSchedule, \
+                    trialWriter, writeStatistics, durabilityPolicy
+from .analysis import OnlineSpikeDetector
+from timeit import default_timer
+
+class AcquisitionEngine:
+    def __init__(self, experiment_ref, data_file, DAQ, LED_arena=None,
+                 output_queue_size=50, input_queue_size=20,
+                 chunk_sections=10, flush_interval=1.0,
+                 flush_policy="protocol", live_tap=None, detect_spikes=True):
+        self.experiment_ref = experiment_ref
+        self.data_file = data_file
+        self.DAQ = DAQ
+        self.LED_arena = LED_arena
+        self.live_tap = live_tap
+        self.outputQ = Queue.Queue(maxsize=output_queue_size)
+        self.inputQ = Queue.Queue(maxsize=input_queue_size)
+        # sections held at once: a full inputQ, one being written and one
+        # being acquired
+        self.DAQ.reserveBuffers(input_queue_size + 2)
+        self.abort = threading.Event()
+        self.aborted = False
+        self.completed = False
+        self.n_output_backpressure = 0
+        self.n_input_backpressure = 0
+        self.schedule = playbackSchedule.fromExperiment(experiment_ref)
+        self.experiment_duration = self.schedule.duration
+        self.sampling_rate = self.schedule.sampling_rate
+        chunk_samples = chunk_sections * self.schedule.n_samples_section
+        flush_chunks = max(1, int(round(flush_interval * self.sampling_rate /
+                                        chunk_samples)))
+        self.write_statistics = writeStatistics()
+        if detect_spikes:
+            spike_detector = OnlineSpikeDetector(self.sampling_rate)
+        else:
+            spike_detector = None
+        self.trial_writer = trialWriter(chunk_samples,
+                                        flush_chunks=flush_chunks,
+                                        statistics=self.write_statistics,
+                                        spike_detector=spike_detector,
+                                        ai_scaling=DAQ.ai_scaling_coefficients)
+        self.flush_interval = flush_chunks * chunk_samples / \
+                              float(self.sampling_rate)
+        self.durability = durabilityPolicy(data_file, flush_policy)
+        self.telemetry = daqTelemetry(self.schedule)
+        self.boundary_list = []
+        if LED_arena is not None:
+            self.arena_pattern_list = self._arenaPatterns()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._reader_done = False
+
+    def run(self):
+        """Run the experiment to the end or until abort is set. Returns
+        (aborted, completed)"""
+        if self.LED_arena is not None:
+            self.LED_arena.stagePattern(*self.arena_pattern_list[0])
+        reader = threading.Thread(target=self._stage, name="readStimulus",
+                                  args=(self._readStimulus,))
+        writer = threading.Thread(target=self._stage, name="writeData",
+                                  args=(self._writeData,))
+        reader.daemon = True
+        writer.daemon = True
+        reader.start()
+        writer.start()
+        try:
+            self._acquire()
+        except Exception:
+            self._setError(sys.exc_info())
+        finally:
+            if not self._reader_done:
+                self._drainOutputQueue()
+            try:
+                n_samples_section = self.schedule.n_samples_section
+                self.DAQ.release(*self.DAQ.acquire(
+                    dataArray((n_samples_section, 2)),
+                    dataArray((n_samples_section, 2), digital=True)))
+                self.DAQ.stop()
+            except Exception:
+                self._setError(sys.exc_info())
+            self.inputQ.put(None)
+            writer.join()
+            reader.join()
+            self._saveWriteStatistics()
+            self.telemetry.save(self.experiment_ref)
+            if self.LED_arena is not None:
+                self._saveArenaBoundaries()
+            if self.live_tap is not None:
+                self.live_tap.close()
+        if self._error is not None:
+            exc_type, exc_value, exc_traceback = self._error
+            raise exc_type, exc_value, exc_traceback
+        self.aborted = self.abort.is_set()
+        return self.aborted, self.completed
+
+    def _acquire(self):
+        while True:
+            output_item = self.outputQ.get()
+            if output_item is None:
+                self._reader_done = True
+                self.completed = not self.abort.is_set()
+                return
+            if self.abort.is_set():
+                return
+            if output_item.new_protocol:
+                self._newProtocol(output_item)
+            input_item = inputItem(release=self.DAQ.release)
+            output_depth = self.outputQ.qsize()
+            input_depth = self.inputQ.qsize()
+            t0 = default_timer()
+            input_item.analog_in, input_item.digital_in = \
+                self.DAQ.acquire(output_item.analog_out,
+                                 output_item.digital_out)
+            t1 = default_timer()
+            if output_item.new_protocol and self.LED_arena is not None:
+                self._commitArenaPattern(output_item, t1)
+            self.telemetry.record(self.DAQ.ao_queued, self.DAQ.ai_backlog,
+                                  len(input_item.analog_in), t1 - t0,
+                                  output_depth, input_depth)
+            if len(input_item.analog_in) > 0:
+                if self.live_tap is not None:
+                    self.live_tap.publish(input_item.analog_in,
+                                          input_item.digital_in)
+                if self.inputQ.full():
+                    self.n_input_backpressure += 1
+                self.inputQ.put(input_item)
+            else:
+                input_item.release()
+
+    def _saveWriteStatistics(self):
+        attrs = self.experiment_ref.attrs
+        attrs["Writer: Flush Interval (s)"] = self.flush_interval
+        attrs["Writer: Chunk Samples"] = self.trial_writer.chunk_samples
+        attrs["Writer: Throughput (MB/s)"] = \
+            self.write_statistics.throughput()
+        attrs["Writer: p99 Write Latency (ms)"] = \
+            self.write_statistics.latencyPercentile(99)
+        attrs["Writer: Flush Policy"] = str(self.durability.policy)
+        print "Writer: %.1f MB/s, p99 write latency %.2f ms," % \
+            (self.write_statistics.throughput(),
+             self.write_statistics.latencyPercentile(99)),
+        print "%d file flushes, %.2f s" % (self.durability.n_flushes,
+                                          self.durability.flush_time)
+        spike_detector_time_list = self.trial_writer.spike_detector_time_list
+        if len(spike_detector_time_list) > 0:
+            attrs["Spike Detector: Max Section Time (ms)"] = \
+                1000 * max(spike_detector_time_list)
+            print "Online spike detection: max %.2f ms per section" % \
+                (1000 * max(spike_detector_time_list))
+
+    def _arenaPatterns(self):
+        """(mode, angular size) of every protocol in playback order, read
+        before the run so the DAQ stage never reads the file"""
+        pattern = {}
+        for name in set(self.schedule.protocol_list):
+            attrs = self.experiment_ref[name].attrs
+            pattern[name] = (str(attrs["Arena: Mode"]),
+                             int(attrs["Arena: Angular Size"]))
+        return [pattern[name] for name in self.schedule.protocol_list]
+
+    def _commitArenaPattern(self, output_item, write_time):
+        boundary_time = write_time + (self.DAQ.ao_queued -
+                                      len(output_item.analog_out) +
+                                      output_item.protocol_start) / \
+                                     float(self.sampling_rate)
+        command = self.LED_arena.commitPattern(at=boundary_time)
+        self.boundary_list.append((output_item.protocol_number, command))
+        next_protocol = output_item.protocol_number + 1
+        if next_protocol < len(self.arena_pattern_list):
+            self.LED_arena.stagePattern(
+                *self.arena_pattern_list[next_protocol])
+
+    def _saveArenaBoundaries(self):
+        """Experiment dataset "Arena Boundaries", one row per protocol
+        boundary: protocol number, its start in the schedule (s), delay in
+        sending the commit, commit round trip and boundary latency (ms)"""
+        self.LED_arena.wait()
+        boundary_array = np.zeros((len(self.boundary_list), 5))
+        for i, (protocol_number, command) in enumerate(self.boundary_list):
+            boundary_array[i, :2] = \
+                (protocol_number,
+                 self.schedule.protocol_start_time_list[protocol_number])
+            if command.status is None:
+                boundary_array[i, 2:] = np.nan
+            else:
+                send_delay = max(0.0, command.sent - command.due)
+                boundary_array[i, 2:] = (1000 * send_delay,
+                                         1000 * command.round_trip,
+                                         1000 * (send_delay +
+                                                 command.round_trip))
+        if "Arena Boundaries" in self.experiment_ref:
+            del self.experiment_ref["Arena Boundaries"]
+        dataset = self.experiment_ref.create_dataset("Arena Boundaries",
+                                                     data=boundary_array)
+        dataset.attrs["Columns"] = ["Protocol Number", "Protocol Start (s)",
+                                    "Send Delay (ms)", "Round Trip (ms)",
+                                    "Latency (ms)"]
+        latency = boundary_array[:, 4]
+        latency = latency[~np.isnan(latency)]
+        if len(latency) > 0:
+            attrs = self.experiment_ref.attrs
+            attrs["Arena: p99 Boundary Latency (ms)"] = \
+                np.percentile(latency, 99)
+            attrs["Arena: Max Boundary Latency (ms)"] = latency.max()
+            print "Arena: %d boundaries, latency p99 %.2f ms, max %.2f ms" % \
+                (len(latency), np.percentile(latency, 99), latency.max())
+
+    def _newProtocol(self, output_item):
+        print "\nDone", secondsToHMS(
+            (output_item.read_till - self.schedule.n_samples_section) /
+            self.sampling_rate),
+        print "of", secondsToHMS(self.experiment_duration)
+        print "Current Protocol:", output_item.protocol_name.split('/')[-1],
+        print "Duration:", output_item.protocol_duration
+
+    def _readStimulus(self):
+        try:
+            readStimulus(self.experiment_ref, self.schedule,
+                         _BackpressureQueue(self), self.abort)
+        finally:
+            self.outputQ.put(None)
+
+    def _writeData(self):
+        try:
+            writeData(self.experiment_ref, self.schedule, self.inputQ,
+                      self.trial_writer, durability=self.durability)
+        except Exception:
+            self._drainInputQueue()
+            raise
+
+    def _stage(self, target):
+        try:
+            target()
+        except Exception:
+            self._setError(sys.exc_info())
+
+    def _setError(self, exc_info):
+        with self._error_lock:
+            if self._error is None:
+                self._error = exc_info
+        self.abort.set()
+
+    def _drainOutputQueue(self):
+        """Discard stimulus sections until the reader's sentinel, unless
+        _acquire has already taken it"""
+        while self.outputQ.get() is not None:
+            pass
+        self._reader_done = True
+
+    def _drainInputQueue(self):
+        """Keep the DAQ stage from blocking once the writer has failed"""
+        while True:
+            input_item = self.inputQ.get()
+            if input_item is None:
+                return
+            input_item.release()
+
+class daqTelemetry:
+    """Buffer health of the DAQ stage, one row per section
+
+    Columns (column_list): samples queued in the AO buffer after the write,
+    samples left in the AI buffer after the read, samples read, acquire
+    wall time (s), outputQ and inputQ depths before the acquire. Rows are
+    preallocated for the whole schedule, so record never allocates.
+
+    A read shorter than a section after the output buffer has filled
+    (the first second) is a short read. Min AO queued is the margin
+    against an output underrun, max AI backlog against an input overflow,
+    both in ms of signal.
+    """
+    column_list = ["AO Queued", "AI Backlog", "Read", "Acquire Time (s)",
+                   "outputQ Depth", "inputQ Depth"]
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.data = np.zeros((schedule.n_sections, len(self.column_list)))
+        self.n_sections = 0
+        self.n_priming_sections = int(schedule.sampling_rate) // \
+                                  schedule.n_samples_section + 1
+
+    def record(self, ao_queued, ai_backlog, read, acquire_time,
+               output_depth, input_depth):
+        if self.n_sections < len(self.data):
+            self.data[self.n_sections] = (ao_queued, ai_backlog, read,
+                                          acquire_time, output_depth,
+                                          input_depth)
+            self.n_sections += 1
+
+    def summary(self, section_list=None):
+        """Attributes summarising the given sections (all by default)"""
+        data = self.data[:self.n_sections]
+        steady = np.arange(self.n_sections) >= self.n_priming_sections
+        if section_list is not None:
+            data = data[section_list]
+            steady = steady[section_list]
+        attrs = {"DAQ: Sections": len(data)}
+        if len(data) == 0:
+            return attrs
+        to_ms = 1000.0 / self.schedule.sampling_rate
+        ao_queued, ai_backlog, read, acquire_time, output_depth, \
+            input_depth = data.T
+        if steady.any():
+            attrs["DAQ: Min AO Queued (ms)"] = ao_queued[steady].min() * \
+                                               to_ms
+        attrs["DAQ: Max AI Backlog (ms)"] = ai_backlog.max() * to_ms
+        attrs["DAQ: Short Reads"] = int(np.count_nonzero(
+            steady & (read < self.schedule.n_samples_section)))
+        attrs["DAQ: p99 Acquire Time (ms)"] = \
+            1000 * np.percentile(acquire_time, 99)
+        attrs["DAQ: Max Acquire Time (ms)"] = 1000 * acquire_time.max()
+        attrs["DAQ: Min outputQ Depth"] = int(output_depth.min())
+        attrs["DAQ: Max inputQ Depth"] = int(input_depth.max())
+        return attrs
+
+    def save(self, experiment_ref):
+        """Save rows as experiment dataset "DAQ Telemetry" and summaries
+        as attributes of the experiment and of every protocol played"""
+        if "DAQ Telemetry" in experiment_ref:
+            del experiment_ref["DAQ Telemetry"]
+        dataset = experiment_ref.create_dataset(
+            "DAQ Telemetry", data=self.data[:self.n_sections])
+        dataset.attrs["Columns"] = self.column_list
+        dataset.attrs["Section Samples"] = self.schedule.n_samples_section
+        section_start = np.arange(self.n_sections, dtype=np.int64) * \
+                        self.schedule.n_samples_section
+        section_protocol = np.searchsorted(
+            self.schedule.trial_end_point_list, section_start,
+            side='right') - 1
+        protocol_section_list = {}
+        for protocol_number in np.unique(section_protocol):
+            protocol_ref = experiment_ref[
+                self.schedule.protocol_list[protocol_number]]
+            protocol_section_list.setdefault(protocol_ref.id, [
+                protocol_ref, np.zeros(self.n_sections, dtype=bool)])
+            protocol_section_list[protocol_ref.id][1] |= \
+                section_protocol == protocol_number
+        for protocol_ref, section_list in protocol_section_list.values():
+            for key, value in self.summary(section_list).items():
+                protocol_ref.attrs[key] = value
+        summary = self.summary()
+        for key, value in summary.items():
+            experiment_ref.attrs[key] = value
+        print "DAQ:", ", ".join(["%s %s" % (key[5:], _format(value))
+                                 for key, value in sorted(summary.items())])
+
+def _format(value):
+    if isinstance(value, float):
+        return "%.2f" % value
+    return str(value)
+
+class _BackpressureQueue:
+    """outputQ as seen by the reader stage, counting blocked puts"""
+    def __init__(self, engine):
+        self._engine = engine
+
+    def put(self, item):
+        if self._engine.outputQ.full():
+            self._engine.n_output_backpressure += 1
+        self._engine.outputQ.put(item)
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -4,6 +4,7 @@
 """
 import numpy as np
 import scipy.signal
+import scipy.fftpack
 from scipy.ndimage.filters import gaussian_filter1d
 
 def Filter(signal, f, f_pass='lowpass', poles=10, sampling_rate = 10000):
@@ -11,7 +12,8 @@ def Filter(signal, f, f_pass='lowpass', poles=10, sampling_rate = 10000):
     b, a = scipy.signal.butter(poles, normalized_f, btype=f_pass, analog=False)
     return scipy.signal.filtfilt(b, a, signal)
 
-def GetSpikePositionList(signal):
+def GetSpikePositionList(signal, sampling_rate=10000):
+    window = max(1, int(round(0.001 * sampling_rate)))
     noise_level = np.std(signal)
     max_point = np.max(signal)
     threshold = (max_point + (np.mean(signal) + noise_level)) / 2
@@ -19,9 +21,9 @@ def GetSpikePositionList(signal):
     tentative_spike_position_list = 1 + np.argwhere(spike)
     spike_position_list = np.zeros(len(tentative_spike_position_list))
     for i in range(len(tentative_spike_position_list)):
-        spike_position_list[i] = (tentative_spike_position_list[i] - (10 - 
+        spike_position_list[i] = (tentative_spike_position_list[i] - (window - 
             _GetSpikeInitiationPoint(signal[tentative_spike_position_list[i] - 
-                10:tentative_spike_position_list[i]], noise_level)))
+                window:tentative_spike_position_list[i]], noise_level)))
     return spike_position_list
 
 def _GetSpikeInitiationPoint(signal_section, noise_level):
@@ -31,6 +33,195 @@ def _GetSpikeInitiationPoint(signal_section, noise_level):
     else:
         return temp[-1]
 
+class OnlineSpikeDetector:
+    """Causal, section by section counterpart of Filter + GetSpikePositionList
+
+    The signal is high-pass filtered (Butterworth, as in AnalyzeTrial) with
+    the filter state carried from section to section. The threshold is
+    threshold_sd times a running noise estimate: the median absolute
+    deviation of each section, averaged exponentially over noise_time
+    seconds. A spike is an upward threshold crossing at least dead_time
+    after the previous one, placed at its initiation point as in
+    GetSpikePositionList. Work per section is proportional to its length.
+    """
+    def __init__(self, sampling_rate=10000, f=50, poles=3, threshold_sd=5.0,
+                 noise_time=1.0, dead_time=0.002):
+        self.sampling_rate = sampling_rate
+        self.sos = scipy.signal.butter(poles, f / (0.5 * sampling_rate),
+                                       btype='highpass', output='sos')
+        self.threshold_sd = threshold_sd
+        self.noise_samples = noise_time * sampling_rate
+        self.dead_time = int(round(dead_time * sampling_rate))
+        self.window = max(1, int(round(0.001 * sampling_rate)))
+        self.reset()
+
+    def reset(self):
+        self.noise_level = None
+        self.threshold = None
+        self._zi = None
+        self._tail = np.zeros(0)
+        self._above = False
+        self._since_spike = self.dead_time
+
+    def process(self, signal):
+        """Spike positions in signal, relative to its first sample. A spike
+        crossing early in signal may start up to 1 ms before it."""
+        if len(signal) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self._zi is None:
+            self._zi = scipy.signal.sosfilt_zi(self.sos) * signal[0]
+        filtered, self._zi = scipy.signal.sosfilt(self.sos, signal,
+                                                  zi=self._zi)
+        section_noise = np.median(np.abs(filtered)) / 0.6745
+        if self.noise_level is None:
+            self.noise_level = section_noise
+        else:
+            self.noise_level += min(1.0, len(signal) / self.noise_samples) * \
+                                (section_noise - self.noise_level)
+        self.threshold = self.threshold_sd * self.noise_level
+        above = filtered > self.threshold
+        previous = np.concatenate(([self._above], above[:-1]))
+        crossing_list = np.flatnonzero(above & ~previous)
+        history = np.concatenate((self._tail, filtered))
+        n_tail = len(self._tail)
+        spike_position_list = []
+        last_spike = -self._since_spike
+        for crossing in crossing_list:
+            if crossing - last_spike < self.dead_time:
+                continue
+            last_spike = crossing
+            window_start = max(0, n_tail + crossing - self.window)
+            signal_section = history[window_start:n_tail + crossing]
+            if len(signal_section) == 0:
+                spike_position_list.append(crossing)
+                continue
+            spike_position_list.append(crossing - (len(signal_section) -
+                _GetSpikeInitiationPoint(signal_section, self.noise_level)))
+        self._since_spike = len(signal) - last_spike
+        self._above = above[-1]
+        self._tail = history[-self.window:]
+        return np.array(spike_position_list, dtype=np.int64)
+
+def FallingEdgeList(line):
+    line = np.asarray(line) != 0
+    return 1 + np.flatnonzero(line[:-1] & ~line[1:])
+
+def RisingEdgeList(line):
+    line = np.asarray(line) != 0
+    return 1 + np.flatnonzero(~line[:-1] & line[1:])
+
+def ArenaStepTiming(step_command, loopback, stcp, sampling_rate=10000,
+                    max_offset=0.005, max_latency=0.005, offset=0):
+    """Align arena step commands (Digital Out line 1) with their loopback
+    (Digital In line 2) and the arena's STCP latch (Digital In line 3)
+
+    Every falling edge of step_command is a step. It is matched to the
+    nearest loopback falling edge within max_offset s of where offset (the
+    Digital In offset in samples, see DigitalInOffset) puts it; the
+    difference from the command is the offset of Digital In, not a delay of
+    the arena. The arena shows the step
+    at the first rising edge of STCP (the latch) after the loopback edge. A
+    step without a loopback edge, or without a latch within max_latency s
+    and before the next step, is dropped. Steps too close to the end of the
+    recording to be seen on Digital In are left out.
+
+    Returns one row per step: command sample, loopback offset (samples),
+    latency (s, loopback edge to latch, both on the Digital In clock),
+    dropped (1 / 0). Latency is nan for dropped steps, offset too if the
+    step has no loopback edge.
+    """
+    command = FallingEdgeList(step_command)
+    loopback_edge = FallingEdgeList(loopback)
+    latch = RisingEdgeList(stcp)
+    timing = np.zeros((len(command), 4))
+    timing[:, 0] = command
+    timing[:, 1:3] = np.nan
+    timing[:, 3] = 1
+    if len(command) == 0 or len(loopback_edge) == 0:
+        return timing
+    expected = command + int(offset)
+    after = np.searchsorted(loopback_edge, expected)
+    before = np.clip(after - 1, 0, len(loopback_edge) - 1)
+    after = np.clip(after, 0, len(loopback_edge) - 1)
+    nearest = np.where(np.abs(loopback_edge[before] - expected) <=
+                       np.abs(loopback_edge[after] - expected), before, after)
+    step_edge = loopback_edge[nearest]
+    loopback_offset = step_edge - command
+    matched = np.abs(step_edge - expected) <= max_offset * sampling_rate
+    if not matched.any():
+        return timing
+    observable = command + np.median(loopback_offset[matched]) + \
+                 max_latency * sampling_rate < len(loopback)
+    next_step_edge = np.append(step_edge[1:], np.iinfo(np.int64).max)
+    latch_number = np.minimum(np.searchsorted(latch, step_edge),
+                              len(latch) - 1)
+    if len(latch) > 0:
+        latch_at = latch[latch_number]
+    else:
+        latch_at = np.zeros(len(step_edge), dtype=np.int64) - 1
+    latency = latch_at - step_edge
+    shown = matched & (latency >= 0) & \
+            (latency <= max_latency * sampling_rate) & \
+            (latch_at < next_step_edge)
+    timing[matched, 1] = loopback_offset[matched]
+    timing[shown, 2] = latency[shown] / float(sampling_rate)
+    timing[:, 3] = ~shown
+    return timing[observable]
+
+def DigitalInOffset(step_command, loopback, max_offset=None):
+    """Samples by which loopback (Digital In line 2) lags step_command
+    (Digital Out line 1), from the peak of their cross-correlation computed
+    with one real FFT of each; only lags within +-max_offset are considered
+    if given. None if either line never changes."""
+    step_command = np.asarray(step_command, dtype=np.float64)
+    loopback = np.asarray(loopback, dtype=np.float64)
+    if np.ptp(step_command) == 0 or np.ptp(loopback) == 0:
+        return None
+    size = scipy.fftpack.next_fast_len(len(step_command) + len(loopback) - 1)
+    correlation = np.fft.irfft(np.fft.rfft(loopback - loopback.mean(), size) *
+                               np.conj(np.fft.rfft(step_command -
+                                                   step_command.mean(),
+                                                   size)), size)
+    lag = np.arange(size)
+    lag[len(loopback):] -= size
+    valid = lag > -len(step_command)
+    if max_offset is not None:
+        valid &= np.abs(lag) <= max_offset
+    return int(lag[valid][np.argmax(correlation[valid])])
+
+def AlignSamples(signal, offset):
+    """signal moved offset samples earlier (later if negative), repeating
+    the edge samples"""
+    offset = int(offset)
+    if offset == 0 or abs(offset) >= len(signal):
+        return signal
+    aligned = np.empty_like(signal)
+    if offset > 0:
+        aligned[:-offset] = signal[offset:]
+        aligned[-offset:] = signal[-1]
+    else:
+        aligned[-offset:] = signal[:offset]
+        aligned[:-offset] = signal[0]
+    return aligned
+
+def ArenaTimingSummary(timing):
+    """Attributes summarising ArenaStepTiming rows"""
+    shown = timing[:, 3] == 0
+    summary = {"Arena Timing: Steps": len(timing),
+               "Arena Timing: Dropped Steps": int(len(timing) -
+                                                  np.count_nonzero(shown))}
+    if shown.any():
+        offset = timing[shown, 1]
+        latency = 1000 * timing[shown, 2]
+        summary["Arena Timing: Loopback Offset (samples)"] = \
+            float(np.median(offset))
+        summary["Arena Timing: Mean Latency (ms)"] = latency.mean()
+        summary["Arena Timing: Jitter (ms)"] = latency.std()
+        summary["Arena Timing: p99 Latency (ms)"] = np.percentile(latency,
+                                                                  99)
+        summary["Arena Timing: Max Latency (ms)"] = latency.max()
+    return summary
+
 def SpikePositionListListToPreGCFR(spike_position_list_list, length):
     pre_GCFR = np.zeros(length)
     for spike_position_list in spike_position_list_list:
@@ -67,9 +258,21 @@ def __VtoD__(v):
 
 hallEffectSensorToDisplacement = np.vectorize(__VtoD__, otypes=[np.float])
 
+def AntennalMovement(hall_effect_sensor_reading, sampling_rate=10000):
+    """Antennal displacement from the hall effect sensor, low-pass filtered
+    and relative to its mean over the first 0.5 s"""
+    antennal_movement = hallEffectSensorToDisplacement(
+        hall_effect_sensor_reading)
+    antennal_movement = Filter(antennal_movement, 500,
+                               sampling_rate=sampling_rate)
+    return antennal_movement - \
+        np.mean(antennal_movement[:int(0.5 * sampling_rate)])
+
 def mec_hallEffectSensorToDisplacementAmplitude(mec_hall_effect_sensor_reading,
-                                                mec_parameters=[4, 5, 4, 0, 120, 0.4]):
-    global sampling_rate
+                                                mec_parameters=[4, 5, 4, 0, 120, 0.4],
+                                                sampling_rate=10000):
+    from .stimulus import _chirp
+    nyquist = 0.5 * sampling_rate
     pre_stimulus_delay = mec_parameters[0]
     stimulus_duration = mec_parameters[1]
     post_stimulus_delay = mec_parameters[2]
@@ -85,19 +288,20 @@ def mec_hallEffectSensorToDisplacementAmplitude(mec_hall_effect_sensor_reading,
     amplitude = mec_parameters[5]
     antenna_displacement = antenna_displacement - antenna_displacement[0]
     antenna_displacement = antenna_displacement[
-        pre_stimulus_delay * sampling_rate:
-        (pre_stimulus_delay + stimulus_duration) * sampling_rate]
+        int(pre_stimulus_delay * sampling_rate):
+        int((pre_stimulus_delay + stimulus_duration) * sampling_rate)]
     if frequency_0 > frequency_1:
         f_cut=frequency_0
     else:
         f_cut=frequency_1    
-    b, a = scipy.signal.butter(10, (f_cut * 4.0) / 5000, btype='low', analog=False)
+    b, a = scipy.signal.butter(10, (f_cut * 4.0) / nyquist, btype='low', analog=False)
     antenna_displacement = scipy.signal.filtfilt(b, a, antenna_displacement)    
-    b, a = scipy.signal.butter(3, 0.2 / 5000, btype='high', analog=False)
+    b, a = scipy.signal.butter(3, 0.2 / nyquist, btype='high', analog=False)
     antenna_displacement = scipy.signal.filtfilt(b, a, antenna_displacement)    
-    chirp = stimulus._chirp(stimulus_duration,
-                        frequency_0=frequency_0,
-                        frequency_1=frequency_1)
+    chirp = _chirp(stimulus_duration,
+                   frequency_0=frequency_0,
+                   frequency_1=frequency_1,
+                   sampling_rate=sampling_rate)
     t = chirp > 0
     t = np.diff(t)
     t = np.nonzero(t)
@@ -108,7 +312,7 @@ def mec_hallEffectSensorToDisplacementAmplitude(mec_hall_effect_sensor_reading,
     #pg.plot(antenna_displacement)
     for current_point in wave_end_point_list[1:]:
         wave = antenna_displacement[previous_point:current_point]
-        frequency = 10000.0 / (current_point - previous_point)
+        frequency = float(sampling_rate) / (current_point - previous_point)
         current_wave_amplitude = np.max(wave) - np.min(wave)
         if frequency in amplitude_dict:
             amplitude_dict[frequency].append(current_wave_amplitude)
@@ -125,8 +329,8 @@ def mec_hallEffectSensorToDisplacementAmplitude(mec_hall_effect_sensor_reading,
     b, a = scipy.signal.butter(10, 0.2, btype='low', analog=False)
     amplitude_list = scipy.signal.filtfilt(b, a, amplitude_list)
     #pg.plot(amplitude_list, title="amplitude_list")
-    t = np.linspace(0, frequency_1, (stimulus_duration * sampling_rate) + 1)
-    t = t[:stimulus_duration * sampling_rate]
+    t = np.linspace(0, frequency_1, int(stimulus_duration * sampling_rate) + 1)
+    t = t[:int(stimulus_duration * sampling_rate)]
     print mec_parameters
     ##print amplitude_list
     amplitude_list = np.interp(t, frequency_list, amplitude_list) / 2
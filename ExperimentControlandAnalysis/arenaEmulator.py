@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Stand-in for the arena's Teensy (1D LED controller/arenaController) on a
+pseudo terminal, to run LEDarena.arena without hardware. POSIX only.
+
+    emulator = teensyEmulator()
+    LED_arena = LEDarena.arena(emulator.port)
+"""
+
+from .experimentCommon import os, threading, time
+from .arenaPattern import ledState, stepDirection
+import pty
+import tty
+import select
+
+GET_COMMAND = 0xcc
+SET_BRIGHTNESS = 0x01
+SET_PATTERN = 0x02
+STAGE_PATTERN = 0x03
+COMMIT_PATTERN = 0x04
+ACKNOWLEDGE = 0xac
+ACK_OK = 0x00
+ACK_UNKNOWN_COMMAND = 0x01
+ACK_TIMEOUT = 0x02
+ACK_NOTHING_STAGED = 0x03
+serial_timeout = 0.01
+
+class teensyEmulator:
+    """Speaks the firmware's serial protocol on the slave end of a pty
+
+    port is the device to open with LEDarena.arena. Commands update
+    brightness, pattern_type and pattern_size (and reset offset) as the
+    firmware does and are acknowledged after latency seconds; with
+    acknowledge=False it behaves like firmware from before acknowledgements,
+    with staging=False like firmware without STAGE / COMMIT_PATTERN.
+    command_list records (time, command, arguments) of every command.
+    step() stands in for a falling edge on the step input; leds is what
+    the arena shows.
+    """
+    def __init__(self, latency=0.0, acknowledge=True, staging=True):
+        self.latency = latency
+        self.acknowledge = acknowledge
+        self.staging = staging
+        self.staged = None
+        self.brightness = 65520
+        self.pattern_type = 0
+        self.pattern_size = 10
+        self.offset = 0
+        self.command_list = []
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._pending = bytearray()
+        self._running = True
+        self._worker = threading.Thread(target=self._run,
+                                        name="teensyEmulator")
+        self._worker.daemon = True
+        self._worker.start()
+        os.write(self._master, "Ready\n\n")
+
+    def step(self):
+        self.offset += stepDirection(self.pattern_type)
+
+    @property
+    def leds(self):
+        return ledState(self.pattern_type, self.pattern_size, self.offset)[0]
+
+    def close(self):
+        self._running = False
+        self._worker.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        while self._running:
+            if self._readByte(0.05) == GET_COMMAND:
+                self._command()
+
+    def _readByte(self, timeout=serial_timeout):
+        """Next byte from the host, None on timeout"""
+        if len(self._pending) == 0:
+            ready, _, _ = select.select([self._master], [], [], timeout)
+            if not ready:
+                return None
+            try:
+                self._pending.extend(os.read(self._master, 1024))
+            except OSError:
+                return None
+        return self._pending.pop(0)
+
+    def _readUInt16(self):
+        low = self._readByte()
+        high = self._readByte()
+        if low is None or high is None:
+            return None
+        return low | (high << 8)
+
+    def _command(self):
+        command = self._readByte()
+        status = ACK_OK
+        if command == SET_BRIGHTNESS:
+            argument_list = [self._readUInt16()]
+            if None not in argument_list:
+                self.brightness = argument_list[0]
+        elif command == SET_PATTERN:
+            argument_list = [self._readUInt16(), self._readUInt16()]
+            if None not in argument_list:
+                self.pattern_type, self.pattern_size = argument_list
+                self.offset = 0
+        elif command == STAGE_PATTERN and self.staging:
+            argument_list = [self._readUInt16(), self._readUInt16()]
+            if None not in argument_list:
+                self.staged = argument_list
+        elif command == COMMIT_PATTERN and self.staging:
+            argument_list = []
+            if self.staged is None:
+                status = ACK_NOTHING_STAGED
+            else:
+                self.pattern_type, self.pattern_size = self.staged
+                self.offset = 0
+                self.staged = None
+        else:
+            argument_list = []
+            status = ACK_UNKNOWN_COMMAND
+        if None in argument_list or command is None:
+            status = ACK_TIMEOUT
+        self.command_list.append((time.time(), command, argument_list))
+        if self.acknowledge:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            os.write(self._master, str(bytearray([GET_COMMAND, ACKNOWLEDGE,
+                                                  command or 0, status])))
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Requirements : numpy
+
+What the 1D LED arena shows, computed as the firmware does it
+(1D LED controller/arenaController, setPattern and nextInSequence), for
+all steps of a protocol at once.
+
+LED i is bit i % 8 of pattern byte i / 8, as shifted out to the arena. The
+firmware resets the step offset to 0 when a pattern is sent (at every
+protocol start) and moves it by one on every falling edge of its step input,
+Digital Out line 1: up for forward, clockwise and both spot modes, down for
+backward and counterclockwise. Offsets follow C integer arithmetic, so
+negative offsets behave as on the Teensy.
+
+Displacement is how far the pattern has moved, in LEDs, towards higher LED
+numbers (on LEDs 0-159 for forward / backward, which are mirrored on LEDs
+160-319).
+"""
+
+import numpy as np
+
+n_leds = 320
+mode_list = ["forward", "backward", "clockwise", "counterclockwise",
+             "spot clockwise", "spot counterclockwise"]
+
+def patternType(mode):
+    if isinstance(mode, basestring):
+        return mode_list.index(mode)
+    return int(mode)
+
+def stepDirection(pattern_type):
+    """Offset change per step, as nextInSequence"""
+    if pattern_type in [1, 3]:
+        return -1
+    return 1
+
+def ledState(pattern_type, pattern_size, offset):
+    """Lit LEDs, one row of n_leds for each offset, as setPattern"""
+    offset = np.atleast_1d(np.asarray(offset, dtype=np.int64))[:, None]
+    pattern_size = int(pattern_size)
+    half = pattern_size // 2
+    if pattern_type in [0, 1]:
+        i = np.arange(n_leds // 2)
+        lit = np.fmod(i + np.fmod(offset, pattern_size), pattern_size) < half
+        return np.hstack((lit, lit[:, ::-1]))
+    if pattern_type in [2, 3]:
+        i = np.arange(n_leds)
+        return np.fmod(i + np.fmod(offset, pattern_size),
+                       pattern_size) < half
+    if pattern_type in [4, 5]:
+        i = np.arange(n_leds)
+        if pattern_type == 4:
+            i = n_leds - 1 - i
+        spot = i - np.fmod(offset, n_leds)
+        return (spot >= 0) & (spot < half)
+    if pattern_type < 0:
+        return np.zeros((len(offset), n_leds), dtype=bool)
+    return np.ones((len(offset), n_leds), dtype=bool)
+
+def stepCount(step_line, previous=0):
+    """Steps taken up to every sample: running count of falling edges"""
+    step_line = np.asarray(step_line)
+    falling_edge = np.empty(len(step_line), dtype=bool)
+    falling_edge[0] = previous and not step_line[0]
+    falling_edge[1:] = (step_line[:-1] != 0) & (step_line[1:] == 0)
+    return np.cumsum(falling_edge)
+
+class protocolArena:
+    """Arena state over one protocol
+
+    step_count    - steps taken, per sample
+    step_position - sample of every step
+    offset        - firmware offset after 0, 1, ... steps
+    led_state     - lit LEDs after 0, 1, ... steps; ledsAt(sample) per sample
+    displacement  - LEDs moved, per sample
+    velocity      - LEDs/s per sample, from the time between the steps
+                    around it; 0 before the first step and after the last
+    """
+    def __init__(self, digital_out, mode="forward", angular_size=10,
+                 sampling_rate=10000, step_line=1):
+        digital_out = np.asarray(digital_out)
+        if digital_out.ndim > 1:
+            digital_out = digital_out[:, step_line]
+        self.pattern_type = patternType(mode)
+        self.pattern_size = int(angular_size)
+        self.sampling_rate = sampling_rate
+        self.step_count = stepCount(digital_out)
+        self.step_position = np.flatnonzero(np.diff(np.concatenate(
+            ([0], self.step_count))))
+        n_steps = len(self.step_position)
+        direction = stepDirection(self.pattern_type)
+        self.offset = direction * np.arange(n_steps + 1, dtype=np.int64)
+        self.led_state = ledState(self.pattern_type, self.pattern_size,
+                                  self.offset)
+        if self.pattern_type in range(len(mode_list)):
+            if self.pattern_type == 5:
+                sign = 1
+            else:
+                sign = -direction
+        else:
+            sign = 0
+        self.displacement = sign * self.step_count
+        self.velocity = np.zeros(len(self.step_count))
+        if n_steps > 1 and sign != 0:
+            step_velocity = sign * float(sampling_rate) / \
+                            np.diff(self.step_position)
+            interval_number = self.step_count - 1
+            during = (interval_number >= 0) & (interval_number < n_steps - 1)
+            self.velocity[during] = step_velocity[interval_number[during]]
+
+    @classmethod
+    def fromProtocol(cls, protocol_ref):
+        """From a protocol group of a data file"""
+        from .dataFileHandling import GetSamplingRate, GetProtocolOutput
+        return cls(GetProtocolOutput(protocol_ref)[1],
+                   mode=protocol_ref.attrs['Arena: Mode'],
+                   angular_size=protocol_ref.attrs['Arena: Angular Size'],
+                   sampling_rate=GetSamplingRate(protocol_ref))
+
+    def ledsAt(self, sample):
+        """Lit LEDs at sample (an index or index array)"""
+        return self.led_state[self.step_count[sample]]
+
+    def stepsPerSecond(self):
+        if len(self.step_position) < 2:
+            return 0.0
+        return float(self.sampling_rate) / np.mean(np.diff(
+            self.step_position))
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -5,17 +5,130 @@
 
 from .common import np
 import h5py
+from .experimentCommon import stimulus_dataset_list, scaleAnalogIn
 from .analysis import Filter, \
                       GetSpikePositionList, \
                       SpikePositionListListToPreGCFR, \
                       SpikePositionListListToArray, \
-                      hallEffectSensorToDisplacement
+                      AntennalMovement, \
+                      ArenaStepTiming, \
+                      ArenaTimingSummary, \
+                      DigitalInOffset, \
+                      AlignSamples
+
+def GetSamplingRate(group, default=10000):
+    """Sampling rate stored on group or its nearest parent. Files from
+    before it was stored were all recorded at 10 kS/s."""
+    while True:
+        if 'Sampling Rate' in group.attrs:
+            return group.attrs['Sampling Rate']
+        if group.name == '/':
+            return default
+        group = group.parent
+
+def GetProtocolOutput(protocol):
+    """Analog Out and Digital Out of a protocol group, synthesized for
+    protocols stored without them (see stimulus.synthesizeProtocol)"""
+    from .stimulus import synthesizeProtocol
+    return synthesizeProtocol(protocol)
+
+def GetDigitalInOffset(group):
+    """Digital In offset (samples) stored on group or its nearest parent
+    by AlignDigitalIn, None if it was not estimated"""
+    while True:
+        if 'Digital In Offset (samples)' in group.attrs:
+            return group.attrs['Digital In Offset (samples)']
+        if group.name == '/':
+            return None
+        group = group.parent
+
+def AlignDigitalIn(data_file_name, per_trial=False, reestimate=False):
+    """Estimate by how many samples Digital In lags Digital Out (the DI
+    task has no start trigger) from the loopback of the arena step line,
+    and store it as 'Digital In Offset (samples)', on every experiment
+    (from its first trial with steps) or with per_trial on every trial.
+    Trial.GetDigitalIn applies it; the stored data is left as recorded.
+    Returns {group name: offset}."""
+    offset_dict = {}
+    with h5py.File(data_file_name, 'a') as data_file:
+        for experiment_name in GetSubGroupList(data_file):
+            experiment = data_file[experiment_name]
+            if not per_trial and not reestimate and \
+               'Digital In Offset (samples)' in experiment.attrs:
+                offset_dict[experiment.name] = \
+                    experiment.attrs['Digital In Offset (samples)']
+                continue
+            for trial, digital_out in _TrialsWithDigitalIn(experiment):
+                if per_trial and not reestimate and \
+                   'Digital In Offset (samples)' in trial.attrs:
+                    offset_dict[trial.name] = \
+                        trial.attrs['Digital In Offset (samples)']
+                    continue
+                digital_in = trial['Digital In']
+                offset = DigitalInOffset(
+                    digital_out[:len(digital_in), 1],
+                    digital_in[:, 0],
+                    max_offset=GetSamplingRate(trial))
+                if offset is None:
+                    continue
+                if per_trial:
+                    trial.attrs['Digital In Offset (samples)'] = offset
+                    offset_dict[trial.name] = offset
+                else:
+                    experiment.attrs['Digital In Offset (samples)'] = offset
+                    offset_dict[experiment.name] = offset
+                    break
+    return offset_dict
+
+def _TrialsWithDigitalIn(experiment):
+    """Trials with Digital In, with the Digital Out of their protocol"""
+    for protocol_name in GetSubGroupList(experiment):
+        protocol = experiment[protocol_name]
+        if 'Number of Samples' not in protocol.attrs:
+            continue
+        digital_out = None
+        for trial_name in GetSubGroupList(protocol):
+            if 'Digital In' in protocol[trial_name]:
+                if digital_out is None:
+                    digital_out = GetProtocolOutput(protocol)[1]
+                yield protocol[trial_name], digital_out
+
+class AnalogIn:
+    """Analog In dataset of a trial, in volts
+
+    Indexing reads only the selected samples and channels, as with the
+    dataset. Raw int16 ADC codes (recorded with raw_ai) are scaled by the
+    dataset's 'Scaling Coefficients', and samples never written (the
+    dataset's fill code) read as NaN, as they do in float64 recordings,
+    which are returned as stored. The fill code is the ADC's negative
+    full scale code, so samples clipped there read as NaN too.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self.shape = dataset.shape
+        self.coefficients = dataset.attrs.get('Scaling Coefficients')
+        self.fill_code = dataset.fillvalue
+
+    def __getitem__(self, key):
+        data = self._dataset[key]
+        if self.coefficients is None:
+            return data
+        if not isinstance(key, tuple) or len(key) < 2:
+            channel_key = slice(None)
+        else:
+            channel_key = key[1]
+        return np.where(data == self.fill_code, np.nan,
+                        scaleAnalogIn(data, self.coefficients[channel_key]))
+
+    @property
+    def value(self):
+        return self[...]
 
 def GetSubGroupList(group):
     sub_group_list =  [sub_group for sub_group in group]
     for sub_group in ['cooldown', 'dye', 'warmup', 
-                      'Analog Out', 'Digital Out',
-                      'Processed Data']:
+                      'Processed Data', 'DAQ Telemetry',
+                      'Arena Boundaries'] + stimulus_dataset_list:
         while sub_group in sub_group_list:
             sub_group_list.remove(sub_group)
     for sub_group in sub_group_list:
@@ -49,6 +162,15 @@ class NeuronData:
         
     def close(self):
         self._file_handle.close()
+
+    def AnalyzeArenaTiming(self, reanalyze=False):
+        """Arena step timing of every experiment (see
+        Experiment.AnalyzeArenaTiming); stored only if the file was opened
+        for writing"""
+        return dict((experiment_name,
+                     experiment.AnalyzeArenaTiming(reanalyze=reanalyze))
+                    for experiment_name, experiment in
+                    self.experiment.items())
     
     def GetExperimentList(self):
         return GetSubGroupList(self._file_handle)
@@ -72,6 +194,13 @@ class Experiment:
 
     def GetProtocolList(self):
         return GetSubGroupList(self._experiment)
+
+    def AnalyzeArenaTiming(self, reanalyze=False):
+        """{protocol name: arena step timing summary} (see
+        Protocol.AnalyzeArenaTiming)"""
+        return dict((protocol_name,
+                     protocol.AnalyzeArenaTiming(reanalyze=reanalyze))
+                    for protocol_name, protocol in self.protocol.items())
     
     def PopulateProtocols(self, reanalyze=False):
         print(" Populating Protocols, reanalyze= " + str(reanalyze))
@@ -87,10 +216,12 @@ class Protocol:
     def __init__(self, protocol, reanalyze=False):
         self._protocol = protocol
         self.name = self._protocol.name
-        self.speaker_out = protocol['Analog Out'].value[:,1]
-        self.arena_out = protocol['Digital Out'].value[:,1]
+        analog_out, digital_out = GetProtocolOutput(protocol)
+        self.speaker_out = analog_out[:,1]
+        self.arena_out = digital_out[:,1]
         self.trial_list = self.GetCompletedTrials()
         self.n_samples = self._protocol.attrs['Number of Samples']
+        self.sampling_rate = GetSamplingRate(self._protocol)
         self.PopulateTrials(reanalyze=reanalyze)
         self.AnalyzeProtocol(reanalyze=reanalyze)
 
@@ -113,6 +244,18 @@ class Protocol:
                 Trial(self._protocol[trial_name],
                       reanalyze=reanalyze)})
     
+    def GetOnlineRaster(self):
+        """Raster of spikes detected during acquisition, one row per
+        completed trial (padded with -1), without analysing the trials"""
+        spike_position_list_list = []
+        for trial_name in self.trial_list:
+            trial = self._protocol[trial_name]
+            if 'Online Spike Position List' not in trial:
+                return None
+            spike_position_list_list.append(
+                trial['Online Spike Position List'].value)
+        return SpikePositionListListToArray(spike_position_list_list)
+
     def AnalyzeProtocol(self, reanalyze=False):
         if len(self.trial_list) == 0:
             return
@@ -166,11 +309,46 @@ class Protocol:
                processed_data['Raster data'],\
                processed_data['pre-GCFR']
 
+    def AnalyzeArenaTiming(self, reanalyze=False):
+        """Arena step timing of all completed trials, summarised on
+        Processed Data of the protocol; None without Digital In"""
+        if len(self.trial_list) == 0 or \
+           'Processed Data' not in self._protocol:
+            return None
+        processed_data = self._protocol['Processed Data']
+        if not reanalyze and \
+           'Arena Timing: Steps' in processed_data.attrs:
+            return dict(processed_data.attrs.items())
+        timing_list = [self.trial[trial_name].AnalyzeArenaTiming(
+                           reanalyze=reanalyze)
+                       for trial_name in self.trial_list]
+        if any(timing is None for timing in timing_list):
+            return None
+        summary = ArenaTimingSummary(np.vstack(timing_list))
+        if self._protocol.file.mode != 'r':
+            for key, value in summary.items():
+                processed_data.attrs[key] = value
+        return summary
+
 class Trial:
     def __init__(self, trial, reanalyze=False):
         self._trial = trial
         self.name = self._trial.name
+        self.sampling_rate = GetSamplingRate(self._trial)
         self.AnalyzeTrial(reanalyze=reanalyze)
+
+    def GetAnalogIn(self):
+        """Analog In of the trial in volts (an AnalogIn)"""
+        return AnalogIn(self._trial['Analog In'])
+
+    def GetDigitalIn(self, aligned=True):
+        """Digital In of the trial, shifted by the offset stored by
+        AlignDigitalIn if aligned (as recorded if none was stored)"""
+        digital_in = self._trial['Digital In'].value
+        offset = GetDigitalInOffset(self._trial)
+        if aligned and offset is not None:
+            return AlignSamples(digital_in, offset)
+        return digital_in
         
     def AnalyzeTrial(self, reanalyze=False):
         if 'Processed Data' in self._trial:
@@ -182,16 +360,16 @@ class Trial:
                        self._trial['Processed Data']['Antennal Movement']
         print("    Analyzing trial " + self.name)
         self._trial.create_group('Processed Data')
-        trial_analog_in = self._trial['Analog In'].value
+        trial_analog_in = self.GetAnalogIn().value
         membrane_potential = trial_analog_in[:,0]
-        antennal_movement = hallEffectSensorToDisplacement(trial_analog_in[:,2])
         membrane_potential = Filter(membrane_potential, 50, 
-                                    f_pass='highpass', poles=3)
+                                    f_pass='highpass', poles=3,
+                                    sampling_rate=self.sampling_rate)
         membrane_potential = membrane_potential - membrane_potential[0]
-        antennal_movement = Filter(antennal_movement, 500)
-        antennal_movement = antennal_movement - \
-                            np.mean(antennal_movement[:5000])
-        spike_position_list = GetSpikePositionList(membrane_potential)
+        antennal_movement = AntennalMovement(trial_analog_in[:,2],
+                                             sampling_rate=self.sampling_rate)
+        spike_position_list = GetSpikePositionList(membrane_potential,
+            sampling_rate=self.sampling_rate)
         processed_data = self._trial['Processed Data']
         if "Membrane Potential" in processed_data:
             processed_data["Membrane Potential"][:] = membrane_potential
@@ -212,3 +390,43 @@ class Trial:
                                       fletcher32=True)
         self._trial.file.flush()
         return membrane_potential, spike_position_list, antennal_movement
+
+    def AnalyzeArenaTiming(self, reanalyze=False):
+        """Per step timing of the arena (see analysis.ArenaStepTiming)
+        from the Digital Out step line of the protocol and the recorded
+        loopback (Digital In line 2) and STCP (line 3); stored as Processed
+        Data/Arena Step Timing unless the file is read only. Steps are
+        matched around the Digital In offset stored by AlignDigitalIn, or
+        estimated for the trial if none was stored. None for trials
+        recorded without Digital In."""
+        if 'Digital In' not in self._trial:
+            return None
+        processed_data = self._trial.require_group('Processed Data') \
+            if self._trial.file.mode != 'r' else \
+            self._trial.get('Processed Data', {})
+        if 'Arena Step Timing' in processed_data:
+            if reanalyze:
+                del processed_data['Arena Step Timing']
+            else:
+                return processed_data['Arena Step Timing'].value
+        digital_in = self._trial['Digital In'].value
+        step_command = GetProtocolOutput(self._trial.parent)[1][:, 1]
+        offset = GetDigitalInOffset(self._trial)
+        if offset is None:
+            offset = DigitalInOffset(step_command[:len(digital_in)],
+                                     digital_in[:, 0],
+                                     max_offset=self.sampling_rate) or 0
+        timing = ArenaStepTiming(step_command,
+                                 digital_in[:, 0], digital_in[:, 1],
+                                 sampling_rate=self.sampling_rate,
+                                 offset=offset)
+        if self._trial.file.mode != 'r':
+            dataset = processed_data.create_dataset('Arena Step Timing',
+                                                    data=timing,
+                                                    fletcher32=True)
+            dataset.attrs['Columns'] = ['Command Sample',
+                                        'Loopback Offset (samples)',
+                                        'Latency (s)', 'Dropped']
+            for key, value in ArenaTimingSummary(timing).items():
+                dataset.attrs[key] = value
+        return timing
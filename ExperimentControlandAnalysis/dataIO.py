@@ -22,151 +22,459 @@ Requirements :
 #            3: STCP
 """
 from .experimentCommon import *
+from .stimulus import synthesizeProtocol
 
-def readStimulus(experiment_ref):
-    global outputQ, experimentEnd, experimentAbort, sample_section
-    experimentEnd = False
-    read_till = 0
-    read_max = experiment_ref.attrs["Trial End Point List"][-1]
-    while True:
-        if experimentAbort or experimentEnd:
-            print "readStimulus: experimentAbort:", experimentAbort, \
-                  "experimentEnd:", experimentEnd, "\n exiting readStimulus"
-            #outputQ.task_done()
-            return
-        protocol_list = experiment_ref.attrs["Protocol List"]
-        trial_end_point_list = experiment_ref.attrs["Trial End Point List"]
-        sample_point_start = read_till
-        protocol, protocol_sample_start, protocol_sample_end = \
-            samplePointToProtocol(protocol_list, trial_end_point_list,
-                              sample_point_start, sample_section)
-        #print "read till:", read_till, protocol, protocol_sample_start, protocol_sample_end
-        output_item = outputItem()
-        if len(protocol) == 1:
-            output_item.analog_out = experiment_ref[protocol[0]][
-                "Analog Out"][protocol_sample_start:protocol_sample_end]
-            output_item.digital_out = experiment_ref[protocol[0]][
-                "Digital Out"][protocol_sample_start:protocol_sample_end]
-            if protocol_sample_start == 0:
-                output_item.new_protocol = True
+def readStimulus(experiment_ref, schedule, output_queue, abort):
+    """Stimulus reader stage: puts one outputItem per section of schedule on
+    output_queue (blocking while it is full) until the end of the
+    experiment or until abort is set"""
+    stimulus = stimulusPrefetcher(experiment_ref, schedule)
+    n_samples_section = schedule.n_samples_section
+    try:
+        for section_number in xrange(schedule.n_sections):
+            if abort.is_set():
+                print "readStimulus: aborted at sample", \
+                      section_number * n_samples_section
+                return
+            piece_list = schedule.section(section_number)
+            output_item = outputItem()
+            output_item.new_protocol = False
+            if len(piece_list) == 1 and \
+               piece_list[0][2] - piece_list[0][1] == n_samples_section:
+                protocol_number, protocol_sample_start, protocol_sample_end = \
+                    piece_list[0]
+                current = stimulus.protocol(protocol_number)
+                output_item.analog_out = current.analog_out[
+                    protocol_sample_start:protocol_sample_end]
+                output_item.digital_out = current.digital_out[
+                    protocol_sample_start:protocol_sample_end]
+                output_item.new_protocol = protocol_sample_start == 0
+                output_item.protocol_number = protocol_number
+                output_item.protocol_start = 0
             else:
-                output_item.new_protocol = False
-        else:
-            a1 = experiment_ref[protocol[0]]["Analog Out"][
-                protocol_sample_start:]
-            a2 = experiment_ref[protocol[1]]["Analog Out"][
-                :protocol_sample_end]
-            d1 = experiment_ref[protocol[0]]["Digital Out"][
-                protocol_sample_start:]
-            d2 = experiment_ref[protocol[1]]["Digital Out"][
-                :protocol_sample_end]
-            output_item.analog_out = np.concatenate((a1, a2))
-            output_item.digital_out = np.concatenate((d1, d2))
-            output_item.new_protocol = True
-        if output_item.new_protocol:
-            #print "readStimulus: new_protocol set to true"
-            output_item.arena_angular_size = \
-                experiment_ref[protocol[-1]].attrs["Arena: Angular Size"]
-            output_item.arena_mode = \
-                experiment_ref[protocol[-1]].attrs["Arena: Mode"]
-            output_item.protocol_name = experiment_ref[protocol[-1]].name
-            output_item.protocol_duration = \
-                experiment_ref[protocol[-1]].attrs["Number of Samples"] / 10000
-        read_till += sample_section
-        output_item.read_till = read_till
-        outputQ.put(output_item, timeout=3)
-        if read_till == read_max:
-            experimentEnd = True
-            #print "readStimulus experimentEnd set to True"
-        else:
-            experimentEnd = False
-
-def writeData(experiment_ref, data_file):
-    global inputQ, experimentAbort, experimentEnd
+                output_item.analog_out = dataArray((n_samples_section, 2))
+                output_item.digital_out = dataArray((n_samples_section, 2),
+                                                    digital=True)
+                section_start = 0
+                for protocol_number, protocol_sample_start, \
+                    protocol_sample_end in piece_list:
+                    current = stimulus.protocol(protocol_number)
+                    section_end = section_start + protocol_sample_end - \
+                                  protocol_sample_start
+                    output_item.analog_out[section_start:section_end] = \
+                        current.analog_out[protocol_sample_start:
+                                           protocol_sample_end]
+                    output_item.digital_out[section_start:section_end] = \
+                        current.digital_out[protocol_sample_start:
+                                            protocol_sample_end]
+                    if protocol_sample_start == 0:
+                        output_item.new_protocol = True
+                        output_item.protocol_number = protocol_number
+                        output_item.protocol_start = section_start
+                    section_start = section_end
+            if output_item.new_protocol:
+                output_item.arena_angular_size = current.arena_angular_size
+                output_item.arena_mode = current.arena_mode
+                output_item.protocol_name = current.name
+                output_item.protocol_duration = current.number_of_samples / \
+                                                float(schedule.sampling_rate)
+            output_item.read_till = (section_number + 1) * n_samples_section
+            output_queue.put(output_item)
+    finally:
+        stimulus.close()
+
+class protocolStimulus:
+    """Output waveforms and arena settings of one protocol, in memory;
+    synthesized here for lazily stored protocols"""
+    def __init__(self, protocol_ref):
+        self.name = protocol_ref.name
+        self.analog_out, self.digital_out = synthesizeProtocol(protocol_ref)
+        self.arena_angular_size = protocol_ref.attrs["Arena: Angular Size"]
+        self.arena_mode = protocol_ref.attrs["Arena: Mode"]
+        self.number_of_samples = protocol_ref.attrs["Number of Samples"]
+
+class stimulusPrefetcher:
+    """Keeps the stimulus of the current and the next protocol of a
+    playbackSchedule in memory
+
+    protocol(n) returns the protocolStimulus of the n-th entry of the
+    Protocol List, loading it if it is not in memory yet, and starts loading
+    entry n + 1 in the background. Everything else is dropped, so at most
+    two protocols are held at a time.
+    """
+    def __init__(self, experiment_ref, schedule):
+        self.experiment_ref = experiment_ref
+        self.protocol_list = schedule.protocol_list
+        self.n_loads = 0
+        self._cache = {}
+        self._loading = {}
+
+    def protocol(self, protocol_number):
+        name = self.protocol_list[protocol_number]
+        if name in self._loading:
+            self._loading.pop(name).join()
+        if name not in self._cache:
+            self._load(name)
+        keep = [name]
+        if protocol_number + 1 < len(self.protocol_list):
+            next_name = self.protocol_list[protocol_number + 1]
+            keep.append(next_name)
+            if next_name not in self._cache and \
+               next_name not in self._loading:
+                loader = threading.Thread(target=self._load,
+                                          args=(next_name, ))
+                loader.daemon = True
+                self._loading[next_name] = loader
+                loader.start()
+        for cached_name in self._cache.keys():
+            if cached_name not in keep:
+                del self._cache[cached_name]
+        return self._cache[name]
+
+    def close(self):
+        """Wait for background loads, so nothing reads the file after the
+        reader stage has ended"""
+        for loader in self._loading.values():
+            loader.join()
+        self._loading = {}
+
+    def _load(self, name):
+        self._cache[name] = protocolStimulus(self.experiment_ref[name])
+        self.n_loads += 1
+
+def writeData(experiment_ref, schedule, input_queue, trial_writer,
+              durability=None):
+    """Writer stage: hands every inputItem from input_queue to trial_writer,
+    starting a new trial at each protocol start, until it gets None.
+    Flushes the data file as durability (a durabilityPolicy) asks."""
     written_till = 0
-    current_trial = None
-    write_max = experiment_ref.attrs["Trial End Point List"][-1]
+    protocol_number = 0
+    if durability is None:
+        durability = durabilityPolicy(experiment_ref.file)
     while True:
-        #print "inputq empty:", inputQ.empty()
-        try:
-            input_item = inputQ.get(block=True,timeout=5)
-        except Queue.Empty:
-            if experimentAbort or experimentEnd:
-                print "Write data: experimentAbort:", experimentAbort, \
-                      "experimentEnd:", experimentEnd
-                #inputQ.join()
-                print "exiting writeData"
-                data_file.close()                
-                return
-        protocol_list = experiment_ref.attrs["Protocol List"]
-        trial_end_point_list = experiment_ref.attrs["Trial End Point List"]
-        sample_point_start = written_till
-        #input_item = inputQ.get(block=True,timeout=5)
-        #print input_item, input_item.analog_in, input_item.digital_in
+        input_item = input_queue.get()
+        if input_item is None:
+            trial_writer.flush()
+            durability.flush()
+            return
         number_of_samples = input_item.analog_in.shape[0]
-        protocol, protocol_sample_start, protocol_sample_end = \
-            samplePointToProtocol(protocol_list, trial_end_point_list,
-                                  sample_point_start, number_of_samples)
-        if len(protocol) == 1:
+        piece_list, protocol_number = schedule.locate(written_till,
+                                                      number_of_samples,
+                                                      protocol_number)
+        section_start = 0
+        for protocol_number, protocol_sample_start, protocol_sample_end \
+            in piece_list:
             if protocol_sample_start == 0:
-                current_trial = _getNextTrial(experiment_ref[protocol[0]])
-            current_trial["Analog In"][
-                protocol_sample_start:protocol_sample_end, :] = \
-                input_item.analog_in
-            current_trial["Digital In"][
-                protocol_sample_start:protocol_sample_end, :] = \
-                input_item.digital_in
-        else:
-            current_trial["Analog In"][protocol_sample_start:, :] = \
-                input_item.analog_in[:-protocol_sample_start, :]
-            current_trial["Digital In"][protocol_sample_start:, :] = \
-                input_item.digital_in[:-protocol_sample_start, :]
-            current_trial.attrs["Trial Completed"] = True
-            current_trial = _getNextTrial(experiment_ref[protocol[1]])
-            current_trial["Analog In"][:protocol_sample_end, :] = \
-                input_item.analog_in[-protocol_sample_end:, :]
-            current_trial["Digital In"][:protocol_sample_end, :] = \
-                input_item.digital_in[-protocol_sample_end:, :]
+                durability.protocolStarted()
+                trial_writer.start(_getNextTrial(
+                    experiment_ref[schedule.protocol_list[protocol_number]],
+                    chunk_samples=trial_writer.chunk_samples,
+                    ai_scaling=trial_writer.ai_scaling))
+            section_end = section_start + protocol_sample_end - \
+                          protocol_sample_start
+            if trial_writer.write(protocol_sample_start,
+                    input_item.analog_in[section_start:section_end],
+                    input_item.digital_in[section_start:section_end]):
+                durability.trialCompleted()
+            section_start = section_end
+        input_item.release()
         written_till += number_of_samples
+        durability.tick()
 
-def samplePointToProtocol(protocol_list, trial_end_point_list,
-                          sample_point_start, number_of_samples):
-    #print "samplePointToProtocol", protocol_list, trial_end_point_list, sample_point_start, number_of_samples
-    sample_point_end = sample_point_start + number_of_samples
-    protocol_start_number = np.searchsorted(trial_end_point_list, 
-                                            sample_point_start, 
-                                            side='right') - 1
-    protocol_end_number = np.searchsorted(trial_end_point_list, 
-                                          sample_point_end - 1, 
-                                          side='right') - 1
-    #print "protocol start,end:", protocol_start_number, protocol_end_number
-    if protocol_start_number != protocol_end_number:
-        #raise Exception("Sample section is spilling into the next protocol")
-        current_protocol = [protocol_list[protocol_start_number],
-                            protocol_list[protocol_end_number]]
-        protocol_sample_start = int(sample_point_start -
-                                    trial_end_point_list[protocol_end_number])
-        protocol_sample_end = int((sample_point_start + number_of_samples) -
-                                  trial_end_point_list[protocol_end_number])
-    else:
-        current_protocol = [protocol_list[protocol_start_number]]
-        protocol_sample_start = int(sample_point_start -
-                                    trial_end_point_list[protocol_start_number])
-        protocol_sample_end = int(protocol_sample_start + number_of_samples)
-    #print "samplePointToProtocol output", current_protocol, protocol_sample_start, protocol_sample_end
-    return current_protocol, protocol_sample_start, protocol_sample_end
-
-def _getNextTrial(protocol_ref):
+class durabilityPolicy:
+    """When the writer stage flushes the data file to disk
+
+    policy: "protocol" - at the start of every protocol
+            "trial"    - whenever a trial is completed
+            seconds    - every that many seconds
+    The file is always flushed when the writer stage ends.
+    """
+    def __init__(self, data_file, policy="protocol"):
+        if policy not in ["protocol", "trial"]:
+            policy = float(policy)
+        self.data_file = data_file
+        self.policy = policy
+        self.n_flushes = 0
+        self.flush_time = 0.0
+        self._last_flush = time.time()
+
+    def protocolStarted(self):
+        if self.policy == "protocol":
+            self.flush()
+
+    def trialCompleted(self):
+        if self.policy == "trial":
+            self.flush()
+
+    def tick(self):
+        if not isinstance(self.policy, float):
+            return
+        if time.time() - self._last_flush >= self.policy:
+            self.flush()
+
+    def flush(self):
+        t0 = time.time()
+        self.data_file.flush()
+        self._last_flush = time.time()
+        self.n_flushes += 1
+        self.flush_time += self._last_flush - t0
+
+class trialWriter:
+    """Collects the input of the current trial in memory and writes it out
+    in whole chunks
+
+    Trial datasets are chunked in chunk_samples (a multiple of the section
+    size), so every write covers whole chunks and HDF5 never has to read
+    back a partly written chunk to update it. Data is written every
+    flush_chunks chunks, and whatever is left when the trial ends. The trial
+    is marked completed once its last sample is written; write then returns
+    True. Every dataset write is timed into statistics.
+
+    With a spike_detector (analysis.OnlineSpikeDetector), analog input
+    channel spike_channel is run through it as it arrives and the spikes
+    found are appended to the trial's "Online Spike Position List" (sample
+    positions in the trial) with every write, so they are complete when the
+    trial is.
+
+    With ai_scaling (the DAQ's ai_scaling_coefficients), analog input
+    arrives as raw int16 codes and is stored as such, with the
+    coefficients; only the spike channel is scaled, for the detector.
+    """
+    def __init__(self, chunk_samples, flush_chunks=1, statistics=None,
+                 spike_detector=None, spike_channel=0, ai_scaling=None):
+        self.chunk_samples = chunk_samples
+        self.ai_scaling = ai_scaling
+        self.spike_detector = spike_detector
+        self.spike_channel = spike_channel
+        self.spike_detector_time_list = []
+        self.flush_samples = chunk_samples * flush_chunks
+        if statistics is None:
+            statistics = writeStatistics()
+        self.statistics = statistics
+        self._trial = None
+        self._analog_stage = None
+        self._digital_stage = None
+
+    def start(self, trial_ref):
+        self.flush()
+        self._trial = trial_ref
+        self._analog_in = trial_ref["Analog In"]
+        self._digital_in = trial_ref["Digital In"]
+        self._n_samples = self._analog_in.shape[0]
+        if self._analog_stage is None or \
+           self._analog_stage.shape[1] != self._analog_in.shape[1] or \
+           self._analog_stage.dtype != self._analog_in.dtype or \
+           self._digital_stage.shape[1] != self._digital_in.shape[1]:
+            self._analog_stage = dataArray((self.flush_samples,
+                                            self._analog_in.shape[1]),
+                                           dtype=self._analog_in.dtype)
+            self._digital_stage = dataArray((self.flush_samples,
+                                             self._digital_in.shape[1]),
+                                            digital=True)
+        self._stage_start = 0
+        self._staged_till = 0
+        if self.spike_detector is not None:
+            self._spike_position_list = []
+            self._online_spikes = trial_ref.create_dataset(
+                "Online Spike Position List", shape=(0,), maxshape=(None,),
+                chunks=(1024,), dtype=np.int64)
+
+    def write(self, protocol_sample_start, analog_in, digital_in):
+        n_samples = len(analog_in)
+        if self.spike_detector is not None:
+            t0 = time.time()
+            spike_signal = analog_in[:, self.spike_channel]
+            if self.ai_scaling is not None:
+                spike_signal = scaleAnalogIn(
+                    spike_signal, self.ai_scaling[self.spike_channel])
+            spike_position_list = self.spike_detector.process(
+                spike_signal) + protocol_sample_start
+            self._spike_position_list.extend(
+                spike_position_list[spike_position_list >= 0])
+            self.spike_detector_time_list.append(time.time() - t0)
+        position = 0
+        while position < n_samples:
+            offset = protocol_sample_start + position - self._stage_start
+            count = min(n_samples - position, self.flush_samples - offset)
+            self._analog_stage[offset:offset + count] = \
+                analog_in[position:position + count]
+            self._digital_stage[offset:offset + count] = \
+                digital_in[position:position + count]
+            position += count
+            self._staged_till = self._stage_start + offset + count
+            if offset + count == self.flush_samples:
+                self.flush()
+        if self._staged_till == self._n_samples:
+            self.flush()
+            if self.spike_detector is not None:
+                self._trial.attrs["Online Spike Threshold"] = \
+                    self.spike_detector.threshold
+            self._trial.attrs["Trial Completed"] = True
+            self._trial = None
+            return True
+        return False
+
+    def flush(self):
+        if self._trial is None:
+            return
+        n_samples = self._staged_till - self._stage_start
+        if n_samples == 0:
+            return
+        t0 = time.time()
+        self._analog_in[self._stage_start:self._staged_till] = \
+            self._analog_stage[:n_samples]
+        self._digital_in[self._stage_start:self._staged_till] = \
+            self._digital_stage[:n_samples]
+        self.statistics.add(time.time() - t0,
+                            self._analog_stage[:n_samples].nbytes +
+                            self._digital_stage[:n_samples].nbytes)
+        self._stage_start = self._staged_till
+        if self.spike_detector is not None and \
+           len(self._spike_position_list) > 0:
+            n_spikes = self._online_spikes.shape[0]
+            self._online_spikes.resize((n_spikes +
+                                        len(self._spike_position_list),))
+            self._online_spikes[n_spikes:] = self._spike_position_list
+            self._spike_position_list = []
+
+class writeStatistics:
+    """Latency and throughput of trial dataset writes"""
+    def __init__(self):
+        self.latency_list = []
+        self.n_bytes = 0
+
+    def add(self, latency, n_bytes):
+        self.latency_list.append(latency)
+        self.n_bytes += n_bytes
+
+    def throughput(self):
+        """MB/s while writing"""
+        write_time = sum(self.latency_list)
+        if write_time == 0:
+            return 0.0
+        return self.n_bytes / write_time / 1e6
+
+    def latencyPercentile(self, percentile=99):
+        """Write latency in ms"""
+        if len(self.latency_list) == 0:
+            return 0.0
+        return 1000 * np.percentile(self.latency_list, percentile)
+
+class playbackSchedule:
+    """Playback order of an experiment, compiled once from its Protocol List
+    and Trial End Point List
+
+    Splits the experiment into sections of n_samples_section samples. For
+    each section, section(n) gives the list of
+    (protocol number, protocol sample start, protocol sample end) pieces it
+    is made of: one piece, or more for sections crossing a protocol
+    boundary (listed in boundary_section_list). Protocol numbers index
+    protocol_list. The last section may be short.
+    """
+    def __init__(self, protocol_list, trial_end_point_list,
+                 n_samples_section=sample_section,
+                 sampling_rate=sampling_rate):
+        self.protocol_list = list(protocol_list)
+        self.sampling_rate = sampling_rate
+        self.trial_end_point_list = np.asarray(trial_end_point_list,
+                                               dtype=np.int64)
+        self.protocol_start_point_list = self.trial_end_point_list[:-1]
+        self.protocol_length_list = np.diff(self.trial_end_point_list)
+        self.protocol_start_time_list = self.protocol_start_point_list / \
+                                        float(sampling_rate)
+        self.n_samples = int(self.trial_end_point_list[-1])
+        self.duration = self.n_samples / float(sampling_rate)
+        n_samples_section = int(n_samples_section)
+        self.n_samples_section = n_samples_section
+        self.n_sections = int(math.ceil(self.n_samples /
+                                        float(n_samples_section)))
+        section_start = np.arange(self.n_sections, dtype=np.int64) * \
+                        n_samples_section
+        section_end = np.minimum(section_start + n_samples_section,
+                                 self.n_samples)
+        first_protocol = np.searchsorted(self.trial_end_point_list,
+                                         section_start, side='right') - 1
+        last_protocol = np.searchsorted(self.trial_end_point_list,
+                                        section_end - 1, side='right') - 1
+        self._section_protocol = first_protocol
+        self._section_offset = section_start - \
+                               self.trial_end_point_list[first_protocol]
+        self._section_length = section_end - section_start
+        self.boundary_section_list = np.flatnonzero(first_protocol !=
+                                                    last_protocol)
+        self._boundary_piece_list = {}
+        for section_number in self.boundary_section_list:
+            self._boundary_piece_list[section_number] = self.locate(
+                section_start[section_number],
+                self._section_length[section_number],
+                first_protocol[section_number])[0]
+
+    @classmethod
+    def fromExperiment(cls, experiment_ref):
+        """Schedule at the experiment's Sampling Rate and Section Samples
+        (10000 and 1000 for files from before they were stored)"""
+        attrs = experiment_ref.attrs
+        return cls(attrs["Protocol List"], attrs["Trial End Point List"],
+                   n_samples_section=attrs.get("Section Samples", 1000),
+                   sampling_rate=attrs.get("Sampling Rate", 10000))
+
+    def section(self, section_number):
+        if section_number in self._boundary_piece_list:
+            return self._boundary_piece_list[section_number]
+        protocol_sample_start = int(self._section_offset[section_number])
+        return [(int(self._section_protocol[section_number]),
+                 protocol_sample_start,
+                 protocol_sample_start +
+                 int(self._section_length[section_number]))]
+
+    def locate(self, sample_point_start, number_of_samples,
+               protocol_number=0):
+        """Pieces for an arbitrary run of samples, searching forward from
+        protocol_number. Returns the piece list and the protocol number the
+        run ends in, to start the next search from. Samples past the end of
+        the experiment are dropped."""
+        trial_end_point_list = self.trial_end_point_list
+        sample_point_end = min(sample_point_start + number_of_samples,
+                               self.n_samples)
+        piece_list = []
+        while sample_point_start < sample_point_end:
+            while trial_end_point_list[protocol_number + 1] <= \
+                  sample_point_start:
+                protocol_number += 1
+            protocol_start = trial_end_point_list[protocol_number]
+            piece_end = min(sample_point_end,
+                            trial_end_point_list[protocol_number + 1])
+            piece_list.append((protocol_number,
+                               int(sample_point_start - protocol_start),
+                               int(piece_end - protocol_start)))
+            sample_point_start = piece_end
+        return piece_list, protocol_number
+
+def _getNextTrial(protocol_ref, chunk_samples=sample_section,
+                  ai_scaling=None):
     #print "Get Next Trial", protocol_ref
     protocol_contents = protocol_ref.keys()
-    protocol_contents.remove("Analog Out")
-    protocol_contents.remove("Digital Out")
+    for stimulus_dataset in stimulus_dataset_list:
+        if stimulus_dataset in protocol_contents:
+            protocol_contents.remove(stimulus_dataset)
     next_trial = "Trial-" + str(len(protocol_contents) + 1)
     next_trial_ref = protocol_ref.create_group(next_trial)
     protocol_number_of_samples = int(protocol_ref.attrs["Number of Samples"])
-    next_trial_ref.create_dataset("Analog In", (protocol_number_of_samples,3),
-                              dtype=np.float64, fillvalue=np.NaN, fletcher32=True)
+    chunk_samples = min(chunk_samples, protocol_number_of_samples)
+    if ai_scaling is None:
+        next_trial_ref.create_dataset("Analog In", (protocol_number_of_samples,3),
+                              dtype=np.float64, fillvalue=np.NaN, fletcher32=True,
+                              chunks=(chunk_samples, 3))
+    else:
+        # raw ADC codes; samples never written hold the lowest code, which
+        # dataFileHandling.AnalogIn reads as NaN
+        analog_in = next_trial_ref.create_dataset("Analog In",
+                              (protocol_number_of_samples, 3),
+                              dtype=np.int16, fillvalue=-2 ** 15,
+                              fletcher32=True, chunks=(chunk_samples, 3))
+        analog_in.attrs["Scaling Coefficients"] = ai_scaling
     next_trial_ref.create_dataset("Digital In", (protocol_number_of_samples, 2),
-                                  dtype=np.uint8, fillvalue=np.NaN, fletcher32=True)
+                                  dtype=np.uint8, fillvalue=np.NaN, fletcher32=True,
+                                  chunks=(chunk_samples, 2))
     next_trial_ref.attrs["Trial Completed"] = False
     return next_trial_ref
@@ -2,12 +2,14 @@
 """
 @author: Umesh Mohan (umeshm@ncbs.res.in)
 """
+import sys
 import numpy as np
 import scipy.signal
 import math
 import time
 import re
 import thread
+import threading
 import Queue
 import h5py
 import tempfile
@@ -15,18 +17,61 @@ import random
 import os
 import signal
 import zipfile
-from msvcrt import getch
+import collections
+import multiprocessing
 from itertools import product
+try:
+    import msvcrt
 
-arena_brightness_percent = 2
+    def getch(timeout=None):
+        """Next key pressed, None if none within timeout (s)"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+            while not msvcrt.kbhit():
+                if time.time() > deadline:
+                    return None
+                time.sleep(0.01)
+        return msvcrt.getch()
+
+    def cbreakTerminal():
+        return None
+
+    def restoreTerminal(settings):
+        pass
+except ImportError:
+    import tty
+    import termios
+    import select
 
-outputQ = Queue.Queue(maxsize=50)
-inputQ = Queue.Queue()
-experimentEnd = None
-experimentAbort = None
+    def getch(timeout=None):
+        """Next key pressed, None if none within timeout (s), "" at end of
+        input. Keys arrive one by one only while the terminal is in cbreak
+        mode (cbreakTerminal)."""
+        ready, _, _ = select.select([sys.stdin], [], [], timeout)
+        if not ready:
+            return None
+        return os.read(sys.stdin.fileno(), 1)
+
+    def cbreakTerminal():
+        """Put the terminal in cbreak mode. Returns the settings to hand
+        to restoreTerminal."""
+        if not sys.stdin.isatty():
+            return None
+        settings = termios.tcgetattr(sys.stdin.fileno())
+        tty.setcbreak(sys.stdin.fileno())
+        return settings
+
+    def restoreTerminal(settings):
+        if settings is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, settings)
+
+arena_brightness_percent = 2
 
 sampling_rate = 10000
 sample_section = 1000
+# Datasets of a protocol group holding its stimulus, in any storage
+stimulus_dataset_list = ["Analog Out", "Digital Out", "Analog Out Codes",
+                         "Digital Out Bits"]
 
 class outputItem:
     def __init__(self):
@@ -36,20 +81,113 @@ class outputItem:
         self.arena_angular_size = None
         self.arena_mode = None
         self.protocol_name = None
+        self.protocol_number = None
+        self.protocol_start = None
         self.read_till = None
 
 class inputItem:
-    def __init__(self):
+    def __init__(self, release=None):
+        self.analog_in = None
+        self.digital_in = None
+        self._release = release
+
+    def release(self):
+        """Hand the section buffers back to the acquisition buffer ring"""
+        if self._release is not None:
+            self._release(self.analog_in, self.digital_in)
         self.analog_in = None
         self.digital_in = None
 
-def dataArray(shape=(1000,2), digital=False):
-    if digital:
+def dataArray(shape=(1000,2), digital=False, dtype=None):
+    if dtype is not None:
+        data_type = dtype
+    elif digital:
         data_type = np.uint8
     else:
         data_type = np.float64
     return np.zeros(shape, dtype=data_type)
 
+def scaleAnalogIn(codes, coefficients):
+    """Volts from raw ADC codes, by the polynomial coefficients (lowest
+    order first, one row per channel, channels along the last axis of
+    codes) the DAQ reports for its analog input channels"""
+    coefficients = np.asarray(coefficients, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.float64)
+    volts = np.zeros(codes.shape) + coefficients[..., -1]
+    for order in range(coefficients.shape[-1] - 2, -1, -1):
+        volts = volts * codes + coefficients[..., order]
+    return volts
+
+class bufferRing:
+    """Preallocated, reusable section buffers
+
+    get returns a free buffer, release takes back a buffer (or any view of
+    it) once the consumer is done with it. A new buffer is only allocated
+    when all buffers are in use; n_allocations counts those, so it stays at
+    0 as long as consumers keep up.
+    """
+    def __init__(self, n_buffers, shape=(1000,2), digital=False, dtype=None):
+        self.shape = shape
+        self.digital = digital
+        self.dtype = dtype
+        self.n_allocations = 0
+        self._buffers = {}
+        self._free = collections.deque()
+        for i in range(n_buffers):
+            self._free.append(self._allocate())
+
+    def get(self):
+        try:
+            return self._free.popleft()
+        except IndexError:
+            self.n_allocations += 1
+            return self._allocate()
+
+    def reserve(self, n_buffers):
+        """Preallocate buffers until there are at least n_buffers, for
+        consumers that hold on to more of them (queued sections)"""
+        while len(self._buffers) < n_buffers:
+            self._free.append(self._allocate())
+
+    def release(self, data):
+        if data is None:
+            return
+        while id(data) not in self._buffers and data.base is not None:
+            data = data.base
+        if id(data) in self._buffers:
+            self._free.append(data)
+
+    def _allocate(self):
+        data = dataArray(self.shape, digital=self.digital, dtype=self.dtype)
+        self._buffers[id(data)] = data
+        return data
+
+def countChannels(channelString=""):
+    """Returns the number of physical channels in a string containing
+    physical channel lists
+
+    http://zone.ni.com/reference/en-XX/help/370466V-01/mxcncpts/physchannames/
+    """
+    count = 0
+    if channelString.count(",") > 0:
+        t = channelString.split(",")
+        for i in t:
+            count += countChannels(i)
+        return count
+    else:
+        if channelString.count(":") > 0:
+            t2 = channelString.split(":")
+            n2 = int(t2[1])
+            # Detect last number in string:
+            t3 = re.match(r'(.*?)(\d+$)', t2[0]).groups() 
+            n1 = int(t3[1])
+            if n1 > n2:
+                return n1 - n2 + 1
+            else:
+                return n2 - n1 + 1
+        else:
+            return 1
+
 def secondsToHMS(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
@@ -75,30 +213,8 @@ def prepareDirectoryForExperiment(data_file_path):
         saveSelf(os.path.join(dir_of_data_file, 'ExperimentControl.zip'))
 
 
-def product2(args):
-    return product(*args)
-
-def expandStimulusRepresentation(compactStimulusRepresentation):
-    a = "".join(compactStimulusRepresentation.split("\n"))
-    a = "".join(a.split(" "))
-    b = a.split(";")
-    x=[]
-    for c in b:
-        m=re.split(r"\[(.*?)\]",c)
-        n=[]
-        for i in m:
-            n.append(i.split("/"))
-        t = product2(n)
-        t2 = []
-        for o in t:
-            t2.append("".join(o))
-        t = ";".join(t2)
-        if t != "":
-            x.append(t)
-    return ";".join(x)
-
 #full stimulus
-'''
+full_protocol_string = '''
 vis(4,5,4,10,[0/1/2/3],40);
 vis(4,8,4,10,[4/5],40);
 vic(4,5,4,10,[0/1/2/3],[0,100/100,0]);
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Requirements : numpy
+
+Live tap: acquired data in a shared memory ring, for scopes, online analysis
+and dashboards running in other processes.
+
+The acquisition engine publishes every acquired Analog In / Digital In
+section into a ring of the last few seconds, kept in a memory mapped file
+(tempdir/ExperimentControl.live by default). Any number of local processes
+attach with liveTapReader and read the latest N seconds. Neither side takes
+a lock: there is one writer, it copies a section into the ring and only then
+advances the write count; a reader copies what it wants and checks that the
+writer has not wrapped over it meanwhile, retrying if it has. Readers get at
+most half the ring, the other half is the margin for a section being
+written but not yet counted.
+
+    reader = liveTapReader()
+    for sample_start, analog_in, digital_in in reader.follow(2.0):
+        print sample_start, analog_in.std(axis=0)
+"""
+
+from .experimentCommon import *
+
+header_dtype = np.dtype([("magic", "S8"),
+                         ("sampling_rate", "<f8"),
+                         ("ai_chan_count", "<i8"),
+                         ("di_chan_count", "<i8"),
+                         ("capacity", "<i8"),
+                         ("run", "<i8"),
+                         ("running", "<i8"),
+                         ("n_written", "<i8")])
+_magic = "ECLIVE1"
+
+def defaultTapPath():
+    return os.path.join(tempfile.gettempdir(), "ExperimentControl.live")
+
+def _ringLayout(ai_chan_count, di_chan_count, capacity):
+    """Byte offsets of the analog and digital rings and the file size"""
+    ai_offset = header_dtype.itemsize
+    di_offset = ai_offset + capacity * ai_chan_count * 8
+    return ai_offset, di_offset, di_offset + capacity * di_chan_count
+
+class liveTap:
+    """Writer side, owned by the DAQ stage
+
+    publish copies a section (a few tens of kB) into the ring; it never
+    blocks and never touches the data file. A file of the right size left
+    by an earlier run is reused, so readers can stay attached across runs;
+    run is incremented and n_written restarts at 0 for every run.
+    Given ai_scaling (a raw DAQ's ai_scaling_coefficients), raw analog input
+    is scaled to volts as it is published.
+    The ring holds seconds of data, and at least two sections of
+    n_samples_section (the longest the DAQ hands over), so that any section
+    fits in its writer's half.
+    """
+    def __init__(self, path=None, ai_chan_count=3, di_chan_count=2,
+                 sampling_rate=sampling_rate, seconds=10, ai_scaling=None,
+                 n_samples_section=sample_section):
+        if path is None:
+            path = defaultTapPath()
+        self.path = path
+        self.sampling_rate = sampling_rate
+        self.capacity = max(int(seconds * sampling_rate),
+                            2 * n_samples_section)
+        self.ai_scaling = ai_scaling
+        ai_offset, di_offset, size = _ringLayout(ai_chan_count, di_chan_count,
+                                                 self.capacity)
+        run = 0
+        if os.path.isfile(path) and os.path.getsize(path) == size:
+            previous = np.memmap(path, dtype=header_dtype, mode='r', shape=(1,))
+            if previous["magic"][0] == _magic:
+                run = int(previous["run"][0])
+            del previous
+        else:
+            with open(path, 'wb') as tap_file:
+                tap_file.truncate(size)
+        self._map = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        self._header = self._map[:ai_offset].view(header_dtype)
+        self.analog_in = self._map[ai_offset:di_offset].view(
+            np.float64).reshape((self.capacity, ai_chan_count))
+        self.digital_in = self._map[di_offset:].reshape((self.capacity,
+                                                         di_chan_count))
+        self.n_written = 0
+        self._header["n_written"] = 0
+        self._header["sampling_rate"] = sampling_rate
+        self._header["ai_chan_count"] = ai_chan_count
+        self._header["di_chan_count"] = di_chan_count
+        self._header["capacity"] = self.capacity
+        self._header["run"] = run + 1
+        self._header["running"] = 1
+        self._header["magic"] = _magic
+
+    def publish(self, analog_in, digital_in):
+        n_samples = len(analog_in)
+        if n_samples == 0:
+            return
+        if self.ai_scaling is not None:
+            analog_in = scaleAnalogIn(analog_in, self.ai_scaling)
+        start = self.n_written % self.capacity
+        n_first = min(n_samples, self.capacity - start)
+        self.analog_in[start:start + n_first] = analog_in[:n_first]
+        self.analog_in[:n_samples - n_first] = analog_in[n_first:]
+        if digital_in is not None:
+            self.digital_in[start:start + n_first] = digital_in[:n_first]
+            self.digital_in[:n_samples - n_first] = digital_in[n_first:]
+        self.n_written += n_samples
+        self._header["n_written"] = self.n_written
+
+    def close(self):
+        self._header["running"] = 0
+        self._map.flush()
+
+class liveTapReader:
+    """Reader side, any number of processes
+
+    latest(seconds) returns (sample_start, analog_in, digital_in) for the
+    latest seconds of data (less at the start of a run), sample_start
+    counting from the start of the run. follow yields the same every time
+    new data has arrived.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = defaultTapPath()
+        self.path = path
+        header = np.memmap(path, dtype=header_dtype, mode='r', shape=(1,))
+        if header["magic"][0] != _magic:
+            raise IOError("%s is not a live tap" % path)
+        self.sampling_rate = float(header["sampling_rate"][0])
+        ai_chan_count = int(header["ai_chan_count"][0])
+        di_chan_count = int(header["di_chan_count"][0])
+        self.capacity = int(header["capacity"][0])
+        del header
+        ai_offset, di_offset, size = _ringLayout(ai_chan_count, di_chan_count,
+                                                 self.capacity)
+        self._map = np.memmap(path, dtype=np.uint8, mode='r', shape=(size,))
+        self._header = self._map[:ai_offset].view(header_dtype)
+        self.analog_in = self._map[ai_offset:di_offset].view(
+            np.float64).reshape((self.capacity, ai_chan_count))
+        self.digital_in = self._map[di_offset:].reshape((self.capacity,
+                                                         di_chan_count))
+
+    @property
+    def n_written(self):
+        return int(self._header["n_written"][0])
+
+    @property
+    def run(self):
+        return int(self._header["run"][0])
+
+    @property
+    def running(self):
+        return bool(self._header["running"][0])
+
+    def latest(self, seconds):
+        n_samples = min(int(seconds * self.sampling_rate),
+                        self.capacity // 2)
+        while True:
+            run = self.run
+            sample_end = self.n_written
+            sample_start = max(0, sample_end - n_samples)
+            analog_in = _ringCopy(self.analog_in, sample_start, sample_end)
+            digital_in = _ringCopy(self.digital_in, sample_start, sample_end)
+            if self.run == run and sample_start >= \
+               self.n_written - self.capacity // 2:
+                return sample_start, analog_in, digital_in
+
+    def follow(self, seconds, interval=0.1):
+        last = None
+        while True:
+            current = (self.run, self.n_written)
+            if current != last and current[1] > 0:
+                last = current
+                yield self.latest(seconds)
+            time.sleep(interval)
+
+def _ringCopy(ring, sample_start, sample_end):
+    capacity = len(ring)
+    start = sample_start % capacity
+    end = start + sample_end - sample_start
+    if end <= capacity:
+        return ring[start:end].copy()
+    return np.concatenate((ring[start:], ring[:end - capacity]))
+
+if __name__ == "__main__":
+    reader = liveTapReader(sys.argv[1] if len(sys.argv) > 1 else None)
+    print "Live tap", reader.path, "at", reader.sampling_rate, "S/s"
+    for sample_start, analog_in, digital_in in reader.follow(1.0, 0.5):
+        print "run %d, %.1f s: AI mean" % \
+            (reader.run, (sample_start + len(analog_in)) /
+                         reader.sampling_rate), \
+            np.round(analog_in.mean(axis=0), 3), "sd", \
+            np.round(analog_in.std(axis=0), 3)
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Requirements : h5py
+
+Motor calibration for calibrated chirps (mec and mcv protocols).
+
+The calibration experiment (mCalib: mec chirps played while the hall
+effect sensor recorded the antenna) is read once. The mean antennal
+movement of each of its mec protocols comes from Processed Data if the file
+was analysed, otherwise from its completed trials. It is indexed by
+(duration, frequency_0, frequency_1, amplitude). The resonance correction
+for a chirp is computed the first time it is needed and memoized. With
+persist, corrections are also kept next to the calibration file
+(<file>.corrections.h5), under a hash of the calibration data, for later
+experiments.
+
+A chirp whose parameters were not calibrated gets its correction
+interpolated between the nearest calibrated amplitudes below and above its
+own on the same sweep (duration and frequencies); without both it is not
+corrected.
+"""
+
+from .experimentCommon import *
+from .analysis import AntennalMovement, \
+                      mec_hallEffectSensorToDisplacementAmplitude
+from .dataFileHandling import GetSubGroupList, GetSamplingRate, AnalogIn
+import hashlib
+
+class motorCalibration:
+    """Calibration store of one calibration experiment (an h5py group)
+
+    correction(duration, frequency_0, frequency_1, amplitude, sampling_rate)
+    returns the correction to multiply a chirp with, or None.
+    calibration_hash identifies the calibration data; n_computed counts
+    corrections computed rather than memoized or loaded.
+    """
+    def __init__(self, calibration_experiment, persist=True):
+        self.name = calibration_experiment.name
+        self.sampling_rate = GetSamplingRate(calibration_experiment)
+        self.index = {}
+        self.n_computed = 0
+        self._mean_antennal_movement = {}
+        self._correction = {}
+        digest = hashlib.sha1()
+        for protocol_name in sorted(GetSubGroupList(calibration_experiment)):
+            mec_parameters = _mecParameters(protocol_name)
+            if mec_parameters is None:
+                continue
+            mean_antennal_movement = _meanAntennalMovement(
+                calibration_experiment[protocol_name])
+            if mean_antennal_movement is None:
+                continue
+            key = (mec_parameters[1], mec_parameters[3], mec_parameters[4],
+                   mec_parameters[5])
+            self.index[key] = mec_parameters
+            self._mean_antennal_movement[key] = mean_antennal_movement
+            digest.update(protocol_name)
+            digest.update(mean_antennal_movement.tobytes())
+        self.calibration_hash = digest.hexdigest()
+        if persist:
+            self.store_path = calibration_experiment.file.filename + \
+                              ".corrections.h5"
+        else:
+            self.store_path = None
+
+    @classmethod
+    def fromFile(cls, file_name, experiment_name, persist=True):
+        with h5py.File(file_name, 'r') as calibration_file:
+            return cls(calibration_file[experiment_name], persist=persist)
+
+    def correction(self, duration, frequency_0, frequency_1, amplitude,
+                   sampling_rate=sampling_rate):
+        key = (float(duration), float(frequency_0), float(frequency_1),
+               float(amplitude))
+        memo_key = key + (float(sampling_rate), )
+        if memo_key not in self._correction:
+            if key in self.index:
+                self._correction[memo_key] = self._calibrated(key,
+                                                              sampling_rate)
+            else:
+                self._correction[memo_key] = self._interpolated(key,
+                                                                sampling_rate)
+        return self._correction[memo_key]
+
+    def _interpolated(self, key, sampling_rate):
+        amplitude = key[3]
+        amplitude_list = sorted(calibrated[3] for calibrated in self.index
+                                if calibrated[:3] == key[:3])
+        below = [a for a in amplitude_list if a < amplitude]
+        above = [a for a in amplitude_list if a > amplitude]
+        if len(below) == 0 or len(above) == 0:
+            return None
+        weight = (amplitude - below[-1]) / (above[0] - below[-1])
+        return (1 - weight) * self.correction(*(key[:3] + (below[-1], )),
+                                              sampling_rate=sampling_rate) + \
+               weight * self.correction(*(key[:3] + (above[0], )),
+                                        sampling_rate=sampling_rate)
+
+    def _calibrated(self, key, sampling_rate):
+        name = " ".join(repr(value) for value in
+                        key + (float(sampling_rate), ))
+        correction = self._load(name)
+        if correction is not None:
+            return correction
+        correction = mec_hallEffectSensorToDisplacementAmplitude(
+            self._mean_antennal_movement[key],
+            mec_parameters=self.index[key],
+            sampling_rate=self.sampling_rate)
+        if sampling_rate != self.sampling_rate:
+            correction = np.interp(
+                np.arange(int(key[0] * sampling_rate)) / float(sampling_rate),
+                np.arange(len(correction)) / float(self.sampling_rate),
+                correction)
+        self.n_computed += 1
+        self._save(name, correction)
+        return correction
+
+    def _load(self, name):
+        if self.store_path is None or not os.path.isfile(self.store_path):
+            return None
+        try:
+            with h5py.File(self.store_path, 'r') as store:
+                if self.calibration_hash in store and \
+                   name in store[self.calibration_hash]:
+                    return store[self.calibration_hash][name].value
+        except IOError:
+            pass
+        return None
+
+    def _save(self, name, correction):
+        if self.store_path is None:
+            return
+        try:
+            with h5py.File(self.store_path, 'a') as store:
+                group = store.require_group(self.calibration_hash)
+                if name not in group:
+                    group.create_dataset(name, data=correction)
+        except IOError:
+            print "Motor calibration: could not save to", self.store_path
+
+def _mecParameters(protocol_name):
+    """Parameters of a mec protocol id, None for anything else"""
+    t = protocol_name.split("(")
+    if t[0] != "mec" or len(t) != 2:
+        return None
+    mec_parameters = [float(parameter) for parameter in t[1][:-1].split(',')]
+    if len(mec_parameters) != 6:
+        return None
+    return mec_parameters
+
+def _meanAntennalMovement(protocol):
+    """Mean Antennal Movement of a calibration protocol, computed from its
+    completed trials if the file was not analysed"""
+    if 'Processed Data' in protocol and \
+       'Mean Antennal Movement' in protocol['Processed Data']:
+        return protocol['Processed Data']['Mean Antennal Movement'].value
+    sampling_rate = GetSamplingRate(protocol)
+    antennal_movement_list = [
+        AntennalMovement(AnalogIn(protocol[trial_name]['Analog In'])[:, 2],
+                         sampling_rate=sampling_rate)
+        for trial_name in GetSubGroupList(protocol)
+        if protocol[trial_name].attrs.get('Trial Completed')]
+    if len(antennal_movement_list) == 0:
+        return None
+    return np.mean(antennal_movement_list, axis=0)
+
+# vim: set ts=4 sw=4 ft=python ai nu et
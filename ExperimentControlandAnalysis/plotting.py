@@ -50,10 +50,10 @@ class SpikesItem(pg.GraphicsObject):
 def PlotTrial(trial_name, membrane_potential, spike_position_list, 
               antennal_movement, arena_out,
               colors={'mp':'w', 'sp':'y', 'am':'r', 'ls':'g'},
-              win=None):
+              win=None, sampling_rate=10000):
     if win is None:
         win = pg.GraphicsWindow(trial_name)
-    t = np.linspace(0, len(arena_out)/10000.0, 
+    t = np.linspace(0, len(arena_out)/float(sampling_rate), 
                     num=len(arena_out), endpoint=False)
     plt_mp = win.addPlot(name="plot_mp", title="Membrane Potential", 
                        row=0, col=0)
@@ -78,10 +78,10 @@ def PlotProtocol(protocol_name, antennal_movement_list, mean_antennal_movement,
                  arena_out, spike_position_list_array, GCFR,
                  colors={'am': (50,0,0), 'amm':'r', 'ls':'g',
                          'sp':'w', 'gcfr':'y'},
-                 win=None):
+                 win=None, sampling_rate=10000):
     if win is None:
         win = pg.GraphicsWindow(protocol_name)
-    t = np.linspace(0, len(arena_out)/10000.0, 
+    t = np.linspace(0, len(arena_out)/float(sampling_rate), 
                     num=len(arena_out), endpoint=False)
     plt_am = win.addPlot(name="plot_am", title="Antennal Movement", 
                          row=0, col=0)
@@ -215,14 +215,16 @@ class ExploreDataFile(QtGui.QWidget):
                          'arena out': protocol.arena_out}
             PlotTrial(trial_name, membrane_potential, spike_position_list, 
                       antennal_movement, protocol.arena_out, 
-                      win=self.plot_widget)
+                      win=self.plot_widget,
+                      sampling_rate=protocol.sampling_rate)
         else:
             protocol_name = str(item.text(0))
             experiment_name = str(item.parent().text(0))
             protocol = self.neuron_data.experiment[experiment_name].protocol[protocol_name]
             antennal_movement_list, mean_antennal_movement, arena_out, \
                 raster_data, pre_GCFR = protocol.AnalyzeProtocol()
-            gcfr = GCFR(pre_GCFR, self.params['GCFR-sigma (ms)'])
+            gcfr = GCFR(pre_GCFR, self.params['GCFR-sigma (ms)'] *
+                        protocol.sampling_rate / 1000.0)
             self.data = {'type': "protocol",
                          'protocol name': protocol_name,
                          'antennal movement list': antennal_movement_list, 
@@ -232,7 +234,8 @@ class ExploreDataFile(QtGui.QWidget):
                          'GCFR': gcfr} 
             PlotProtocol(protocol_name, antennal_movement_list, 
                          mean_antennal_movement, arena_out, raster_data, 
-                         gcfr, win=self.plot_widget)
+                         gcfr, win=self.plot_widget,
+                         sampling_rate=protocol.sampling_rate)
 """
 def PlotTrial(trial_name, membrane_potential, spike_position_list, 
     antennal_movement, arena_out,
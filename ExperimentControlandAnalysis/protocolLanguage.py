@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Protocol language: the protocol strings experiments are described with.
+
+    vis(4,5,4,10,[0/1/2/3],40);
+    mec(4,5,4,[0,120/120,0],0.4)
+
+A protocol string is protocols separated by ";", whitespace is ignored. A
+protocol is type(parameter,...) and any part of its parameters can be a
+grid, [a/b/...], which stands for one protocol per alternative; several
+grids in a protocol stand for every combination, in order.
+
+parseProtocolString checks a whole string (syntax, protocol types,
+parameter counts and values) and returns a protocolGrid for every protocol,
+without expanding the grids. iterProtocols expands them lazily into
+protocolCall tuples. estimateExperiment adds up protocols, duration, samples
+and data file size from the parameters alone, combining only the grids that
+change a protocol's duration, so even a sweep of millions of protocols is
+checked in milliseconds, before anything is generated.
+"""
+
+from .experimentCommon import *
+
+# Protocol types: name, number of parameters and the parameters the
+# protocol's duration depends on
+protocol_types = collections.OrderedDict([
+    ("bla", ("Blank", 1, (0, ))),
+    ("brb", ("Bridge Balance", 1, (0, ))),
+    ("mep", ("Mechanical Pulse", 4, (0, 1, 2))),
+    ("mes", ("Mechanical Sine", 5, (0, 1, 2))),
+    ("mec", ("Mechanical Chirp", 6, (0, 1, 2))),
+    ("men", ("Mechanical Noise", 5, (0, 1, 2))),
+    ("vis", ("Visual", 6, (0, 1, 2))),
+    ("vic", ("Visual Chirp", 7, (0, 1, 2))),
+    ("msv", ("Mechanical Sine + Visual", 10, (0, 1, 2, 3, 4))),
+    ("mcv", ("Mechanical Chirp + Visual", 11, (0, 1, 2, 3, 4))),
+    ("dye", ("dye", 2, (0, )))])
+
+# Bytes per sample of the stored stimulus (Analog Out, Digital Out; by
+# stimulus storage, compressed at most as large as compact) and of the
+# recorded data (Analog In, Digital In; float64 or raw int16 Analog In)
+stimulus_bytes_per_sample = {"float": 2 * 8 + 2 * 1,
+                             "compact": 2 * 2 + 2 / 8.0,
+                             "compressed": 2 * 2 + 2 / 8.0}
+recorded_bytes_per_sample = 3 * 8 + 2 * 1
+raw_recorded_bytes_per_sample = 3 * 2 + 2 * 1
+warmup_duration = 5
+
+protocolCall = collections.namedtuple("protocolCall", ["protocol_id",
+                                                       "protocol_type",
+                                                       "parameters"])
+
+def parseProtocol(protocol_id):
+    """protocolCall of a protocol id (a protocol without grids)"""
+    t = protocol_id.split("(")
+    if len(t) != 2 or not t[1].endswith(")"):
+        raise Exception("Protocol " + protocol_id +
+                        ": expected type(parameter,...)")
+    protocol_type = t[0]
+    if protocol_type not in protocol_types:
+        raise NotImplementedError("Stimulus " + protocol_type +
+                                  " not implemented")
+    try:
+        parameters = tuple(float(parameter)
+                           for parameter in t[1][:-1].split(','))
+    except ValueError:
+        raise Exception("Protocol " + protocol_id +
+                        ": parameters must be numbers")
+    name, number_of_parameters, _ = protocol_types[protocol_type]
+    if len(parameters) != number_of_parameters:
+        raise Exception("Protocol " + name + " requires " +
+                        str(number_of_parameters) + " parameter(s). Got " +
+                        protocol_id)
+    return protocolCall(protocol_id, protocol_type, parameters)
+
+def parseProtocolString(protocol_string):
+    """protocolGrid for every protocol of a protocol string, checked"""
+    protocol_string = "".join(protocol_string.split())
+    return [protocolGrid(text) for text in protocol_string.split(";")
+            if text != ""]
+
+def iterProtocols(protocol_string):
+    """Every protocol of a protocol string, grids expanded, in order"""
+    for grid in parseProtocolString(protocol_string):
+        for protocol in grid.expand():
+            yield protocol
+
+def expandStimulusRepresentation(compactStimulusRepresentation):
+    """Protocol string with its grids expanded, as protocol ids joined by
+    ";" """
+    return ";".join(protocol.protocol_id for protocol in
+                    iterProtocols(compactStimulusRepresentation))
+
+class protocolGrid:
+    """One protocol of a protocol string, grids unexpanded
+
+    segment_list is the protocol's text split into text and grids (tuples
+    of alternatives). n_protocols is the number of protocols it stands for,
+    expand yields them. Every alternative of every grid is checked when it
+    is created.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.segment_list = _segments(text)
+        if isinstance(self.segment_list[0], tuple) or \
+           "(" not in self.segment_list[0] or \
+           isinstance(self.segment_list[-1], tuple):
+            raise Exception("Protocol " + text +
+                            ": expected type(parameter,...), with grids "
+                            "only in the parameters")
+        self.protocol_type = self.segment_list[0].split("(")[0]
+        self._grid_index_list = [index for index, segment in
+                                 enumerate(self.segment_list)
+                                 if isinstance(segment, tuple)]
+        self.n_protocols = 1
+        for index in self._grid_index_list:
+            self.n_protocols *= len(self.segment_list[index])
+        parseProtocol(self._choice({}))
+        for index in self._grid_index_list:
+            for alternative in self.segment_list[index][1:]:
+                parseProtocol(self._choice({index: alternative}))
+
+    def expand(self):
+        for choice in product(*[segment if isinstance(segment, tuple)
+                                else (segment, )
+                                for segment in self.segment_list]):
+            yield parseProtocol("".join(choice))
+
+    def durations(self):
+        """(duration, number of protocols) pairs covering every protocol,
+        expanding only the grids that change the duration"""
+        duration_parameters = protocol_types[self.protocol_type][2]
+        varying = []
+        n_same = 1
+        for index in self._grid_index_list:
+            start = self._choice({}, end=index).count(",")
+            touched = range(start,
+                            start + self.segment_list[index][0].count(",") + 1)
+            if set(touched) & set(duration_parameters):
+                varying.append(index)
+            else:
+                n_same *= len(self.segment_list[index])
+        for choice in product(*[self.segment_list[index]
+                                for index in varying]):
+            protocol = parseProtocol(self._choice(dict(zip(varying, choice))))
+            yield protocolDuration(protocol), n_same
+
+    def _choice(self, alternative_dict, end=None):
+        """Protocol id with the given alternatives (by segment index) and
+        the first alternative of other grids, up to segment end"""
+        text_list = []
+        for index, segment in enumerate(self.segment_list[:end]):
+            if isinstance(segment, tuple):
+                segment = alternative_dict.get(index, segment[0])
+            text_list.append(segment)
+        return "".join(text_list)
+
+def _segments(text):
+    segment_list = []
+    position = 0
+    while position < len(text):
+        start = text.find("[", position)
+        if start == -1:
+            start = len(text)
+        if "]" in text[position:start]:
+            raise Exception("Protocol " + text + ": unmatched ]")
+        if start > position:
+            segment_list.append(text[position:start])
+        if start == len(text):
+            break
+        end = text.find("]", start)
+        if end == -1:
+            raise Exception("Protocol " + text + ": unmatched [")
+        if "[" in text[start + 1:end]:
+            raise Exception("Protocol " + text + ": nested grids")
+        segment_list.append(tuple(text[start + 1:end].split("/")))
+        position = end + 1
+    if len(segment_list) == 0:
+        raise Exception("Empty protocol")
+    return segment_list
+
+def protocolDuration(protocol):
+    """Duration (s) of a protocol, as its stimulus function lays it out"""
+    p = protocol.parameters
+    if protocol.protocol_type in ["bla", "brb", "dye"]:
+        return p[0]
+    if protocol.protocol_type in ["msv", "mcv"]:
+        [PrSD, MSD, VSD, MVD, PoSD] = p[:5]
+        if MVD == 0:
+            SD = max(MSD, VSD)
+        elif MVD > 0:
+            SD = max(MSD, VSD + MVD)
+        else:
+            SD = max(MSD - MVD, VSD)
+        return PrSD + SD + PoSD
+    return p[0] + p[1] + p[2]
+
+def protocolSamples(duration, sampling_rate=sampling_rate):
+    """Number of samples of a protocol lasting duration (at least 1000, as
+    stimulus._roundoff)"""
+    return int(max(duration * sampling_rate, 1000))
+
+def estimateExperiment(protocol_string, repeats=1,
+                       sampling_rate=sampling_rate, lazy=False,
+                       storage="float", raw_ai=False):
+    """Size of an experiment, from its protocol string alone: protocols,
+    trials, duration, samples and data file size (stimulus stored as
+    storage unless lazy, and recorded data, raw if raw_ai), warmup and
+    cooldown included"""
+    n_protocols = 0
+    n_samples = 0
+    for grid in parseProtocolString(protocol_string):
+        n_protocols += grid.n_protocols
+        for duration, count in grid.durations():
+            n_samples += count * protocolSamples(duration, sampling_rate)
+    warmup_samples = protocolSamples(warmup_duration, sampling_rate)
+    recorded_samples = repeats * n_samples + 2 * warmup_samples
+    if lazy:
+        stimulus_bytes = 0
+    else:
+        stimulus_bytes = int((n_samples + warmup_samples) *
+                             stimulus_bytes_per_sample[storage])
+    if raw_ai:
+        recorded_bytes = recorded_samples * raw_recorded_bytes_per_sample
+    else:
+        recorded_bytes = recorded_samples * recorded_bytes_per_sample
+    estimate = collections.OrderedDict()
+    estimate["Protocols"] = n_protocols
+    estimate["Trials"] = repeats * n_protocols + 2
+    estimate["Duration (s)"] = recorded_samples / float(sampling_rate)
+    estimate["Samples"] = recorded_samples
+    estimate["Stimulus Size (bytes)"] = stimulus_bytes
+    estimate["Recorded Size (bytes)"] = recorded_bytes
+    estimate["File Size (bytes)"] = stimulus_bytes + recorded_bytes
+    return estimate
+
+def printEstimate(estimate):
+    print "%d protocols, %d trials, %.1f min, %.2f GB (stimulus %.2f GB)" % \
+        (estimate["Protocols"], estimate["Trials"],
+         estimate["Duration (s)"] / 60.0,
+         estimate["File Size (bytes)"] / 1e9,
+         estimate["Stimulus Size (bytes)"] / 1e9)
+
+if __name__ == "__main__":
+    start = time.time()
+    estimate = estimateExperiment(sys.argv[1] if len(sys.argv) > 1 else
+                                  full_protocol_string)
+    printEstimate(estimate)
+    print "Checked in %.3f s" % (time.time() - start)
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -4,38 +4,48 @@
 """
 
 from .experimentCommon import *
-from .dataIO import *
-import DAQmxAcquisition
+from .acquisitionEngine import AcquisitionEngine
+try:
+    import DAQmxAcquisition
+except ImportError:
+    DAQmxAcquisition = None
+import DAQSimulation
 from .stimulus import AddExperimentToDataFile
+from .protocolLanguage import expandStimulusRepresentation, \
+                              estimateExperiment, printEstimate
+from .liveData import liveTap
+from .stimulusCache import stimulusCache
 import LEDarena
+try:
+    from .arenaEmulator import teensyEmulator
+except ImportError:
+    teensyEmulator = None
 
-def abortExperimentOnKeypress():
-    global experimentAbort
-    while True:
-        char = getch()
-        if char == "\x08":
-            experimentAbort = True
+def abortExperimentOnKeypress(abort, stop):
+    while not stop.is_set():
+        char = getch(timeout=0.1)
+        if char is None:
+            continue
+        if char == "":
+            return
+        if char in ["\x08", "\x7f"]:
+            abort.set()
             return
 
 def runExperiment(data_file_name, file_mode='a', 
-                  experiment='full', mCalib=False, repeats=10):
+                  experiment='full', mCalib=False, repeats=10,
+                  simulate=False, flush_policy="protocol",
+                  sampling_rate=sampling_rate, sample_section=sample_section,
+                  live_tap=False, stimulus_cache=True, lazy_stimulus=False,
+                  stimulus_processes=None, stimulus_storage="float",
+                  raw_ai=False):
     data_file = h5py.File(data_file_name, file_mode)
-    global inputQ, outputQ, experimentEnd, experimentAbort
     if experiment not in data_file:
         if experiment == "mCalib":
             protocol_string = "mec(4,5,4,[0,120/120,0],0.4)"
             randomize = False
         elif experiment == "full":
-            protocol_string = '''
-    vis(4,5,4,10,[0/1/2/3],40);
-    vis(4,8,4,10,[4/5],40);
-    vic(4,5,4,10,[0/1/2/3],[0,100/100,0]);
-    mep(4,[0.02,4.08/0.1,4/0.5,4],0.4);
-    men(4,5,4,120,0.4);
-    mec(4,5,4,[0,120/120,0],0.4);
-    mcv(4,5,5,0,4,[0,120/120,0],0.4,10,[0/1/2/3],40);
-    mcv(4,8,8,0,4,[0,120/120,0],0.4,10,[4/5],40);
-    '''
+            protocol_string = full_protocol_string
             randomize = True
         elif experiment == "brb":
             protocol_string = "brb(100)"
@@ -54,11 +64,40 @@ def runExperiment(data_file_name, file_mode='a',
             else:
                 randomize = False
     
+        printEstimate(estimateExperiment(protocol_string, repeats=repeats,
+                                         sampling_rate=sampling_rate,
+                                         lazy=lazy_stimulus,
+                                         storage=stimulus_storage,
+                                         raw_ai=raw_ai))
+        if stimulus_cache is True:
+            stimulus_cache = stimulusCache()
+        elif stimulus_cache == "link":
+            stimulus_cache = stimulusCache(link=True)
+        elif not stimulus_cache:
+            stimulus_cache = None
         AddExperimentToDataFile(data_file_name, experiment_name=experiment,
                                 protocol_string=expandStimulusRepresentation(protocol_string), 
-                                randomize=randomize, mCalib=mCalib, repeats=repeats)
-    LED_arena = LEDarena.arena('com7')
-    LED_arena.setBrightness(arena_brightness_percent)
+                                randomize=randomize, mCalib=mCalib, repeats=repeats,
+                                sampling_rate=sampling_rate,
+                                sample_section=sample_section,
+                                stimulus_cache=stimulus_cache,
+                                lazy=lazy_stimulus,
+                                processes=stimulus_processes,
+                                storage=stimulus_storage)
+        if stimulus_cache is not None:
+            print "Stimulus cache: %d protocols reused, %d generated" % \
+                (stimulus_cache.n_hits, stimulus_cache.n_misses)
+    arena_emulator = None
+    if simulate:
+        if teensyEmulator is not None:
+            arena_emulator = teensyEmulator()
+            LED_arena = LEDarena.arena(arena_emulator.port)
+            LED_arena.setBrightness(arena_brightness_percent)
+        else:
+            LED_arena = None
+    else:
+        LED_arena = LEDarena.arena('com7')
+        LED_arena.setBrightness(arena_brightness_percent)
     
     for item in [experiment, "warmup", "cooldown"]:
         if item not in data_file:
@@ -69,48 +108,65 @@ def runExperiment(data_file_name, file_mode='a',
     data_file = h5py.File(data_file_name, 'a')
     experiment_ref = data_file[experiment]
     experiment_ref.attrs["Arena: Brightness percent"] = arena_brightness_percent
-    experiment_duration = experiment_ref.attrs["Trial End Point List"][-1] / sampling_rate
-    
-    DAQ = DAQmxAcquisition.Continuous(ai="Dev1/ai0:2",
-                                      ao="Dev1/ao0:1",
-                                      di="Dev1/port0/line2:3",
-                                      do="Dev1/port0/line0:1")
-    
-    thread.start_new_thread(readStimulus, (experiment_ref, ))
-    thread.start_new_thread(writeData, (experiment_ref, data_file))
-    
-    thread.start_new_thread(abortExperimentOnKeypress, tuple())
-    
-    while True:
-        if experimentAbort:
-            break
-        try:
-            output_item = outputQ.get(block=True,timeout=0.1)
-        except Queue.Empty:
-            if inputQ.empty():
-                break
-            else:
-                continue
-        if output_item.new_protocol:
-            data_file.flush()
-            LED_arena.sendPattern(angular_size=int(output_item.arena_angular_size),
-                                  mode=output_item.arena_mode)
-            print "\nDone", secondsToHMS((output_item.read_till - sample_section) / sampling_rate),
-            print "of", secondsToHMS(experiment_duration)        
-            print "Current Protocol:", output_item.protocol_name.split('/')[-1], 
-            print "Duration:", output_item.protocol_duration
-            
-        input_item = inputItem()
-        input_item.analog_in, input_item.digital_in = \
-            DAQ.acquire(output_item.analog_out, output_item.digital_out)
-        if len(input_item.analog_in) > 0:
-            inputQ.put_nowait(input_item)
-    
-    temp1, temp2 = DAQ.acquire(dataArray(), dataArray(digital=True))
-    DAQ.stop()
-    data_file.flush()
-    data_file.close()
-    LED_arena._end()
-    return experimentAbort, experimentEnd
+    if simulate:
+        DAQ_module = DAQSimulation
+    else:
+        DAQ_module = DAQmxAcquisition
+    DAQ = DAQ_module.Continuous(ai="Dev1/ai0:2",
+                                ao="Dev1/ao0:1",
+                                di="Dev1/port0/line2:3",
+                                do="Dev1/port0/line0:1",
+                                n_samples_section=int(experiment_ref.attrs.get(
+                                    "Section Samples", 1000)),
+                                sampling_rate=experiment_ref.attrs.get(
+                                    "Sampling Rate", 10000),
+                                raw_ai=raw_ai)
+    if live_tap:
+        if live_tap is True:
+            live_tap = None
+        live_tap = liveTap(live_tap, ai_chan_count=DAQ.ai_chan_count,
+                           di_chan_count=DAQ.di_chan_count,
+                           sampling_rate=DAQ.sampling_rate,
+                           ai_scaling=DAQ.ai_scaling_coefficients,
+                           n_samples_section=DAQ.n_samples_section)
+        print "Live data tap:", live_tap.path
+    else:
+        live_tap = None
+    engine = AcquisitionEngine(experiment_ref, data_file, DAQ,
+                               LED_arena=LED_arena,
+                               flush_policy=flush_policy,
+                               live_tap=live_tap)
+    stop_keypress = threading.Event()
+    keypress_thread = threading.Thread(target=abortExperimentOnKeypress,
+                                       args=(engine.abort, stop_keypress))
+    keypress_thread.daemon = True
+    terminal_settings = cbreakTerminal()
+    try:
+        keypress_thread.start()
+        experiment_abort, experiment_end = engine.run()
+    finally:
+        stop_keypress.set()
+        if keypress_thread.is_alive():
+            keypress_thread.join()
+        restoreTerminal(terminal_settings)
+        print "Section buffer allocations during run:", \
+            DAQ.n_buffer_allocations
+        print "Backpressure: stimulus", engine.n_output_backpressure, \
+              "data", engine.n_input_backpressure
+        if LED_arena is not None:
+            LED_arena.end()
+            n_commands, _, max_round_trip, n_timeouts = \
+                LED_arena.roundTripSummary()
+            experiment_ref.attrs["Arena: Commands"] = n_commands
+            experiment_ref.attrs["Arena: Max Round Trip (ms)"] = max_round_trip
+            experiment_ref.attrs["Arena: Acknowledgement Timeouts"] = n_timeouts
+            if LED_arena.error is not None:
+                experiment_ref.attrs["Arena: Serial Error"] = \
+                    str(LED_arena.error)
+        if arena_emulator is not None:
+            arena_emulator.close()
+        data_file.flush()
+        data_file.close()
+    return experiment_abort, experiment_end
 
 # vim: set ts=4 sw=4 ft=python ai nu et
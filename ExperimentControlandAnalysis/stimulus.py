@@ -3,8 +3,26 @@
 @author: Umesh Mohan (umeshm@ncbs.res.in)
 """
 from .experimentCommon import *
-from .analysis import mec_hallEffectSensorToDisplacementAmplitude
-from .dataFileHandling import Protocol
+from .dataFileHandling import GetSamplingRate
+from .motorCalibration import motorCalibration
+from .protocolLanguage import parseProtocol
+
+# Version of the generators below; part of the stimulus cache key, so bump
+# it whenever a change alters generated waveforms, and list the protocol
+# types it alters in stimulus_version_changes
+stimulus_version = 2
+stimulus_version_changes = {2: ["men"]}
+# Protocol types with random stimuli: generated afresh for every data file,
+# never cached, from a seed stored with the protocol
+random_protocol_types = ["men"]
+# Protocol types whose waveforms depend on the motor calibration
+calibrated_protocol_types = ["mec", "mcv"]
+# How Analog Out and Digital Out are stored: "float" (the default, the
+# layout every reader expects) as float64 and uint8 per line, "compact" as DAC codes (int16, the AO channels' 16 bits over
+# -10 to 10 V) and bit-packed lines, "compressed" as compact with the
+# constant stretches compressed away (gzip)
+stimulus_storage_types = ["float", "compact", "compressed"]
+dac_scale = 20.0 / 2 ** 16
 
 # PrSD  PreStimulus Duration
 # SD    Stimulus Duration
@@ -23,28 +41,30 @@ from .dataFileHandling import Protocol
 #            0: To Amplifier GATE
 #            1: To LED arena - next in sequence
 
-dt = 1 / float(sampling_rate)
-
 def AddExperimentToDataFile(data_file_path, experiment_name="Test",
                               protocol_string="bla(60)", 
                               randomize=True,
                               mCalib=None,
-                              repeats=1):
+                              repeats=1,
+                              sampling_rate=sampling_rate,
+                              sample_section=sample_section,
+                              stimulus_cache=None,
+                              lazy=False,
+                              processes=None,
+                              storage="float"):
     stimulus_master_file = h5py.File(data_file_path, 'a')
     if mCalib:
-        mCalib_file = h5py.File(mCalib["file"], 'r')
-        calib_exp = mCalib_file[mCalib["protocol"]]
+        motor_calibration = motorCalibration.fromFile(mCalib["file"],
+                                                      mCalib["protocol"])
+        calibration_hash = motor_calibration.calibration_hash
     else:
-        calib_exp = None
+        motor_calibration = None
+        calibration_hash = None
     if "warmup" not in stimulus_master_file:
-        length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            _createStimulus(protocol_id="bla(5)")
-        protocol = stimulus_master_file.create_group("warmup")
-        protocol.attrs["Arena: Angular Size"] = arena_angular_size
-        protocol.attrs["Arena: Mode"] = arena_mode
-        protocol.attrs["Number of Samples"] = length
-        protocol.create_dataset("Analog Out", data=analog_out, fletcher32=True)
-        protocol.create_dataset("Digital Out", data=digital_out, fletcher32=True)            
+        _addProtocol(stimulus_master_file, "warmup", "bla(5)",
+                     sampling_rate=sampling_rate,
+                     stimulus_cache=stimulus_cache, lazy=lazy,
+                     storage=storage)
     if "cooldown" not in stimulus_master_file:
         stimulus_master_file["cooldown"] = h5py.SoftLink("/warmup")
     
@@ -55,22 +75,28 @@ def AddExperimentToDataFile(data_file_path, experiment_name="Test",
         experiment.attrs['Title'] = experiment_name
         experiment.attrs['Protocol String'] = protocol_string
         experiment.attrs['Randomized'] = randomize
+        experiment.attrs['Sampling Rate'] = sampling_rate
+        experiment.attrs['Section Samples'] = sample_section
         protocol_list = protocol_string.split(';')
         if randomize:
             random.shuffle(protocol_list)
         unique_protocol_list = protocol_list[:]
         protocol_list = repeats * unique_protocol_list
-        for protocol_id in unique_protocol_list:
-            length, arena_angular_size, arena_mode, analog_out, digital_out = \
-                _createStimulus(protocol_id=protocol_id, mCalib=calib_exp)
-            protocol = experiment.create_group(protocol_id)
-            protocol.attrs["Arena: Angular Size"] = arena_angular_size
-            protocol.attrs["Arena: Mode"] = arena_mode
-            protocol.attrs["Number of Samples"] = length
-            protocol.create_dataset("Analog Out", data=analog_out, fletcher32=True)
-            protocol.create_dataset("Digital Out", data=digital_out, fletcher32=True)
-        experiment["warmup"] = h5py.SoftLink("/warmup")
-        experiment["cooldown"] = h5py.SoftLink("/cooldown")
+        _addProtocolList(experiment, unique_protocol_list,
+                         mCalib=motor_calibration, sampling_rate=sampling_rate,
+                         stimulus_cache=stimulus_cache,
+                         calibration_hash=calibration_hash, lazy=lazy,
+                         processes=processes, storage=storage)
+        if GetSamplingRate(stimulus_master_file["warmup"]) == sampling_rate:
+            experiment["warmup"] = h5py.SoftLink("/warmup")
+            experiment["cooldown"] = h5py.SoftLink("/cooldown")
+        else:
+            _addProtocol(experiment, "warmup", "bla(5)",
+                         sampling_rate=sampling_rate,
+                         stimulus_cache=stimulus_cache, lazy=lazy,
+                         storage=storage)
+            experiment["cooldown"] = h5py.SoftLink(experiment.name +
+                                                   "/warmup")
         protocol_list = ["warmup"] + protocol_list + ["cooldown"]
         experiment.attrs['Protocol List'] = protocol_list
         trial_end_point_list = [0]
@@ -79,55 +105,267 @@ def AddExperimentToDataFile(data_file_path, experiment_name="Test",
                 experiment[protocol].attrs["Number of Samples"])
         experiment.attrs["Trial End Point List"] = trial_end_point_list
     stimulus_master_file.close()
-    if mCalib:
-        mCalib_file.close()
-
-def _createStimulus(protocol_id="bla(60)", mCalib=None):
-    t = protocol_id.split("(")
-    protocol_type = t[0]
-    protocol_parameters = []
-    for parameter in t[1][:-1].split(','):
-        protocol_parameters.append(float(parameter))
+
+def _addProtocolList(parent, protocol_id_list, mCalib=None,
+                     sampling_rate=sampling_rate, stimulus_cache=None,
+                     calibration_hash=None, lazy=False, processes=None,
+                     storage="float"):
+    """_addProtocol for every protocol id, in order
+
+    Stimuli that have to be generated (not in stimulus_cache) are generated
+    by a pool of processes (one per core if processes is None) when there
+    are at least two. This process stays the only writer: it stores each
+    protocol as its stimulus arrives, in protocol_id_list order, with at
+    most two stimuli per process generated ahead of it. Calibrated
+    protocols are generated here too, from mCalib's memoized corrections.
+    """
+    seed_list = [_newSeed(protocol_id) for protocol_id in protocol_id_list]
+    job_list = []
+    for protocol_id, seed in zip(protocol_id_list, seed_list):
+        key = _cacheKey(protocol_id, sampling_rate, calibration_hash,
+                        stimulus_cache=stimulus_cache, lazy=lazy,
+                        mCalib=mCalib, storage=storage)
+        if (key is not None and stimulus_cache.hasEntry(key)) or \
+           (mCalib is not None and
+            protocol_id.split("(")[0] in calibrated_protocol_types):
+            job_list.append(None)
+        else:
+            job_list.append((protocol_id, sampling_rate, seed))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    n_jobs = len(job_list) - job_list.count(None)
+    n_processes = min(processes, n_jobs)
+    pool = None
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes)
+    pending = collections.deque()
+    job_iterator = (job for job in job_list if job is not None)
+    start = time.time()
+    try:
+        for n, (protocol_id, seed, job) in enumerate(zip(protocol_id_list,
+                                                         seed_list,
+                                                         job_list)):
+            stimulus = None
+            if pool is not None and job is not None:
+                while len(pending) < 2 * n_processes:
+                    next_job = next(job_iterator, None)
+                    if next_job is None:
+                        break
+                    pending.append(pool.apply_async(_generateStimulus,
+                                                    (next_job, )))
+                stimulus = pending.popleft().get()
+            _addProtocol(parent, protocol_id, protocol_id, mCalib=mCalib,
+                         sampling_rate=sampling_rate,
+                         stimulus_cache=stimulus_cache,
+                         calibration_hash=calibration_hash, lazy=lazy,
+                         seed=seed, stimulus=stimulus, storage=storage)
+            print "  Stimulus %d/%d %s (%.1f s)" % \
+                (n + 1, len(protocol_id_list), protocol_id,
+                 time.time() - start)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _generateStimulus(job):
+    """_createStimulus in a pool process; job is (protocol id, sampling
+    rate, seed)"""
+    protocol_id, sampling_rate, seed = job
+    return _createStimulus(protocol_id=protocol_id,
+                           sampling_rate=sampling_rate, seed=seed)
+
+def _newSeed(protocol_id):
+    """Seed for a protocol with random stimuli, None for others"""
+    if protocol_id.split("(")[0] in random_protocol_types:
+        return random.SystemRandom().randint(0, 2 ** 32 - 1)
+    return None
+
+def _cacheKey(protocol_id, sampling_rate, calibration_hash,
+              stimulus_cache=None, lazy=False, mCalib=None,
+              storage="float"):
+    """Stimulus cache key of a protocol, None if it is not to be cached"""
+    protocol_type = protocol_id.split("(")[0]
+    if protocol_type in calibrated_protocol_types and mCalib is not None:
+        lazy = False
+    if stimulus_cache is None or lazy or \
+       protocol_type in random_protocol_types:
+        return None
+    if protocol_type not in calibrated_protocol_types:
+        calibration_hash = None
+    return (protocol_id, float(sampling_rate), stimulus_version,
+            calibration_hash, storage)
+
+def _addProtocol(parent, name, protocol_id, mCalib=None,
+                 sampling_rate=sampling_rate, stimulus_cache=None,
+                 calibration_hash=None, lazy=False, seed=None,
+                 stimulus=None, storage="float"):
+    """Protocol group with the protocol's attributes and its Analog Out
+    and Digital Out. With lazy, the waveforms are not stored: readStimulus
+    synthesizes them from the attributes (Stimulus: Protocol, Version and
+    Seed) when the protocol is played, and synthesizeProtocol for analysis.
+    Calibrated protocols are always stored, their calibration is in
+    another file. stimulus is what _createStimulus returns, if it was
+    generated already. storage is one of stimulus_storage_types."""
+    protocol_type = protocol_id.split("(")[0]
+    if protocol_type in calibrated_protocol_types and mCalib is not None:
+        lazy = False
+    key = _cacheKey(protocol_id, sampling_rate, calibration_hash,
+                    stimulus_cache=stimulus_cache, lazy=lazy, mCalib=mCalib,
+                    storage=storage)
+    if key is not None:
+        return stimulus_cache.addProtocol(parent, name, key,
+            lambda group, group_name: _addProtocol(group, group_name,
+                protocol_id, mCalib=mCalib, sampling_rate=sampling_rate,
+                stimulus=stimulus, storage=storage))
+    if seed is None:
+        seed = _newSeed(protocol_id)
+    if stimulus is None:
+        stimulus = _createStimulus(protocol_id=protocol_id, mCalib=mCalib,
+                                   sampling_rate=sampling_rate, seed=seed)
+    length, arena_angular_size, arena_mode, analog_out, digital_out = \
+        stimulus
+    protocol = parent.create_group(name)
+    protocol.attrs["Arena: Angular Size"] = arena_angular_size
+    protocol.attrs["Arena: Mode"] = arena_mode
+    protocol.attrs["Number of Samples"] = length
+    protocol.attrs["Sampling Rate"] = sampling_rate
+    protocol.attrs["Stimulus: Protocol"] = protocol_id
+    protocol.attrs["Stimulus: Version"] = stimulus_version
+    if seed is not None:
+        protocol.attrs["Stimulus: Seed"] = seed
+    if not lazy:
+        _storeStimulus(protocol, analog_out, digital_out, storage=storage)
+    return protocol
+
+def _storeStimulus(protocol, analog_out, digital_out, storage="float"):
+    if storage not in stimulus_storage_types:
+        raise NotImplementedError("Stimulus storage " + str(storage) +
+                                  " not implemented")
+    if storage == "float":
+        protocol.create_dataset("Analog Out", data=analog_out,
+                                fletcher32=True)
+        protocol.create_dataset("Digital Out", data=digital_out,
+                                fletcher32=True)
+        return
+    if storage == "compressed":
+        options = {"compression": "gzip", "compression_opts": 1,
+                   "shuffle": True}
+    else:
+        options = {}
+    codes = np.clip(np.round(analog_out / dac_scale), -2 ** 15, 2 ** 15 - 1)
+    dataset = protocol.create_dataset("Analog Out Codes",
+                                      data=codes.astype(np.int16),
+                                      fletcher32=True, **options)
+    dataset.attrs["Scale (V)"] = dac_scale
+    dataset.attrs["Offset (V)"] = 0.0
+    dataset = protocol.create_dataset("Digital Out Bits",
+                                      data=np.packbits(digital_out.T != 0,
+                                                       axis=1),
+                                      fletcher32=True, **options)
+    dataset.attrs["Number of Samples"] = len(digital_out)
+
+def _readStimulus(protocol_ref):
+    """Analog Out and Digital Out as stored, decoded if compact"""
+    if "Analog Out" in protocol_ref:
+        return protocol_ref["Analog Out"][...], protocol_ref["Digital Out"][...]
+    codes = protocol_ref["Analog Out Codes"]
+    analog_out = codes[...] * codes.attrs["Scale (V)"] + \
+                 codes.attrs["Offset (V)"]
+    bits = protocol_ref["Digital Out Bits"]
+    digital_out = np.unpackbits(bits[...], axis=1)[
+        :, :bits.attrs["Number of Samples"]]
+    return analog_out, np.ascontiguousarray(digital_out.T)
+
+def synthesizeProtocol(protocol_ref):
+    """Analog Out and Digital Out of a protocol, as stored (decoded if
+    compact) or, for a lazily stored protocol, synthesized exactly as they
+    would have been"""
+    if "Analog Out" in protocol_ref or "Analog Out Codes" in protocol_ref:
+        return _readStimulus(protocol_ref)
+    _checkVersion(protocol_ref)
+    seed = protocol_ref.attrs.get("Stimulus: Seed")
+    if seed is not None:
+        seed = int(seed)
+    _, _, _, analog_out, digital_out = _createStimulus(
+        protocol_id=protocol_ref.attrs["Stimulus: Protocol"],
+        sampling_rate=GetSamplingRate(protocol_ref), seed=seed)
+    return analog_out, digital_out
+
+def protocolNoise(protocol_ref):
+    """(first sample, number of samples, noiseSource) of the noise of a
+    men protocol, regenerated from its recorded seed. Reading the
+    noiseSource chunk by chunk gives the noise exactly as it was played,
+    in constant memory, e.g. for reverse correlation of long recordings."""
+    _checkVersion(protocol_ref)
+    protocol = parseProtocol(protocol_ref.attrs["Stimulus: Protocol"])
+    if protocol.protocol_type != "men":
+        raise Exception("Protocol " + protocol_ref.name + " is not men")
+    return _mechanicalNoiseSource(protocol.parameters,
+        sampling_rate=GetSamplingRate(protocol_ref),
+        seed=int(protocol_ref.attrs["Stimulus: Seed"]))
+
+def _checkVersion(protocol_ref):
+    """Raise unless this stimulus version synthesizes the protocol as the
+    version that stored it did"""
+    version = protocol_ref.attrs["Stimulus: Version"]
+    protocol_type = str(protocol_ref.attrs["Stimulus: Protocol"]).split("(")[0]
+    changed_type_list = []
+    for changed_version, type_list in stimulus_version_changes.items():
+        if changed_version > version:
+            changed_type_list.extend(type_list)
+    if version > stimulus_version or protocol_type in changed_type_list:
+        raise Exception("Protocol " + protocol_ref.name + " was stored by " +
+                        "stimulus version " + str(version) + ", this is " +
+                        str(stimulus_version))
+
+def _createStimulus(protocol_id="bla(60)", mCalib=None,
+                    sampling_rate=sampling_rate, seed=None):
+    protocol = parseProtocol(protocol_id)
+    protocol_type = protocol.protocol_type
+    protocol_parameters = list(protocol.parameters)
     if protocol_type == "bla":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            blank(protocol_parameters)
+            blank(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "brb":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            bridgeBalance(protocol_parameters)
+            bridgeBalance(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "mep":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalPulse(protocol_parameters)
+            mechanicalPulse(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "mes":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalSine(protocol_parameters)
+            mechanicalSine(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "mec":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalChirp(protocol_parameters,mCalib=mCalib)
+            mechanicalChirp(protocol_parameters, mCalib=mCalib,
+                            sampling_rate=sampling_rate)
     elif protocol_type == "men":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalNoise(protocol_parameters)
+            mechanicalNoise(protocol_parameters, sampling_rate=sampling_rate,
+                            seed=seed)
     elif protocol_type == "vis":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            visual(protocol_parameters)
+            visual(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "vic":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            visualChirp(protocol_parameters)
+            visualChirp(protocol_parameters, sampling_rate=sampling_rate)
     elif protocol_type == "msv":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalSineAndVisual(protocol_parameters)
+            mechanicalSineAndVisual(protocol_parameters,
+                                    sampling_rate=sampling_rate)
     elif protocol_type == "mcv":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            mechanicalChirpAndVisual(protocol_parameters,mCalib=mCalib)
+            mechanicalChirpAndVisual(protocol_parameters, mCalib=mCalib,
+                                     sampling_rate=sampling_rate)
     elif protocol_type == "dye":
         length, arena_angular_size, arena_mode, analog_out, digital_out = \
-            dye(protocol_parameters)
+            dye(protocol_parameters, sampling_rate=sampling_rate)
     else:
         raise NotImplementedError("Stimulus " + protocol_type +
                                   " not implemented")
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def blank(parameters):
-    global sampling_rate
+def blank(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Blank", 1, parameters)
     [SD] = parameters
     length = _roundoff(SD * sampling_rate)
@@ -137,79 +375,88 @@ def blank(parameters):
     arena_mode = "forward"
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def bridgeBalance(parameters):
-    global sampling_rate
+def bridgeBalance(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Bridge Balance", 1, parameters)
     [SD] = parameters
     length = _roundoff(SD * sampling_rate)
     temp, arena_angular_size, arena_mode, analog_out, digital_out = \
-        blank([SD])
-    analog_out[:, 0] = 0.05 * _squareWave(SD, frequency=3, digital=False)
+        blank([SD], sampling_rate=sampling_rate)
+    analog_out[:, 0] = 0.05 * _squareWave(SD, frequency=3, digital=False,
+                                          sampling_rate=sampling_rate)
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalPulse(parameters):
-    global sampling_rate
+def mechanicalPulse(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Mechanical Pulse", 4, parameters)
     [PrSD, SD, PoSD, amplitude] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
     temp, arena_angular_size, arena_mode, analog_out, digital_out = \
-        blank([PrSD + SD + PoSD])
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     stimulus_start_n = PrSD * sampling_rate
     stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
     analog_out[stimulus_start_n:stimulus_stop_n, 1] = \
-        amplitude * np.ones((SD * sampling_rate), dtype=np.float64)
+        _pulse(SD, amplitude=amplitude, sampling_rate=sampling_rate)
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalSine(parameters):
-    global sampling_rate
+def mechanicalSine(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Mechanical Sine", 5, parameters)
     [PrSD, SD, PoSD, frequency, amplitude] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
     temp, arena_angular_size, arena_mode, analog_out, digital_out = \
-        blank([PrSD + SD + PoSD])
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     stimulus_start_n = PrSD * sampling_rate
     stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
     analog_out[stimulus_start_n:stimulus_stop_n, 1] = \
-        amplitude * _sineWave(SD, frequency=frequency)
+        amplitude * _sineWave(SD, frequency=frequency,
+                              sampling_rate=sampling_rate)
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalChirp(parameters,mCalib=None):
-    global sampling_rate
+def mechanicalChirp(parameters, mCalib=None, sampling_rate=sampling_rate):
     _protocolParameterCheck("Mechanical Chirp", 6, parameters)
     [PrSD, SD, PoSD, frequency_0, frequency_1, amplitude] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
     temp, arena_angular_size, arena_mode, analog_out, digital_out = \
-        blank([PrSD + SD + PoSD])
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     stimulus_start_n = PrSD * sampling_rate
     stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
     analog_out[stimulus_start_n:stimulus_stop_n, 1] = \
         _chirp(SD, frequency_0=frequency_0, frequency_1=frequency_1,
-               amplitude=amplitude, mCalib=mCalib)
+               amplitude=amplitude, mCalib=mCalib,
+               sampling_rate=sampling_rate)
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalNoise(parameters):
-    global sampling_rate
+def mechanicalNoise(parameters, sampling_rate=sampling_rate, seed=None):
     _protocolParameterCheck("Mechanical Noise", 5, parameters)
     [PrSD, SD, PoSD, frequency_0, amplitude] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
     temp, arena_angular_size, arena_mode, analog_out, digital_out = \
-        blank([PrSD + SD + PoSD])
-    stimulus_start_n = PrSD * sampling_rate
-    stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
-    analog_out[stimulus_start_n:stimulus_stop_n, 1] = \
-        _noise(SD, frequency_0=frequency_0, amplitude=amplitude*4)
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
+    stimulus_start_n, n_samples, noise_source = _mechanicalNoiseSource(
+        parameters, sampling_rate=sampling_rate, seed=seed)
+    noise_source.read(n_samples, out=analog_out[
+        stimulus_start_n:stimulus_start_n + n_samples, 1])
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def visual(parameters):
-    global sampling_rate
+def _mechanicalNoiseSource(parameters, sampling_rate=sampling_rate,
+                           seed=None):
+    """First sample, number of samples and noiseSource of the noise in a
+    Mechanical Noise protocol"""
+    [PrSD, SD, PoSD, frequency_0, amplitude] = parameters
+    stimulus_start_n = int(PrSD * sampling_rate)
+    stimulus_stop_n = int(PrSD * sampling_rate + SD * sampling_rate)
+    return stimulus_start_n, stimulus_stop_n - stimulus_start_n, \
+        noiseSource(frequency_0, amplitude * 4, sampling_rate=sampling_rate,
+                    seed=seed)
+
+def visual(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Visual", 6, parameters)
     [PrSD, SD, PoSD, arena_angular_size, mode, arena_speed] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
-    temp1, temp2, temp3, analog_out, digital_out = blank([PrSD + SD + PoSD])
+    temp1, temp2, temp3, analog_out, digital_out = \
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     stimulus_start_n = PrSD * sampling_rate
     stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
     digital_out[stimulus_start_n:stimulus_stop_n, 1] = \
-        _squareWave(SD, frequency=arena_speed)
+        _squareWave(SD, frequency=arena_speed, sampling_rate=sampling_rate)
     if mode == 0:
         arena_mode = "forward"
     elif mode == 1:
@@ -227,15 +474,16 @@ def visual(parameters):
                                   str(mode))
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def visualChirp(parameters):
-    global sampling_rate
+def visualChirp(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Visual Chirp", 7, parameters)
     [PrSD, SD, PoSD, arena_angular_size, mode, arena_speed_0, arena_speed_1] = parameters
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
-    temp1, temp2, temp3, analog_out, digital_out = blank([PrSD + SD + PoSD])
+    temp1, temp2, temp3, analog_out, digital_out = \
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     stimulus_start_n = PrSD * sampling_rate
     stimulus_stop_n = stimulus_start_n + (SD * sampling_rate)
-    temp = _chirp(SD, frequency_0=arena_speed_0, frequency_1=arena_speed_1, amplitude=1)
+    temp = _chirp(SD, frequency_0=arena_speed_0, frequency_1=arena_speed_1,
+                  amplitude=1, sampling_rate=sampling_rate)
     temp = temp > 0
     digital_out[stimulus_start_n:stimulus_stop_n, 1] = temp.astype(np.uint8)
     if mode == 0:
@@ -251,8 +499,7 @@ def visualChirp(parameters):
                                   str(mode))
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalSineAndVisual(parameters):
-    global sampling_rate
+def mechanicalSineAndVisual(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("Mechanical Sine + Visual", 10, parameters)
     [PrSD, MSD, VSD, MVD, PoSD, frequency, amplitude, arena_angular_size,
      mode, arena_speed] = parameters
@@ -279,11 +526,13 @@ def mechanicalSineAndVisual(parameters):
         visual_stimulus_start_n = PrSD * sampling_rate
         visual_stimulus_stop_n = visual_stimulus_start_n + (VSD * sampling_rate) 
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
-    temp1, temp2, temp3, analog_out, digital_out = blank([PrSD + SD + PoSD])
+    temp1, temp2, temp3, analog_out, digital_out = \
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     digital_out[visual_stimulus_start_n:visual_stimulus_stop_n, 1] = \
-        _squareWave(VSD, frequency=arena_speed)
+        _squareWave(VSD, frequency=arena_speed, sampling_rate=sampling_rate)
     analog_out[mechanical_stimulus_start_n:mechanical_stimulus_stop_n, 1] = \
-        amplitude * _sineWave(MSD, frequency=frequency)
+        amplitude * _sineWave(MSD, frequency=frequency,
+                              sampling_rate=sampling_rate)
     if mode == 0:
         arena_mode = "forward"
     elif mode == 1:
@@ -301,8 +550,7 @@ def mechanicalSineAndVisual(parameters):
                                   str(mode))
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def mechanicalChirpAndVisual(parameters,mCalib=None):
-    global sampling_rate
+def mechanicalChirpAndVisual(parameters, mCalib=None, sampling_rate=sampling_rate):
     _protocolParameterCheck("Mechanical Chirp + Visual", 11, parameters)
     [PrSD, MSD, VSD, MVD, PoSD, frequency_0, frequency_1, amplitude,
      arena_angular_size, mode, arena_speed] = parameters
@@ -329,12 +577,14 @@ def mechanicalChirpAndVisual(parameters,mCalib=None):
         visual_stimulus_start_n = PrSD * sampling_rate
         visual_stimulus_stop_n = visual_stimulus_start_n + (VSD * sampling_rate) 
     length = _roundoff((PrSD + SD + PoSD) * sampling_rate)
-    temp1, temp2, temp3, analog_out, digital_out = blank([PrSD + SD + PoSD])
+    temp1, temp2, temp3, analog_out, digital_out = \
+        blank([PrSD + SD + PoSD], sampling_rate=sampling_rate)
     digital_out[visual_stimulus_start_n:visual_stimulus_stop_n, 1] = \
-        _squareWave(VSD, frequency=arena_speed)
+        _squareWave(VSD, frequency=arena_speed, sampling_rate=sampling_rate)
     analog_out[mechanical_stimulus_start_n:mechanical_stimulus_stop_n, 1] = \
         _chirp(MSD, frequency_0=frequency_0, amplitude=amplitude,
-                           frequency_1=frequency_1,mCalib=mCalib)
+                           frequency_1=frequency_1,mCalib=mCalib,
+                           sampling_rate=sampling_rate)
     if mode == 0:
         arena_mode = "forward"
     elif mode == 1:
@@ -352,73 +602,127 @@ def mechanicalChirpAndVisual(parameters,mCalib=None):
                                   str(mode))
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def dye(parameters):
-    global sampling_rate
+def dye(parameters, sampling_rate=sampling_rate):
     _protocolParameterCheck("dye", 2, parameters)
     [SD, frequency] = parameters
     length = _roundoff(SD * sampling_rate)
-    length, arena_angular_size, arena_mode, analog_out, digital_out = blank([SD])
-    digital_out[:, 0] = _squareWave(SD, frequency=frequency)
+    length, arena_angular_size, arena_mode, analog_out, digital_out = \
+        blank([SD], sampling_rate=sampling_rate)
+    digital_out[:, 0] = _squareWave(SD, frequency=frequency,
+                                    sampling_rate=sampling_rate)
     return length, arena_angular_size, arena_mode, analog_out, digital_out
 
-def _squareWave(duration, frequency=1, duty_cycle=0.5, digital=True):
-    global sampling_rate
-    length = int(duration * sampling_rate)
-    t = np.linspace(0, duration, duration * sampling_rate, endpoint=False)
-    square_wave = (0.5 * scipy.signal.square(2 * np.pi * frequency * t)) + 0.5
+# The primitives below broadcast over their parameters: scalars give one
+# waveform, arrays of parameter sets (all of the same shape) one row per set,
+# rendered in a single call.
+
+def _sampleTimes(duration, sampling_rate=sampling_rate):
+    """Sample times of a stimulus, as np.arange(0, duration, dt)"""
+    dt = 1 / float(sampling_rate)
+    return np.arange(0, duration, dt)
+
+def _parameterSet(parameter):
+    """parameter as a column, to broadcast over sample times"""
+    return np.asarray(parameter, dtype=np.float64)[..., np.newaxis]
+
+def _squareWave(duration, frequency=1, duty_cycle=0.5, digital=True,
+                sampling_rate=sampling_rate):
+    t = np.linspace(0, duration, int(duration * sampling_rate),
+                    endpoint=False)
+    # high where scipy.signal.square is, without its per-element masking
+    square_wave = np.mod(2 * np.pi * _parameterSet(frequency) * t,
+                         2 * np.pi) < _parameterSet(duty_cycle) * 2 * np.pi
     if digital:
         return square_wave.astype(np.uint8)
     else:
         return square_wave.astype(np.float64)
 
-def _sineWave(duration, frequency=15):
-    global sampling_rate, dt
-    T = np.arange(0, duration, dt)
-    sine_wave = np.sin(2 * np.pi * frequency * T)
+def _sineWave(duration, frequency=15, sampling_rate=sampling_rate):
+    T = _sampleTimes(duration, sampling_rate=sampling_rate)
+    sine_wave = np.sin(2 * np.pi * _parameterSet(frequency) * T)
     return sine_wave.astype(np.float64)
 
-def _chirp(duration, frequency_0=0, frequency_1=120, amplitude=0.4, mCalib=None):
-    global sampling_rate, dt
+def _pulse(duration, amplitude=1, sampling_rate=sampling_rate):
+    pulse = _parameterSet(amplitude) * np.ones(int(duration * sampling_rate))
+    return pulse
+
+def _chirp(duration, frequency_0=0, frequency_1=120, amplitude=0.4, mCalib=None,
+           sampling_rate=sampling_rate):
+    T = _sampleTimes(duration, sampling_rate=sampling_rate)
+    frequency_0, frequency_1, amplitude = np.broadcast_arrays(
+        np.asarray(frequency_0, dtype=np.float64),
+        np.asarray(frequency_1, dtype=np.float64),
+        np.asarray(amplitude, dtype=np.float64))
     k = (frequency_1 - frequency_0) / duration
-    T = np.arange(0, duration, dt)
-    chirp = np.asarray([np.sin(2 * np.pi * (frequency_0 * t + ((k / 2) * (t ** 2))))
-             for t in T], dtype=np.float64)
+    chirp = np.sin(2 * np.pi * (_parameterSet(frequency_0) * T +
+                                ((_parameterSet(k) / 2) * (T ** 2))))
+    chirp = chirp.reshape(frequency_0.shape + T.shape)
     if mCalib is not None:
-        mCalib_list = mCalib.keys()
-        for protocol in mCalib_list:
-            t = protocol.split("(")
-            protocol_type = t[0]
-            if protocol_type != 'mec':
-                continue
-            protocol_parameters = []
-            for parameter in t[1][:-1].split(','):
-                protocol_parameters.append(float(parameter))
-            if protocol_parameters[1] == duration and \
-               protocol_parameters[3] == frequency_0 and \
-               protocol_parameters[4] == frequency_1 and \
-               protocol_parameters[5] == amplitude:
-                   chirp_protocol = Protocol(mCalib)
-                   resonance_correction = \
-                       mec_hallEffectSensorToDisplacementAmplitude(\
-                           chirp_protocol['Processed Data']\
-                                         ['Mean Antennal Movement'],
-                           mec_parameters=protocol_parameters)
-                   #print chirp.size, resonance_correction.size
-                   #print duration, frequency_0, frequency_1, amplitude
-                   chirp=chirp*resonance_correction
-                   break
-    return chirp * amplitude
-
-def _noise(duration, frequency_0, amplitude):
-    global sampling_rate, dt
-    sample_size = sampling_rate * duration * 3
-    white_noise = np.random.random(sample_size)
-    white_noise =  (2 * amplitude * (white_noise - np.mean(white_noise)))
-    print np.mean(white_noise), np.max(white_noise), np.min(white_noise)
-    normalized_f_0 = frequency_0 / (0.5 * sampling_rate)
-    b, a = scipy.signal.butter(10, normalized_f_0, btype='low', analog=False)
-    band_limited_white_noise = scipy.signal.filtfilt(b, a, white_noise)
-    return band_limited_white_noise[sample_size/3:2*sample_size/3].astype(np.float64)
+        for index in np.ndindex(frequency_0.shape):
+            resonance_correction = mCalib.correction(duration,
+                frequency_0[index], frequency_1[index], amplitude[index],
+                sampling_rate=sampling_rate)
+            if resonance_correction is not None:
+                chirp[index] = chirp[index] * resonance_correction
+    return chirp * amplitude[..., np.newaxis]
+
+def _noise(duration, frequency_0, amplitude, sampling_rate=sampling_rate,
+           seed=None):
+    """Band-limited noise (see noiseSource), batched over parameter sets
+    like the other primitives; the n-th set uses seed + n"""
+    n_samples = int(duration * sampling_rate)
+    frequency_0, amplitude = np.broadcast_arrays(
+        np.asarray(frequency_0, dtype=np.float64),
+        np.asarray(amplitude, dtype=np.float64))
+    noise = np.empty(frequency_0.shape + (n_samples, ))
+    for n, index in enumerate(np.ndindex(frequency_0.shape)):
+        if seed is None:
+            index_seed = None
+        else:
+            index_seed = (seed + n) % 2 ** 32
+        noiseSource(frequency_0[index], amplitude[index],
+                    sampling_rate=sampling_rate,
+                    seed=index_seed).read(n_samples, out=noise[index])
+    return noise
+
+class noiseSource:
+    """Band-limited noise, generated chunk by chunk
+
+    Uniform white noise (-amplitude to amplitude) from RandomState(seed),
+    low pass filtered below frequency_0 by a 10 pole Butterworth filter,
+    applied twice for the magnitude response filtfilt used to give (not
+    zero phase), as second order sections. The filter state is carried
+    from chunk to chunk: working memory does not depend on how much is
+    read, and a seed gives the same noise however it is read. The filter
+    runs for 20 periods of frequency_0 before the first sample, so the
+    noise starts settled.
+    """
+    def __init__(self, frequency_0, amplitude, sampling_rate=sampling_rate,
+                 seed=None, chunk_samples=2 ** 16):
+        self.amplitude = float(amplitude)
+        self.chunk_samples = chunk_samples
+        self._random_state = np.random.RandomState(seed)
+        sos = scipy.signal.butter(10, frequency_0 / (0.5 * sampling_rate),
+                                  btype='low', output='sos')
+        self._sos = np.vstack((sos, sos))
+        self._state = np.zeros((len(self._sos), 2))
+        self.skip(int(20 * sampling_rate / frequency_0))
+
+    def read(self, n_samples, out=None):
+        """Next n_samples of noise, into out if given"""
+        if out is None:
+            out = np.empty(n_samples)
+        for start in range(0, n_samples, self.chunk_samples):
+            stop = min(start + self.chunk_samples, n_samples)
+            white_noise = 2 * self.amplitude * \
+                (self._random_state.random_sample(stop - start) - 0.5)
+            out[start:stop], self._state = scipy.signal.sosfilt(
+                self._sos, white_noise, zi=self._state)
+        return out
+
+    def skip(self, n_samples):
+        for start in range(0, n_samples, self.chunk_samples):
+            self.read(min(self.chunk_samples, n_samples - start))
 
 def _roundoff(length):
     if length < 1000:
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Requirements : h5py
+
+Stimulus waveform cache shared by data files.
+
+Every generated protocol (its Analog Out, Digital Out and attributes) is
+kept in the cache directory as an HDF5 file named by the SHA-1 of its key:
+protocol id, sampling rate, generator version and calibration hash (see
+stimulus._addProtocol). A data file gets a copy of the cached group, copied
+as stored without regenerating or re-checksumming it, or with link=True
+external links to the cached datasets.
+
+The cache is kept under max_bytes by evicting the least recently used
+entries (by modification time, touched on every use). Entries that a data
+file links to are pinned: the entry's .pin file lists the data files linking
+to it, and it is not evicted while any of them exists. unpin releases a data
+file's entries explicitly, e.g. before moving it (a moved data file no longer
+pins them).
+"""
+
+from .experimentCommon import *
+import hashlib
+
+def defaultCachePath():
+    return os.path.join(os.path.expanduser("~"), ".ExperimentControl",
+                        "stimulus cache")
+
+class stimulusCache:
+    """Cache directory at path (defaultCachePath() if None)
+
+    addProtocol(parent, name, key, generate) puts protocol name into parent
+    from the entry for key, calling generate(group, name) to create the
+    entry first if there is none. n_hits and n_misses count lookups.
+    """
+    def __init__(self, path=None, max_bytes=2 * 1024 ** 3, link=False):
+        if path is None:
+            path = defaultCachePath()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.link = link
+        self.n_hits = 0
+        self.n_misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entryPath(self, key):
+        return os.path.join(self.path,
+                            hashlib.sha1(repr(key)).hexdigest() + ".h5")
+
+    def hasEntry(self, key):
+        return os.path.isfile(self.entryPath(key))
+
+    def addProtocol(self, parent, name, key, generate):
+        entry_path = self.entryPath(key)
+        if os.path.isfile(entry_path):
+            self.n_hits += 1
+            os.utime(entry_path, None)
+        else:
+            self.n_misses += 1
+            self._addEntry(entry_path, key, generate)
+            self.evict()
+        if self.link:
+            self._pin(entry_path, parent.file.filename)
+            protocol = parent.create_group(name)
+            with h5py.File(entry_path, 'r') as entry_file:
+                for attribute, value in entry_file["protocol"].attrs.items():
+                    protocol.attrs[attribute] = value
+                dataset_list = list(entry_file["protocol"])
+            for dataset in dataset_list:
+                protocol[dataset] = h5py.ExternalLink(entry_path,
+                                                      "/protocol/" + dataset)
+        else:
+            with h5py.File(entry_path, 'r') as entry_file:
+                parent.copy(entry_file["protocol"], name)
+        return parent[name]
+
+    def unpin(self, data_file_name):
+        """Stop data_file_name from pinning the entries it links to"""
+        data_file_name = os.path.realpath(data_file_name)
+        for file_name in os.listdir(self.path):
+            if file_name.endswith(".pin"):
+                pin_path = os.path.join(self.path, file_name)
+                self._writePins(pin_path, [name for name in
+                                           self._readPins(pin_path)
+                                           if name != data_file_name])
+
+    def evict(self):
+        """Remove least recently used entries until the unpinned ones fit in
+        max_bytes"""
+        entry_list = []
+        total_bytes = 0
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".h5"):
+                continue
+            entry_path = os.path.join(self.path, file_name)
+            if self._pinned(entry_path):
+                continue
+            status = os.stat(entry_path)
+            entry_list.append((status.st_mtime, status.st_size, entry_path))
+            total_bytes += status.st_size
+        for _, size, entry_path in sorted(entry_list)[:-1]:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+                total_bytes -= size
+            except OSError:
+                pass
+
+    def _pin(self, entry_path, data_file_name):
+        data_file_name = os.path.realpath(data_file_name)
+        pin_path = entry_path[:-len(".h5")] + ".pin"
+        if data_file_name not in self._readPins(pin_path):
+            with open(pin_path, 'a') as pin_file:
+                pin_file.write(data_file_name + "\n")
+
+    def _pinned(self, entry_path):
+        """Whether a data file still linking to the entry exists; drops
+        the ones that do not from its .pin file"""
+        pin_path = entry_path[:-len(".h5")] + ".pin"
+        if not os.path.isfile(pin_path):
+            return False
+        data_file_list = [name for name in self._readPins(pin_path)
+                          if os.path.isfile(name)]
+        self._writePins(pin_path, data_file_list)
+        return len(data_file_list) > 0
+
+    def _readPins(self, pin_path):
+        if not os.path.isfile(pin_path):
+            return []
+        with open(pin_path, 'r') as pin_file:
+            return [line.strip() for line in pin_file if line.strip() != ""]
+
+    def _writePins(self, pin_path, data_file_list):
+        if len(data_file_list) == 0:
+            if os.path.isfile(pin_path):
+                os.remove(pin_path)
+            return
+        with open(pin_path, 'w') as pin_file:
+            for data_file_name in data_file_list:
+                pin_file.write(data_file_name + "\n")
+
+    def _addEntry(self, entry_path, key, generate):
+        """Generate into a temporary file and move it into place, so other
+        processes never see a partial entry"""
+        temporary_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with h5py.File(temporary_path, 'w') as entry_file:
+            generate(entry_file, "protocol")
+            entry_file["protocol"].attrs["Stimulus Cache Key"] = repr(key)
+        try:
+            os.rename(temporary_path, entry_path)
+        except OSError:
+            os.remove(temporary_path)
+            if not os.path.isfile(entry_path):
+                raise
+
+# vim: set ts=4 sw=4 ft=python ai nu et
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+from ExperimentControlandAnalysis.dataFileHandling import AlignDigitalIn
+
+import sys
+per_trial = '--per_trial' in sys.argv[1:]
+for data_file_name in sys.argv[1:]:
+    if data_file_name == '--per_trial':
+        continue
+    for name, offset in sorted(AlignDigitalIn(data_file_name,
+                                              per_trial=per_trial).items()):
+        print(data_file_name + " " + name + ": Digital In offset " +
+              str(offset) + " samples")
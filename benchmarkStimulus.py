@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+@author: Umesh Mohan (umeshm@ncbs.res.in)
+
+Time to generate the stimuli of the full experiment, per protocol type, at
+10 and 100 kS/s (or the sampling rates given as arguments), and of chirps
+rendered one parameter set at a time, in one batched call and with the
+per-sample loop stimulus._chirp used to have.
+"""
+from ExperimentControlandAnalysis.experimentCommon import \
+    full_protocol_string, np
+from ExperimentControlandAnalysis.protocolLanguage import iterProtocols
+from ExperimentControlandAnalysis.stimulus import _createStimulus, _chirp
+from timeit import default_timer
+import collections
+import sys
+
+def _loopChirp(duration, frequency_0, frequency_1, amplitude, sampling_rate):
+    dt = 1 / float(sampling_rate)
+    k = (frequency_1 - frequency_0) / duration
+    T = np.arange(0, duration, dt)
+    return amplitude * np.asarray(
+        [np.sin(2 * np.pi * (frequency_0 * t + ((k / 2) * (t ** 2))))
+         for t in T], dtype=np.float64)
+
+def benchmark(sampling_rate):
+    protocol_list = list(iterProtocols(full_protocol_string))
+    type_time = collections.OrderedDict()
+    total_samples = 0
+    start = default_timer()
+    for protocol in protocol_list:
+        t0 = default_timer()
+        length = _createStimulus(protocol.protocol_id,
+                                 sampling_rate=sampling_rate)[0]
+        protocol_type = protocol.protocol_type
+        type_time[protocol_type] = type_time.get(protocol_type, 0) + \
+                                   default_timer() - t0
+        total_samples += length
+    total = default_timer() - start
+    print("%d S/s: %d protocols, %.1f s of stimulus in %.3f s" %
+          (sampling_rate, len(protocol_list), total_samples /
+           float(sampling_rate), total))
+    for protocol_type, seconds in type_time.items():
+        print("    %s %.3f s" % (protocol_type, seconds))
+    parameter_set_list = [(0, 120, 0.4), (120, 0, 0.4), (0, 100, 1),
+                          (100, 0, 1)]
+    t0 = default_timer()
+    for frequency_0, frequency_1, amplitude in parameter_set_list:
+        _chirp(5, frequency_0, frequency_1, amplitude,
+               sampling_rate=sampling_rate)
+    one_at_a_time = default_timer() - t0
+    t0 = default_timer()
+    _chirp(5, *zip(*parameter_set_list), sampling_rate=sampling_rate)
+    batched = default_timer() - t0
+    t0 = default_timer()
+    for frequency_0, frequency_1, amplitude in parameter_set_list:
+        _loopChirp(5, frequency_0, frequency_1, amplitude, sampling_rate)
+    loop = default_timer() - t0
+    print("    %d 5 s chirps: %.3f s one at a time, %.3f s batched, "
+          "%.3f s per-sample loop" % (len(parameter_set_list), one_at_a_time,
+                                      batched, loop))
+
+if __name__ == "__main__":
+    sampling_rate_list = [int(float(rate)) for rate in sys.argv[1:]]
+    for sampling_rate in sampling_rate_list or [10000, 100000]:
+        benchmark(sampling_rate)
+
+# vim: set ts=4 sw=4 ft=python ai nu et